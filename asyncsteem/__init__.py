@@ -1,5 +1,8 @@
 from .blockchain import ActiveBlockChain
 from .blockfinder import DateFinder
 from .jsonrpc import RpcClient
+from .blockcache import BlockCache
+from .checkpoint import Checkpoint
+from .rpccache import ResultCache
 
-__all__ = ['blockchain','blockfinder','jsonrpc','nodesets']
+__all__ = ['blockchain','blockcache','blockfinder','blocksource','checkpoint','codec','commandqueue','connectionpool','dispatcher','events','jsonrpc','jsonstream','metrics','mocknode','nodescheduler','nodesets','quarantine','rpccache','timestamps','workers']
@@ -0,0 +1,103 @@
+"""Persistent on-disk cache for irreversible blocks."""
+import os
+import mmap
+import struct
+from .codec import default_codec
+
+#Index records: block number, segment number, offset within segment, length of the JSON encoded block.
+_INDEX_RECORD = struct.Struct("<QIQI")
+
+class BlockCache(object):
+    """Append-only store of JSON encoded blocks with an offset index keyed by block number."""
+    def __init__(self, path, segment_size=256*1024*1024, codec=None):
+        """Constructor
+
+        Args:
+            path : Directory to keep the segment and index files in, created if it doesn't exist.
+            segment_size : Size in bytes after which a new segment file is started.
+            codec : Optional asyncsteem.codec.Codec for encoding and decoding blocks, the fastest one installed by default.
+        """
+        self.path = path
+        self.codec = codec if codec != None else default_codec
+        self.segment_size = segment_size
+        self.index = dict()       #Block number to (segment, offset, length) mapping.
+        self.maps = dict()        #Memory maps of segment files, keyed by segment number.
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.segment = 0
+        self._load_index()
+        self.segment_file = open(self._segment_path(self.segment), "ab")
+        self.index_file = open(os.path.join(self.path, "index.dat"), "ab")
+    def _segment_path(self, segment):
+        return os.path.join(self.path, "segment-%06d.dat" % segment)
+    def _load_index(self):
+        """Read the index file, ignoring records that point past the end of their segment after a crash."""
+        indexpath = os.path.join(self.path, "index.dat")
+        if not os.path.exists(indexpath):
+            return
+        sizes = dict()
+        with open(indexpath, "rb") as indexfile:
+            data = indexfile.read()
+        #Drop a partially written trailing record.
+        usable = len(data) - len(data) % _INDEX_RECORD.size
+        for blockno, segment, offset, length in _INDEX_RECORD.iter_unpack(data[:usable]):
+            if not segment in sizes:
+                segpath = self._segment_path(segment)
+                sizes[segment] = os.path.getsize(segpath) if os.path.exists(segpath) else 0
+            if offset + length <= sizes[segment]:
+                self.index[blockno] = (segment, offset, length)
+            if segment > self.segment:
+                self.segment = segment
+        if usable != len(data):
+            with open(indexpath, "r+b") as indexfile:
+                indexfile.truncate(usable)
+    def _map(self, segment, end):
+        """Return a memory map of a segment that covers at least up to end."""
+        segmap = self.maps.get(segment)
+        if segmap == None or len(segmap) < end:
+            if segmap != None:
+                segmap.close()
+            with open(self._segment_path(segment), "rb") as segfile:
+                segmap = mmap.mmap(segfile.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = segmap
+        return segmap
+    def get(self, blockno):
+        """Return the cached block or None if we don't have it."""
+        location = self.index.get(blockno)
+        if location == None:
+            self.misses = self.misses + 1
+            return None
+        segment, offset, length = location
+        self.hits = self.hits + 1
+        return self.codec.loads(self._map(segment, offset + length)[offset:offset+length])
+    def put(self, blockno, blk):
+        """Append a block to the cache. Only irreversible blocks should ever be stored."""
+        if blockno in self.index:
+            return
+        data = self.codec.dumps(blk)
+        offset = self.segment_file.tell()
+        if offset > 0 and offset + len(data) > self.segment_size:
+            #Start a new segment file.
+            self.segment_file.close()
+            self.segment = self.segment + 1
+            self.segment_file = open(self._segment_path(self.segment), "ab")
+            offset = 0
+        #Write the block before its index record, so the index never points at missing data.
+        self.segment_file.write(data)
+        self.segment_file.flush()
+        self.index_file.write(_INDEX_RECORD.pack(blockno, self.segment, offset, len(data)))
+        self.index_file.flush()
+        self.index[blockno] = (self.segment, offset, len(data))
+    def __contains__(self, blockno):
+        return blockno in self.index
+    def __len__(self):
+        return len(self.index)
+    def close(self):
+        """Close all files and memory maps."""
+        for segmap in self.maps.values():
+            segmap.close()
+        self.maps = dict()
+        self.segment_file.close()
+        self.index_file.close()
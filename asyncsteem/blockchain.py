@@ -1,14 +1,90 @@
 from .jsonrpc import RpcClient
 from .blockfinder import DateFinder
-import copy
-import dateutil.parser
+from .dispatcher import BlockDispatcher
+from .workers import spawn_workers, encode_filters
+from .codec import default_codec
+from .timestamps import parse_timestamp, datetime_to_epoch
 import time
+import collections
+import heapq
 from datetime import date
-from datetime import datetime as dt
 from dateutil import relativedelta
 
 
-class ActiveBlockChain(object):
+#Seconds before the first retry of a get_block that got an error, doubled for every next retry up to _RETRY_DELAY_MAX.
+_RETRY_DELAY = 0.5
+_RETRY_DELAY_MAX = 30
+
+#JSON-RPC error code of a node that doesn't know block_api.get_block_range, other errors are worth a retry.
+_METHOD_NOT_FOUND = -32601
+
+#Asset symbols for the NAI asset identifiers used by the appbase API.
+_NAI_SYMBOLS = {"@@000000021" : "STEEM", "@@000000013" : "SBD", "@@000000037" : "VESTS"}
+
+def _legacy_value(value):
+    """Convert appbase style assets inside an operation value to legacy asset strings."""
+    if isinstance(value,dict):
+        if "nai" in value and "amount" in value and "precision" in value and value["nai"] in _NAI_SYMBOLS:
+            precision = value["precision"]
+            amount = int(value["amount"])
+            sign = "-" if amount < 0 else ""
+            whole, frac = divmod(abs(amount), 10 ** precision)
+            if precision > 0:
+                return sign + str(whole) + "." + str(frac).zfill(precision) + " " + _NAI_SYMBOLS[value["nai"]]
+            return sign + str(whole) + " " + _NAI_SYMBOLS[value["nai"]]
+        return dict((k,_legacy_value(v)) for k,v in value.items())
+    if isinstance(value,list):
+        return [_legacy_value(v) for v in value]
+    return value
+
+def _legacy_block(blk):
+    """Convert the operations in an appbase block_api block to the legacy ["vote",{...}] form."""
+    if isinstance(blk,dict) and "transactions" in blk and isinstance(blk["transactions"],list):
+        for transaction in blk["transactions"]:
+            if "operations" in transaction and isinstance(transaction["operations"],list):
+                operations = list()
+                for operation in transaction["operations"]:
+                    if isinstance(operation,dict) and "type" in operation and "value" in operation:
+                        opname = operation["type"]
+                        if opname.endswith("_operation"):
+                            opname = opname[:-len("_operation")]
+                        operation = [opname,_legacy_value(operation["value"])]
+                    operations.append(operation)
+                transaction["operations"] = operations
+    return blk
+
+
+class _ReorderBuffer(object):
+    """Helper class holding blocks that arrived before their predecessors."""
+    def __init__(self, max_size):
+        self.max_size = max_size  #Maximum number of blocks held back.
+        self.next_block = None    #The block number that should be handed to the bots next.
+        self.blocks = dict()      #Early blocks keyed by block number.
+    def start(self, blockno):
+        """Set the first block number to be released."""
+        self.next_block = blockno
+        self.blocks = dict()
+    def full(self):
+        """Check if the buffer has reached its memory cap."""
+        return len(self.blocks) >= self.max_size
+    def add(self, blockno, blk):
+        """Add a block to the buffer, returns False for blocks that were already released."""
+        if self.next_block == None or blockno < self.next_block:
+            return False
+        self.blocks[blockno] = blk
+        return True
+    def pop_ready(self):
+        """Return the contiguous run of (block number, block) pairs starting at next_block, in order."""
+        ready = list()
+        while self.next_block in self.blocks:
+            ready.append((self.next_block,self.blocks.pop(self.next_block)))
+            self.next_block = self.next_block + 1
+        return ready
+    def __len__(self):
+        return len(self.blocks)
+
+
+class ActiveBlockChain(BlockDispatcher):
     """Class for following the blockchain as it grows, or processing it from a given block in the past"""
     def __init__(self,
                  reactor,
@@ -20,7 +96,45 @@ class ActiveBlockChain(object):
                  parallel=16,
                  rpc_timeout=15,
                  initial_batch_size = 128,
-                 stop_when_empty= False):
+                 stop_when_empty= False,
+                 ordered=False,
+                 reorder_buffer_size=1024,
+                 range_size=None,
+                 range_parallel=4,
+                 block_cache=None,
+                 checkpoint=None,
+                 checkpoint_interval=60,
+                 interpolate_search=False,
+                 probe_cache=None,
+                 zero_copy=False,
+                 node_selection="roundrobin",
+                 hedge_percentile=None,
+                 adaptive_batching=False,
+                 lane_methods=None,
+                 coalesce=False,
+                 result_cache=None,
+                 aggregate_window=None,
+                 aggregate_limit=100,
+                 persistent=True,
+                 max_connections_per_node=None,
+                 idle_timeout=60,
+                 streaming_decode=False,
+                 max_response_size=None,
+                 json_backend=None,
+                 pending_rpc_high=None,
+                 pending_rpc_low=None,
+                 ready_blocks_high=None,
+                 ready_blocks_low=None,
+                 flow_poll_interval=0.1,
+                 workers=0,
+                 block_source=None,
+                 archive=None,
+                 metrics=None,
+                 profile_handlers=False,
+                 handler_budget=None,
+                 quarantine_after=None,
+                 quarantine_threads=4,
+                 block_retries=8):
         """Constructor
 
         Args:
@@ -34,6 +148,51 @@ class ActiveBlockChain(object):
             rpc_timeout : Timeout (in seconds) for a single HTTPS JSON-RPC query.
             initial_batch_size : The initial number of 'get_block' commands to start the command queue off with.
             stop_when_empty : Boolean indicating if reactor should be stopped when the command queue is empty and no active HTTPS sessions remain.
+            ordered : Boolean indicating if blocks should be handed to the bots strictly in block number order.
+            reorder_buffer_size : Maximum number of early blocks held back in ordered mode before new get_block queries are paused.
+            range_size : If set, catch up using block_api.get_block_range queries for this many blocks at a time.
+            range_parallel : Maximum number of outstanding get_block_range queries while catching up.
+            block_cache : Optional asyncsteem.blockcache.BlockCache used to serve and store irreversible blocks locally.
+            checkpoint : Optional asyncsteem.checkpoint.Checkpoint, if it holds a checkpoint we resume right after it.
+            checkpoint_interval : Number of seconds between writing checkpoints.
+            interpolate_search : Locate the rewind start block by interpolation, using a few get_block_header queries.
+            probe_cache : Optional file for persisting the block timestamp probes of the interpolation search.
+            zero_copy : Hand bots read-only event objects that share block and transaction meta instead of per event dict copies.
+            node_selection : "roundrobin" or "scored", see RpcClient.
+            hedge_percentile : If set, resend batches slower than this latency percentile to a second node, see RpcClient.
+            adaptive_batching : Detect JSON-RPC batch support and tune batch sizes per node, see RpcClient.
+            lane_methods : Dict mapping method names to "stream", "normal" or "bulk" command queue lanes, see RpcClient.
+            coalesce : Let identical in-flight read-only calls share a single network call, see RpcClient.
+            result_cache : Optional asyncsteem.rpccache.ResultCache for read-only call results, see RpcClient.
+            aggregate_window : If set, merge get_accounts style lookups made within this many seconds, see RpcClient.
+            aggregate_limit : Maximum number of unique names in a single merged lookup.
+            persistent : Keep HTTPS connections to the nodes open between requests, see RpcClient.
+            max_connections_per_node : Maximum number of idle connections kept open per node, defaults to parallel.
+            idle_timeout : Seconds an idle connection is kept open.
+            streaming_decode : Process batch replies while the response body is still coming in, see RpcClient.
+            max_response_size : Maximum size in bytes of a streamed response body.
+            json_backend : "orjson", "ujson" or "json", None for the fastest one installed, see RpcClient.
+            pending_rpc_high : If set, stop issuing get_block queries once this many bot queries are waiting in the command queue.
+            pending_rpc_low : Resume issuing get_block queries once no more than this many bot queries are waiting, defaults
+                              to half of pending_rpc_high.
+            ready_blocks_high : If set, stop issuing get_block queries once this many fetched blocks wait to be handed to the bots.
+            ready_blocks_low : Resume once no more than this many fetched blocks are waiting, defaults to half of ready_blocks_high.
+            flow_poll_interval : Seconds between checks of the watermarks while get_block queries are paused.
+            workers : Number of worker processes to start for bots registered with register_remote_bot.
+            block_source : Optional source to take blocks from instead of the API nodes, such as an
+                           asyncsteem.blocksource.ArchiveBlockSource. The API nodes are then only used for bot queries.
+                           Without rewind_days the whole source is replayed. Any object with the same start and now
+                           methods as ArchiveBlockSource will do.
+            archive : Optional asyncsteem.blocksource.ArchiveWriter that every block handed to the bots is written to.
+            metrics : Optional asyncsteem.metrics.Metrics, shared with the RpcClient, to report block progress, lag
+                      behind the head, flow control state and per bot handler times to.
+            profile_handlers : Record calls and cumulative and maximum wall time per bot and event, see handler_profile.
+            handler_budget : Seconds a single handler call may take, slower calls are logged. Implies profile_handlers.
+            quarantine_after : Number of handler calls in a row over budget after which a bot gets quarantined: its handlers
+                               then run in a thread pool, so it no longer holds back the other bots.
+            quarantine_threads : Maximum number of threads for quarantined bots.
+            block_retries : Number of times a get_block that got an error is retried, with a growing delay, before the
+                            block is skipped.
         """
         try:
             self.log = log
@@ -45,46 +204,200 @@ class ActiveBlockChain(object):
                                  nodelist=nodelist,
                                  parallel=parallel,
                                  rpc_timeout=rpc_timeout,
-                                 stop_when_empty=stop_when_empty)
+                                 stop_when_empty=stop_when_empty and block_source == None,
+                                 block_cache=block_cache,
+                                 node_selection=node_selection,
+                                 hedge_percentile=hedge_percentile,
+                                 adaptive_batching=adaptive_batching,
+                                 lane_methods=lane_methods,
+                                 coalesce=coalesce,
+                                 result_cache=result_cache,
+                                 aggregate_window=aggregate_window,
+                                 aggregate_limit=aggregate_limit,
+                                 persistent=persistent,
+                                 max_connections_per_node=max_connections_per_node,
+                                 idle_timeout=idle_timeout,
+                                 streaming_decode=streaming_decode,
+                                 max_response_size=max_response_size,
+                                 json_backend=json_backend,
+                                 metrics=metrics)
+            BlockDispatcher.__init__(self,log,zero_copy,profile_handlers,handler_budget,quarantine_after,quarantine_threads,reactor)
+            self.sync_block = None
+            self.missing_blocks = list() #Heap of block numbers past the sync_block we stopped asking for, fetched again first.
+            self.active_block_queries = 0
+            self.initial_batch_size = initial_batch_size
+            self.ordered = ordered
+            self.reorder_buffer = _ReorderBuffer(reorder_buffer_size)
+            self.held_fetches = 0  #Number of get_block queries we did not issue because the reorder buffer was full or of flow control.
+            self.held_ranges = 0   #Number of get_block_range queries we did not issue because of flow control.
+            self.ready = collections.deque() #Fetched (block number, block) pairs, in the order they are handed to the bots.
+            self.draining = False  #True while blocks from the ready queue are being processed.
+            self.pending_rpc_high = pending_rpc_high
+            self.pending_rpc_low = pending_rpc_low if pending_rpc_low != None or pending_rpc_high == None else pending_rpc_high // 2
+            self.ready_blocks_high = ready_blocks_high
+            self.ready_blocks_low = ready_blocks_low if ready_blocks_low != None or ready_blocks_high == None else ready_blocks_high // 2
+            self.flow_poll_interval = flow_poll_interval
+            self.flow_paused = False
+            self.flow_poll = None  #Delayed call checking the watermarks again while paused.
+            self.stop_when_empty = stop_when_empty
+            self.block_retries = block_retries
+            self.block_source = block_source
+            self.archive = archive
+            self.metrics = metrics
+            self.metrics_mark = (time.time(), 0) #Time and processed block count at the previous metrics collection.
+            self.processed_count = 0 #Number of blocks handed to the bots.
+            if metrics != None:
+                metrics.add_collector(self._collect_metrics)
+            if archive != None:
+                self.reactor.addSystemEventTrigger("before", "shutdown", archive.close)
+            self.workers = list()
+            self.remote_bots = dict()  #Worker process of each bot registered with register_remote_bot, by bot name.
+            if workers:
+                self.workers = spawn_workers(reactor,workers,self.rpc,log,zero_copy,self._worker_done,self._worker_ended)
+                self.reactor.addSystemEventTrigger("before", "shutdown", self._stop_workers)
+            self.range_size = range_size
+            self.range_parallel = range_parallel
+            self.range_mode = False
+            self.range_next = None     #First block of the next range to request.
+            self.range_deliver = None  #First block of the next range to hand to the bots.
+            self.range_results = dict()
+            self.checkpoint = checkpoint
+            self.checkpoint_interval = checkpoint_interval
+            self.checkpoint_data = None
+            self.contiguous_block = None  #Highest block number for which it and all blocks before it were processed.
+            self.processed_above = set()  #Processed blocks above contiguous_block.
+            if checkpoint != None:
+                self.checkpoint_data = checkpoint.load()
+                self.reactor.callLater(self.checkpoint_interval, self._checkpoint_tick)
+                self.reactor.addSystemEventTrigger("before", "shutdown", self._save_checkpoint)
             #Start at the apropriate block.
-            datefinder = DateFinder(self.rpc,log)
-            if rewind_days == None:
+            datefinder = DateFinder(self.rpc,log,interpolate=interpolate_search,probe_cache=probe_cache)
+            if block_source != None:
+                #Replay from a local source, the bots see the time of the source.
+                self.clock = block_source.now
+                start_block = None
+                start_time = None
+                if self.checkpoint_data != None:
+                    self.log.info("Resuming from checkpoint at block {block!r}",block=self.checkpoint_data["block"])
+                    start_block = self.checkpoint_data["block"] + 1
+                elif rewind_days != None:
+                    start_time = datetime_to_epoch(date.today() - relativedelta.relativedelta(hour=0,days=rewind_days))
+                block_source.start(self._source_block,self._source_done,self._fetch_blocked,start_block,start_time)
+            elif self.checkpoint_data != None:
+                #Resume exactly where we left off, no need to search for a start block.
+                self.log.info("Resuming from checkpoint at block {block!r}",block=self.checkpoint_data["block"])
+                self._bootstrap(self.checkpoint_data["block"] + 1)
+            elif rewind_days == None:
                 #If no date is given, use now
                 datefinder(self._bootstrap,None)
             else:
                 ddt = date.today() - relativedelta.relativedelta(hour=0,days=rewind_days)
                 datefinder(self._bootstrap,ddt)
-            self.active_events = dict() #The list of events the active bots are subscribed to.
-            self.ddt = None
-            self.last_ddt = None
-            self.synced = False
-            self.eventtypes = set()
-            self.sync_block = None
-            self.active_block_queries = 0
-            self.initial_batch_size = initial_batch_size
             #Wake up the RpcClient
             self.rpc()
         except Exception as ex:
             self.log.failure("Error in ActiveBlockChain constructor: {err!r}",err=str(ex))
-    def register_bot(self,bot,botname):
+    def register_bot(self,bot,botname,await_deferreds=False,filters=None):
         """Register a bot with the active blockchain.
 
         Args:
             bot: The bot object to register
             botname: A unique name for this bot.
+            await_deferreds: If a handler of this bot returns a Deferred, hold back the next block untill it has fired.
+            filters: Optional dict mapping operation event names to filters, see BlockDispatcher.register_bot.
         """
         try:
-            #Each method of the object not starting with an underscore is a handler of operation events
-            for key in dir(bot):
-                if key[0] != "_":
-                    #Create a new dict if no bots are yet registered for this event.
-                    if not key in self.active_events:
-                        self.active_events[key] = dict()
-                    #Add handler by bot name.
-                    self.active_events[key][botname] = getattr(bot,key)
+            if self.checkpoint_data != None and botname in self.checkpoint_data["bots"] and hasattr(bot,"_restore_checkpoint_state"):
+                #Give the bot back the state it had at the time of the checkpoint.
+                bot._restore_checkpoint_state(self.checkpoint_data["bots"][botname])
         except Exception as ex:
             self.log.failure("Error in ActiveBlockChain::register_bot : {err!r}",err=str(ex))
-    def _get_block(self,blockno):
+        BlockDispatcher.register_bot(self,bot,botname,await_deferreds,filters)
+    def register_remote_bot(self,factory,botname,args=(),worker=None,await_deferreds=False,filters=None):
+        """Register a bot that runs in one of the worker processes.
+
+        Blocks are sent to the workers in the same order they are handed to local bots, so each bot sees its events in
+        order. Bots in a worker get a proxy as client, that forwards calls to the RpcClient of this process.
+        Checkpoints only cover local bots, remote bots may lag behind them.
+
+        Args:
+            factory: "package.module:callable" path of a callable returning the bot object, called in the worker with args.
+            botname: A unique name for this bot.
+            args: JSON serializable arguments for the factory.
+            worker: Index of the worker process to run the bot in, by default bots are spread over the workers.
+            await_deferreds: If a handler of this bot returns a Deferred, the worker holds back its next block untill it has fired.
+            filters: Optional operation filters as for register_bot, limited to field values as they are sent to the worker as JSON.
+        """
+        try:
+            if not self.workers:
+                self.log.error("Can't register remote bot {bot!r} without worker processes.",bot=botname)
+                return
+            if worker == None:
+                worker = len(self.remote_bots) % len(self.workers)
+            process = self.workers[worker]
+            if process.ended:
+                self.log.error("Can't register remote bot {bot!r}, worker {index!r} has ended.",bot=botname,index=worker)
+                return
+            process.send({"type" : "bot", "name" : botname, "factory" : factory, "args" : list(args),
+                          "await_deferreds" : await_deferreds, "filters" : encode_filters(filters)})
+            self.remote_bots[botname] = process
+        except Exception as ex:
+            self.log.failure("Error in ActiveBlockChain::register_remote_bot : {err!r}",err=str(ex))
+    def unregister_bot(self,botname):
+        """Remove a previously registered local or remote bot from the active blockchain.
+
+        Args:
+            botname: The name the bot was registered with.
+        """
+        if botname in self.remote_bots:
+            self.remote_bots.pop(botname).send({"type" : "unregister", "name" : botname})
+        else:
+            BlockDispatcher.unregister_bot(self,botname)
+    def _forward_block(self,blockno,blk):
+        """Send a block to each worker process that hosts remote bots, encoding it only once."""
+        line = default_codec.dumps({"type" : "block", "block_num" : blockno, "block" : blk}) + b"\n"
+        for process in set(self.remote_bots.values()):
+            process.outstanding = process.outstanding + 1
+            process.write_line(line)
+    def _source_block(self,blockno,blk):
+        """Take a block from the block source."""
+        try:
+            if self.reorder_buffer.next_block == None:
+                #First block from the source.
+                self.log.info("Starting at block {block!r}",block=blockno)
+                self.reorder_buffer.start(blockno)
+                self.contiguous_block = blockno - 1
+            if self.last_block < blockno:
+                self.last_block = blockno
+            self._deliver_block(blockno,blk)
+            if self.rpc.queue:
+                #Send out the queries the bots made.
+                self.rpc()
+        except Exception as ex:
+            self.log.failure("Error in ActiveBlockChain::_source_block : {err!r}",err=str(ex))
+    def _source_done(self):
+        """The block source has handed out its last block."""
+        if self.ready or self.awaiting > 0 or self._backlog() > 0:
+            #Give the bots, worker processes and quarantined bots a chance to finish the last blocks first.
+            self.reactor.callLater(self.flow_poll_interval,self._source_done)
+            return
+        self.log.info("Block source done at block {block!r}",block=self.last_block)
+        if self.stop_when_empty:
+            #Stop once the last bot queries are done.
+            self.rpc.stop_when_empty = True
+            self.rpc()
+    def _worker_done(self):
+        if self.held_fetches > 0 or self.held_ranges > 0:
+            self._release_held()
+    def _worker_ended(self,process):
+        """Drop the remote bots of a worker process that has ended."""
+        for botname in [name for name, owner in self.remote_bots.items() if owner is process]:
+            self.log.error("Dropping remote bot {bot!r}, its worker process has ended.",bot=botname)
+            del self.remote_bots[botname]
+    def _stop_workers(self):
+        for process in self.workers:
+            process.stop()
+    def _get_block(self,blockno,attempt=0):
         try:
             def process_block_event(event,client):
                 try:
@@ -96,6 +409,9 @@ class ActiveBlockChain(object):
                             self.sync_block = blockno
                             self._get_block(blockno)
                         else:
+                            #Remember the block so we ask for it again once the blocks before it are there.
+                            if not blockno in self.missing_blocks:
+                                heapq.heappush(self.missing_blocks,blockno)
                             if self.active_block_queries == 0:
                                 #If it isn't, but this is the last query remaining, try the sync_block once more.
                                 self._get_block(self.sync_block)
@@ -106,10 +422,10 @@ class ActiveBlockChain(object):
                         #Clear the sync_block if needed
                         if self.sync_block != None and blockno >= self.sync_block:
                             self.sync_block = None
-                        #Process this whole block
-                        self._process_block(event)
+                        #Process this whole block, or hold it back untill all blocks before it have been processed.
+                        self._deliver_block(blockno,event)
                         #Add a new block getting command to the queue
-                        self._get_block(self.last_block+1)
+                        self._fetch_next()
                         if self.active_block_queries < self.initial_batch_size:
                             #We may want to scale up the number of get_block commands in the queue again.
                             if self.active_block_queries < 7:
@@ -118,138 +434,297 @@ class ActiveBlockChain(object):
                             else:
                                 #If we still end up running more than two minutes behind, keep scaling untill we don't
                                 treshold = 120
-                            behind = (dt.utcnow() - dateutil.parser.parse(event["timestamp"])).seconds
-                            if behind >= treshold:
+                            behind = time.time() - parse_timestamp(event["timestamp"])
+                            if behind >= treshold and not self._fetch_blocked():
                                 #Do an extra get_block if we are behind to far.
-                                self._get_block(self.last_block+1)
+                                self._fetch_next()
                                 self.log.info("Lost synchonysation, spinning up an extra parallel get_block query to {count!r}",count=self.active_block_queries)
                 except Exception as ex:
                     self.log.failure("Error in process_block_event : {err!r}",err=str(ex))
+            def process_block_error(errno,msg,client):
+                try:
+                    if attempt >= self.block_retries:
+                        self.active_block_queries = self.active_block_queries - 1
+                        self.log.error("Giving up on block {block!r} after {count!r} retries, skipping it : {err!r}",block=blockno,count=attempt,err=msg)
+                        #Let the blocks after it through in ordered mode, and keep the number of get_block queries up.
+                        self._deliver_block(blockno,None)
+                        self._fetch_next()
+                        return
+                    #Don't leave a gap in the chain, ask for the block again after a while.
+                    delay = min(_RETRY_DELAY_MAX,_RETRY_DELAY * 2 ** attempt)
+                    self.log.error("Error fetching block {block!r} : {err!r}, retrying in {delay!r} seconds.",block=blockno,err=msg,delay=delay)
+                    if self.metrics != None:
+                        self.metrics.inc("block_fetch_retries_total")
+                    self.reactor.callLater(delay,self._retry_block,blockno,attempt + 1)
+                except Exception as ex:
+                    self.log.failure("Error in process_block_error : {err!r}",err=str(ex))
             if self.last_block < blockno:
                 self.last_block = blockno
             cmd = self.rpc.get_block(blockno)
             cmd.on_result(process_block_event)
+            cmd.on_error(process_block_error)
             self.active_block_queries = self.active_block_queries + 1
         except Exception as ex:
             self.log.failure("Error in ActiveBlockChain::_get_block : {err!r}",err=str(ex))
+    def _retry_block(self,blockno,attempt):
+        #The failed query counts as active untill its retry is queued.
+        self.active_block_queries = self.active_block_queries - 1
+        self._get_block(blockno,attempt)
+        #Called from a timer, so wake up the RpcClient.
+        self.rpc()
+    def _fetch_next(self):
+        """Queue a get_block for the next block, unless the reorder buffer is full or flow control is holding back."""
+        if self._fetch_blocked():
+            #Hold back on fetching untill the reorder buffer has drained a bit or the bots have caught up.
+            self.held_fetches = self.held_fetches + 1
+        else:
+            self._get_block(self._next_blockno())
+    def _next_blockno(self):
+        """Return the number of the next block to ask for: the lowest one we stopped asking for, else the one after the last requested."""
+        if self.missing_blocks:
+            return heapq.heappop(self.missing_blocks)
+        return self.last_block+1
+    def _fetch_blocked(self):
+        return (self.ordered and self.reorder_buffer.full()) or self._flow_paused()
+    def _flow_paused(self):
+        """Check the watermarks, pausing above a high watermark and resuming once everything is below its low watermark."""
+        if self.pending_rpc_high == None and self.ready_blocks_high == None:
+            return False
+        pending = self.rpc.pending_commands() if self.pending_rpc_high != None else 0
+        ready = len(self.ready) + len(self.reorder_buffer) + self._backlog()
+        if not self.flow_paused:
+            if (self.pending_rpc_high != None and pending >= self.pending_rpc_high) or \
+               (self.ready_blocks_high != None and ready >= self.ready_blocks_high):
+                self.log.info("Pausing block fetching, {pending!r} bot queries and {ready!r} blocks waiting.",pending=pending,ready=ready)
+                self.flow_paused = True
+        elif (self.pending_rpc_high == None or pending <= self.pending_rpc_low) and \
+             (self.ready_blocks_high == None or ready <= self.ready_blocks_low):
+            self.log.info("Resuming block fetching.")
+            self.flow_paused = False
+        if self.flow_paused and (self.flow_poll == None or not self.flow_poll.active()):
+            #Bot queries complete without telling us, so keep checking while paused.
+            self.flow_poll = self.reactor.callLater(self.flow_poll_interval, self._release_held)
+        return self.flow_paused
+    def _backlog(self):
+        """Return the number of blocks handed out that worker processes or quarantined bots haven't finished yet."""
+        return max(self._worker_backlog(),self.quarantine_backlog())
+    def _worker_backlog(self):
+        """Return the largest number of blocks sent to a worker process that it hasn't processed yet."""
+        if not self.workers:
+            return 0
+        return max(process.outstanding for process in self.workers)
+    def _release_held(self):
+        """Issue the get_block and get_block_range queries we held back, as far as there is room now."""
+        try:
+            issued = False
+            while self.held_fetches > 0 and not self._fetch_blocked():
+                self.held_fetches = self.held_fetches - 1
+                self._get_block(self._next_blockno())
+                issued = True
+            while self.held_ranges > 0 and self.range_mode and not self._flow_paused():
+                self.held_ranges = self.held_ranges - 1
+                self._get_block_range()
+                issued = True
+            if not self.range_mode:
+                self.held_ranges = 0
+            if issued:
+                #We may be called from a timer or a fired Deferred with the RpcClient idle, so wake it up.
+                self.rpc()
+        except Exception as ex:
+            self.log.failure("Error in ActiveBlockChain::_release_held : {err!r}",err=str(ex))
+    def _deliver_block(self,blockno,blk):
+        """Hand a fetched block to the bots, in block number order if so configured."""
+        if not self.ordered:
+            self.ready.append((blockno,blk))
+        else:
+            if not self.reorder_buffer.add(blockno,blk):
+                self.log.error("Dropping out of window block {block!r}",block=blockno)
+                return
+            #Queue any contiguous run of blocks starting at the next expected block.
+            self.ready.extend(self.reorder_buffer.pop_ready())
+        self._drain()
+    def _drain(self):
+        """Process ready blocks, stopping whenever a bot has a returned Deferred outstanding."""
+        if self.draining:
+            #Called from within a handler, the outer loop will pick up from here.
+            return
+        self.draining = True
+        try:
+            while self.ready and self.awaiting == 0:
+                readyno, readyblk = self.ready.popleft()
+                if readyblk != None:
+                    #None for a block we gave up on fetching.
+                    self._process_block(readyblk)
+                    if self.remote_bots:
+                        self._forward_block(readyno,readyblk)
+                    if self.archive != None:
+                        self.archive.write(readyno,readyblk)
+                    self.processed_count = self.processed_count + 1
+                self._mark_processed(readyno)
+        finally:
+            self.draining = False
+        #Now there may be room again, issue the queries we held back.
+        self._release_held()
+    def flow_stats(self):
+        """Return flow control state: paused, waiting bot queries, ready blocks, outstanding Deferreds and held back queries."""
+        return {"paused" : self.flow_paused,
+                "pending_rpcs" : self.rpc.pending_commands(),
+                "ready_blocks" : len(self.ready) + len(self.reorder_buffer) + self._backlog(),
+                "awaiting" : self.awaiting,
+                "held_fetches" : self.held_fetches,
+                "held_ranges" : self.held_ranges}
+    def _collect_metrics(self,metrics):
+        """Report block progress, lag and flow control state."""
+        now = time.time()
+        mark_time, mark_count = self.metrics_mark
+        if now > mark_time:
+            metrics.set("blocks_per_second",(self.processed_count - mark_count) / (now - mark_time))
+        self.metrics_mark = (now, self.processed_count)
+        metrics.set_counter("blocks_processed_total",self.processed_count)
+        metrics.set("last_block",self.last_block)
+        if self.last_time != None:
+            metrics.set("block_lag_seconds",self.clock() - self.last_time)
+        metrics.set("ready_blocks",len(self.ready) + len(self.reorder_buffer) + self._backlog())
+        metrics.set("awaiting_deferreds",self.awaiting)
+        metrics.set("flow_paused",1 if self.flow_paused else 0)
+        metrics.set("quarantined_bots",len(self.quarantined))
+    def _mark_processed(self,blockno):
+        """Keep track of the highest contiguously processed block for checkpointing."""
+        if self.checkpoint == None:
+            return
+        if blockno == self.contiguous_block + 1:
+            self.contiguous_block = blockno
+            while self.contiguous_block + 1 in self.processed_above:
+                self.contiguous_block = self.contiguous_block + 1
+                self.processed_above.remove(self.contiguous_block)
+        elif blockno > self.contiguous_block:
+            self.processed_above.add(blockno)
+    def _save_checkpoint(self):
+        try:
+            if self.checkpoint != None and self.contiguous_block != None and self.contiguous_block > 0:
+                bots = dict()
+                for botname in self.bots:
+                    if hasattr(self.bots[botname],"_checkpoint_state"):
+                        bots[botname] = self.bots[botname]._checkpoint_state()
+                self.checkpoint.save(self.contiguous_block,bots)
+        except Exception as ex:
+            self.log.failure("Error in ActiveBlockChain::_save_checkpoint : {err!r}",err=str(ex))
+    def _checkpoint_tick(self):
+        self._save_checkpoint()
+        self.reactor.callLater(self.checkpoint_interval, self._checkpoint_tick)
     def _bootstrap(self,block):
         try:
             self.log.info("Starting at block {block!r}",block=block)
-            #Start up eight paralel https queries so we can catch up with the blockchain.
-            for index in range(0,self.initial_batch_size):
-                self._get_block(block+index)
+            self.reorder_buffer.start(block)
+            self.contiguous_block = block - 1
+            if self.range_size:
+                #Catch up with a few large get_block_range queries, we switch to get_block polling once near the head.
+                self.range_mode = True
+                self.range_next = block
+                self.range_deliver = block
+                for index in range(0,self.range_parallel):
+                    self._get_block_range()
+            else:
+                self._start_polling(block)
         except Exception as ex:
             self.log.failure("Error in ActiveBlockChain::_bootstrap : {err!r}",err=str(ex))
-    #The __call__ method is to be called only by the jsonrpc client!
-    def _process_block(self,blk):
+    def _start_polling(self,block):
+        #Start up eight paralel https queries so we can catch up with the blockchain.
+        for index in range(0,self.initial_batch_size):
+            self._get_block(block+index)
+    def _get_block_range(self,start=None,attempt=0):
         try:
-            if blk != None and "timestamp" in blk:
-                ts = blk["timestamp"]
-                ddt = None
+            if start == None:
+                start = self.range_next
+                self.range_next = start + self.range_size
+            cached = self._cached_range(start)
+            if cached != None:
+                #Serve the whole range from the local block cache, without going to the network.
+                self.reactor.callLater(0,self._cached_range_fetched,start,cached)
+                return
+            def process_range_event(event,client):
+                try:
+                    if not self.range_mode:
+                        #We already switched to get_block polling, ignore late results.
+                        return
+                    if event == None or not "blocks" in event or not isinstance(event["blocks"],list):
+                        self.log.error("Unusable get_block_range response, falling back to get_block.")
+                        self._end_range_fetch()
+                        return
+                    blocks = [_legacy_block(blk) for blk in event["blocks"]]
+                    for offset in range(0,len(blocks)):
+                        self.rpc.cache_block(start + offset,blocks[offset])
+                    self._range_fetched(start,blocks)
+                except Exception as ex:
+                    self.log.failure("Error in process_range_event : {err!r}",err=str(ex))
+            def process_range_error(errno,msg,client):
                 try:
-                    #Parse the time from the block
-                    ddt = dateutil.parser.parse(ts)
-                except:
-                    pass
-                if ddt !=None:
-                    #If this is a valid block with a valid time, check if we are synced yet
-                    if self.last_ddt == None or self.last_ddt < ddt:
-                        self.last_ddt = ddt
-                        #We consider ourselves synced if we are behind no more than two minutes
-                        if self.synced == False and (dt.now() - self.last_ddt).seconds < 120:
-                            self.synced  = True
-                    if self.ddt == None:
-                        self.ddt = ddt
+                    if not self.range_mode:
+                        return
+                    if errno == _METHOD_NOT_FOUND or "Could not find API" in msg:
+                        self.log.error("Node does not support get_block_range ({err!r}), falling back to get_block.",err=msg)
+                        self._end_range_fetch()
+                    elif attempt >= self.block_retries:
+                        self.log.error("Giving up on get_block_range at block {block!r} after {count!r} retries, falling back to get_block : {err!r}",block=start,count=attempt,err=msg)
+                        self._end_range_fetch()
                     else:
-                        if ddt > self.ddt and ddt.hour != self.ddt.hour:
-                            #Hour event
-                            self.ddt = ddt
-                            obj = dict()
-                            obj["year"] = ddt.year
-                            obj["month"] = ddt.month
-                            obj["day"] = ddt.day
-                            obj["weekday"] = ddt.weekday()
-                            obj["hour"] = ddt.hour
-                            if "hour" in self.active_events:
-                                #Invoke hour event on all bots that implement the hour method
-                                for bot in list(self.active_events["hour"].keys()):
-                                    try:
-                                        self.active_events["hour"][bot](ts,obj,self.rpc)
-                                    except Exception as e:
-                                        self.log.failure("Error in bot '{bot!r}' processing 'hour' event.",bot=bot)
-                            if ddt.hour == 0 and "day" in self.active_events:
-                                #Invoke day event on all bots that implement the day method
-                                for bot in list(self.active_events["day"].keys()):
-                                    try:
-                                        self.active_events["day"][bot](ts,obj,self.rpc)
-                                    except Exception as e:
-                                        self.log.failure("Error in bot '{bot!r}' processing 'day' event.",bot=bot)
-                            if ddt.hour == 0 and ddt.weekday == 0 and "week" in self.active_events:
-                                #Invoke week event on all bots that implement the week method
-                                for bot in list(self.active_events["week"].keys()):
-                                    try:
-                                        self.active_events["week"][bot](ts,obj,self.rpc)
-                                    except Exception as e:
-                                        self.log.failure("Error in bot '{bot!r}' processing 'week' event.",bot=bot)
-                blk_meta = dict()
-                #Copy relevant keys to block level meta.
-                for k in ["witness_signature",
-                          "block_id",
-                          "signing_key",
-                          "transaction_merkle_root",
-                          "witness","previous"]:
-                    if k in blk:
-                        blk_meta[k] = blk[k]
-                if "block" in self.active_events:
-                    #Invoke block event  on all bots that implement the block method
-                    for bot in list(self.active_events["block"].keys()):
-                        try:
-                            self.active_events["block"][bot](ts,blk_meta,self.rpc)
-                        except Exception as e:
-                            self.log.failure("Error in bot '{bot!r}' processing 'block' event.",bot=bot)
-                if "transactions" in blk and isinstance(blk["transactions"],list):
-                    for index in range(0,len(blk["transactions"])):
-                        transaction_meta = dict()
-                        #Start off transaction meta with our block level meta.
-                        transaction_meta["block_meta"] = copy.copy(blk_meta)
-                        #Copy the transaction id
-                        if "transaction_ids" in blk and isinstance(blk["transaction_ids"],list) and len(blk["transaction_ids"]) > index:
-                            transaction_meta["id"] = blk["transaction_ids"][index]
-                        #And copy some relevant transaction meta
-                        for k in ["ref_block_prefix","ref_block_num","expiration"]:
-                            if k in blk["transactions"][index]:
-                                transaction_meta[k] = blk["transactions"][index][k]
-                        if "transaction" in self.active_events:
-                            #Invoke transaction event  on all bots that implement the transaction method
-                            for bot in list(self.active_events["transaction"].keys()):
-                                try:
-                                    self.active_events["transaction"][bot](ts,transaction_meta,self.rpc)
-                                except Exception as e:
-                                    self.log.failure("Error in bot '{bot!r}' processing 'transaction' event.",bot=bot)
-                        if "operations" in blk["transactions"][index] and isinstance(blk["transactions"][index]["operations"],list):
-                            for oindex in range(0,len(blk["transactions"][index]["operations"])):
-                                #Get the name of the operation.
-                                operation = blk["transactions"][index]["operations"][oindex]
-                                #Do some logging of unimplemented methods on first occurance.
-                                if not operation[0] in self.eventtypes:
-                                    self.eventtypes.add(operation[0])
-                                    if not operation[0] in self.active_events:
-                                        self.log.info("Received an operation not implemented by any bot: {op!r}",op=operation[0])
-                                if isinstance(operation,list) and \
-                                   len(operation) == 2 and \
-                                   (isinstance(operation[0],str) or isinstance(operation[0],str)) and \
-                                   isinstance(operation[1],object) and \
-                                   operation[0] in self.active_events:
-                                    #Start off with operation meta copied from the operation.
-                                    op = copy.copy(operation[1])
-                                    op["operation_no"] = oindex
-                                    #Copy in thansaction (and block) level meta.
-                                    op["transaction_meta"] = copy.copy(transaction_meta)
-                                    #Invoke specific operation event  on all bots that implement the specific operation method
-                                    for bot in list(self.active_events[operation[0]].keys()):
-                                        try:
-                                            self.active_events[operation[0]][bot](ts,op,self.rpc)
-                                        except Exception as e:
-                                            self.log.failure("Error in bot '{bot!r}' processing '{op!r}' event.",bot=bot, op=operation[0])
+                        #Most likely a passing problem with the node, ask for the same range again after a while.
+                        delay = min(_RETRY_DELAY_MAX,_RETRY_DELAY * 2 ** attempt)
+                        self.log.error("Error fetching block range at {block!r} : {err!r}, retrying in {delay!r} seconds.",block=start,err=msg,delay=delay)
+                        if self.metrics != None:
+                            self.metrics.inc("block_fetch_retries_total")
+                        self.reactor.callLater(delay,self._retry_range,start,attempt + 1)
+                except Exception as ex:
+                    self.log.failure("Error in process_range_error : {err!r}",err=str(ex))
+            cmd = self.rpc.call("block_api","get_block_range",{"starting_block_num" : start, "count" : self.range_size})
+            cmd.on_result(process_range_event)
+            cmd.on_error(process_range_error)
         except Exception as ex:
-            self.log.failure("Error in ActiveBlockChain::_process_block : {err!r}",err=str(ex))
+            self.log.failure("Error in ActiveBlockChain::_get_block_range : {err!r}",err=str(ex))
+    def _retry_range(self,start,attempt):
+        if self.range_mode:
+            self._get_block_range(start,attempt)
+            #Called from a timer, so wake up the RpcClient.
+            self.rpc()
+    def _cached_range(self,start):
+        """Return the blocks of the range starting at start if the block cache has all of them, else None."""
+        if self.rpc.block_cache == None:
+            return None
+        blocks = list()
+        for blockno in range(start,start + self.range_size):
+            blk = self.rpc.block_cache.get(blockno)
+            if blk == None:
+                return None
+            blocks.append(blk)
+        return blocks
+    def _cached_range_fetched(self,start,blocks):
+        if self.range_mode:
+            self._range_fetched(start,blocks)
+            #Called from a timer, so wake up the RpcClient.
+            self.rpc()
+    def _range_fetched(self,start,blocks):
+        """Take the blocks of a range, handing complete ranges to the bots in order."""
+        self.range_results[start] = blocks
+        while self.range_mode and self.range_deliver in self.range_results:
+            blocks = self.range_results.pop(self.range_deliver)
+            for offset in range(0,len(blocks)):
+                self._deliver_block(self.range_deliver + offset,blocks[offset])
+            self.range_deliver = self.range_deliver + len(blocks)
+            if self.last_block < self.range_deliver - 1:
+                self.last_block = self.range_deliver - 1
+            if len(blocks) < self.range_size or self._near_head(blocks[-1]):
+                self._end_range_fetch()
+            elif self._flow_paused():
+                #Hold back on the next range untill the bots have caught up.
+                self.held_ranges = self.held_ranges + 1
+            else:
+                self._get_block_range()
+    def _near_head(self,blk):
+        """Check if a block is within one range worth of blocks from the head of the chain."""
+        behind = time.time() - parse_timestamp(blk["timestamp"])
+        return behind < self.range_size * 3
+    def _end_range_fetch(self):
+        self.log.info("Switching from get_block_range to get_block polling at block {block!r}",block=self.range_deliver)
+        self.range_mode = False
+        self.range_results = dict()
+        self._start_polling(self.range_deliver)
@@ -1,18 +1,39 @@
-import dateutil.parser
+import os
+import json
+import collections
+from .timestamps import parse_timestamp, datetime_to_epoch
+
+#Steem produces a block every three seconds.
+_BLOCK_INTERVAL = 3
 
 class DateFinder(object):
     """Class for finding the first block measured from a given time in the past."""
-    def __init__(self,client,log):
+    def __init__(self,client,log,interpolate=False,probe_cache=None,probe_cache_size=256):
         """Constructor
 
         Args:
             client : The asyncsteem JSON-RPC RpcClient to use.
             log    : The Twisted asynchonous logger to use.
+            interpolate : Locate blocks by interpolating from the head block time instead of by bisecting.
+            probe_cache : Optional path of a file for persisting (block number, timestamp) probes between runs.
+            probe_cache_size : Maximum number of probes kept in the probe cache.
 
         """
         self.rpc = client
         self.log = log
         self.active_queries = 0
+        self.interpolate = interpolate
+        self.probe_cache = probe_cache
+        self.probe_cache_size = probe_cache_size
+        self.probe_method = "get_block_header"
+        self.probes = collections.OrderedDict()  #Block number to timestamp (in epoch seconds) for irreversible blocks.
+        if probe_cache != None and os.path.exists(probe_cache):
+            try:
+                with open(probe_cache, "r") as cachefile:
+                    for blockno, timestamp in json.load(cachefile):
+                        self.probes[blockno] = timestamp
+            except Exception as ex:
+                self.log.error("Ignoring unreadable probe cache {path!r}: {err!r}",path=probe_cache,err=str(ex))
     def __call__(self,on_found,trigger_time=None):
         """Find a block that matches the given time and call callback
 
@@ -27,6 +48,10 @@ class DateFinder(object):
             cmd = self.rpc.get_dynamic_global_properties()
             cmd.on_result(process_global_config)
             return
+        if self.interpolate:
+            self._interpolate(on_found,trigger_time)
+            return
+        target = datetime_to_epoch(trigger_time)
         self.lower_limit = 0   #Initial window starts at zero
         self.upper_limit = -1  # and ends at infinity.
         self.found = False
@@ -35,8 +60,7 @@ class DateFinder(object):
                 if not self.found: #Don't continue if already found
                     self.active_queries = self.active_queries - 1
                     if event != None and "timestamp" in event:
-                        ddt = dateutil.parser.parse(event["timestamp"])
-                        if ddt < trigger_time:
+                        if parse_timestamp(event["timestamp"]) < target:
                             #Our guess was to early
                             if blk > self.lower_limit:
                                 if self.upper_limit > 0 and self.upper_limit - blk < 2:
@@ -71,7 +95,7 @@ class DateFinder(object):
                         if self.upper_limit != -1:
                             #Divide our remaining seach space into four chunks and use our own search index to figure out what block to
                             #look at next.
-                            nexttry = self.lower_limit + (self.upper_limit - self.lower_limit)*(ndx+1)/4
+                            nexttry = self.lower_limit + (self.upper_limit - self.lower_limit)*(ndx+1)//4
                             get_block(nexttry,ndx)
                         else:
                             nexttry = blk + 30000000
@@ -87,3 +111,101 @@ class DateFinder(object):
         get_block(10000000,0)
         get_block(20000000,1)
         get_block(30000000,2)
+    def _save_probes(self):
+        if self.probe_cache != None:
+            try:
+                with open(self.probe_cache, "w") as cachefile:
+                    json.dump(list(self.probes.items()), cachefile)
+            except Exception as ex:
+                self.log.error("Unable to write probe cache {path!r}: {err!r}",path=self.probe_cache,err=str(ex))
+    def _interpolate(self,on_found,trigger_time):
+        """Find the first block at or after trigger_time by extrapolating from the head block and refining by interpolation."""
+        target = datetime_to_epoch(trigger_time)
+        #Bracket the target between the highest known block before it and the lowest known block at or after it.
+        bracket = dict()
+        bracket["lower"] = None
+        bracket["upper"] = None
+        bracket["lib"] = 0
+        bracket["width"] = None  #Width of the bracket when the previous probe was picked.
+        def add_probe(blockno,timestamp):
+            if timestamp < target:
+                if bracket["lower"] == None or blockno > bracket["lower"][0]:
+                    bracket["lower"] = (blockno,timestamp)
+            else:
+                if bracket["upper"] == None or blockno < bracket["upper"][0]:
+                    bracket["upper"] = (blockno,timestamp)
+        def next_probe():
+            lower = bracket["lower"]
+            upper = bracket["upper"]
+            while True:
+                if upper[0] <= 1 or (lower != None and upper[0] - lower[0] <= 1):
+                    self._save_probes()
+                    self.log.info("Found block {block!r}",block=upper[0])
+                    on_found(upper[0])
+                    return
+                lowest = 1 if lower == None else lower[0] + 1
+                width = upper[0] - lowest
+                if bracket["width"] != None and width > bracket["width"] // 2:
+                    #The previous probe didn't halve the bracket, block times are skewed (for example by a chain halt), so bisect.
+                    guess = (lowest + upper[0]) // 2
+                elif lower == None or upper[1] == lower[1]:
+                    #Extrapolate back from the upper bound assuming no missed blocks.
+                    guess = upper[0] - (upper[1] - target + _BLOCK_INTERVAL - 1) // _BLOCK_INTERVAL
+                else:
+                    #Interpolate between our bounds, this accounts for missed blocks in between.
+                    guess = lower[0] + -((lower[1] - target) * (upper[0] - lower[0]) // (upper[1] - lower[1]))
+                guess = int(max(lowest, min(upper[0] - 1, guess)))
+                if guess in self.probes:
+                    #We looked at this block before, no need to ask the node again.
+                    add_probe(guess,self.probes[guess])
+                    lower = bracket["lower"]
+                    upper = bracket["upper"]
+                else:
+                    bracket["width"] = width
+                    get_header(guess)
+                    return
+        def get_header(blk):
+            def process_header(event,client):
+                try:
+                    if event == None or not "timestamp" in event:
+                        self.log.error("No timestamp for block {block!r}",block=blk)
+                        return
+                    timestamp = parse_timestamp(event["timestamp"])
+                    if blk <= bracket["lib"]:
+                        #Irreversible blocks never change, so they are safe to remember.
+                        self.probes[blk] = timestamp
+                        while len(self.probes) > self.probe_cache_size:
+                            self.probes.popitem(last=False)
+                    add_probe(blk,timestamp)
+                    self.log.info("Looking for block in range {rng!r}",rng=[bracket["lower"] and bracket["lower"][0],bracket["upper"][0]])
+                    next_probe()
+                except Exception as ex:
+                    self.log.failure("Error in DateFinder process_header {err!r}",err=str(ex))
+            def process_header_error(errno,msg,client):
+                if self.probe_method == "get_block_header":
+                    #Node doesn't do headers, fall back to full blocks.
+                    self.log.info("Falling back to get_block for date search: {err!r}",err=msg)
+                    self.probe_method = "get_block"
+                    get_header(blk)
+                else:
+                    self.log.error("Error looking up block {block!r}: {err!r}",block=blk,err=msg)
+            opp = getattr(self.rpc,self.probe_method)(blk)
+            opp.on_result(process_header)
+            opp.on_error(process_header_error)
+        def process_global_config(config_event,cclient):
+            try:
+                bracket["lib"] = config_event["last_irreversible_block_num"]
+                for blockno in self.probes:
+                    add_probe(blockno,self.probes[blockno])
+                head = config_event["head_block_number"]
+                head_time = parse_timestamp(config_event["time"])
+                if head_time < target:
+                    #Nothing to look for yet, the head block is the best we can do.
+                    on_found(head)
+                    return
+                add_probe(head,head_time)
+                next_probe()
+            except Exception as ex:
+                self.log.failure("Error in DateFinder process_global_config {err!r}",err=str(ex))
+        cmd = self.rpc.get_dynamic_global_properties()
+        cmd.on_result(process_global_config)
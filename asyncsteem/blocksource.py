@@ -0,0 +1,127 @@
+"""Local block archives, for replaying the blockchain without any API node."""
+import gzip
+import time
+from .codec import default_codec
+from .timestamps import parse_timestamp
+
+def _open(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+class ArchiveWriter(object):
+    """Writer for block archives: one [block number, block] JSON array per line, gzip compressed if the path ends in .gz."""
+    def __init__(self, path, codec=None):
+        """Constructor
+
+        Args:
+            path : File to write, appended to if it exists.
+            codec : Optional asyncsteem.codec.Codec, the fastest one installed by default.
+        """
+        self.path = path
+        self.codec = codec if codec != None else default_codec
+        self.file = _open(path, "ab")
+        self.count = 0
+    def write(self, blockno, blk):
+        """Append a block to the archive."""
+        self.file.write(self.codec.dumps([blockno, blk]) + b"\n")
+        self.count = self.count + 1
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+class ArchiveBlockSource(object):
+    """Block source reading an archive written by ArchiveWriter, in file order.
+
+    By default blocks are handed out as fast as the bots can take them. With a speed set, blocks are handed out
+    according to a simulated clock that runs speed times as fast as the wall clock, starting at the time of the
+    first block, so speed=1 replays the blockchain the way it happened.
+    """
+    def __init__(self, reactor, path, speed=None, chunk_size=100, pause_interval=0.05, codec=None):
+        """Constructor
+
+        Args:
+            reactor : The Twisted reactor.
+            path : Archive file to read.
+            speed : None to replay as fast as possible, or the number of blockchain seconds per wall clock second.
+            chunk_size : Number of blocks handed out before giving the reactor a chance to run other things.
+            pause_interval : Seconds to wait before trying again while the consumer is paused.
+            codec : Optional asyncsteem.codec.Codec, the fastest one installed by default.
+        """
+        self.reactor = reactor
+        self.path = path
+        self.speed = speed
+        self.chunk_size = chunk_size
+        self.pause_interval = pause_interval
+        self.codec = codec if codec != None else default_codec
+        self.file = None
+        self.next = None          #The next (block number, block) pair to hand out.
+        self.sim_start = None     #Timestamp of the first block handed out, in seconds since the epoch.
+        self.wall_start = None    #Wall clock time at which the first block was handed out.
+        self.last_time = None     #Timestamp of the last block handed out.
+        self.count = 0
+        self.on_block = None
+        self.on_done = None
+        self.paused = None
+    def now(self):
+        """Return the simulated current time in seconds since the epoch."""
+        if self.speed != None and self.wall_start != None:
+            return self.sim_start + (time.time() - self.wall_start) * self.speed
+        if self.last_time != None:
+            #As fast as possible, the clock is at the newest block.
+            return self.last_time
+        return time.time()
+    def start(self, on_block, on_done, paused=None, start_block=None, start_time=None):
+        """Start handing out blocks, in block number order.
+
+        Args:
+            on_block : Callable taking a block number and a block.
+            on_done : Callable without arguments, called after the last block.
+            paused : Optional callable returning True while no blocks should be handed out.
+            start_block : Skip blocks before this block number.
+            start_time : Skip blocks older than this, in seconds since the epoch.
+        """
+        self.on_block = on_block
+        self.on_done = on_done
+        self.paused = paused
+        self.file = _open(self.path, "rb")
+        #Skip ahead to the first block wanted.
+        self._read_next()
+        while self.next != None and ((start_block != None and self.next[0] < start_block) or
+                                     (start_time != None and parse_timestamp(self.next[1]["timestamp"]) < start_time)):
+            self._read_next()
+        self.reactor.callLater(0, self._run)
+    def _read_next(self):
+        """Read the next (block number, block) pair from the archive, None at the end."""
+        self.next = None
+        for line in self.file:
+            if line.strip():
+                blockno, blk = self.codec.loads(line)
+                self.next = (blockno, blk)
+                return
+    def _run(self):
+        """Hand out the next chunk of blocks, then schedule the next run."""
+        for index in range(0, self.chunk_size):
+            if self.next == None:
+                self.file.close()
+                self.on_done()
+                return
+            if self.paused != None and self.paused():
+                self.reactor.callLater(self.pause_interval, self._run)
+                return
+            blockno, blk = self.next
+            blktime = parse_timestamp(blk["timestamp"])
+            if self.speed != None:
+                if self.wall_start == None:
+                    self.sim_start = blktime
+                    self.wall_start = time.time()
+                delay = (blktime - self.now()) / self.speed
+                if delay > 0:
+                    #Not there yet on the simulated clock.
+                    self.reactor.callLater(delay, self._run)
+                    return
+            self.last_time = blktime
+            self.count = self.count + 1
+            self._read_next()
+            self.on_block(blockno, blk)
+        self.reactor.callLater(0, self._run)
@@ -0,0 +1,50 @@
+"""Durable checkpoints for resuming an ActiveBlockChain where it left off."""
+import os
+import json
+import time
+
+class Checkpoint(object):
+    """Class for durably recording the last fully processed block and optional per bot state."""
+    def __init__(self, path):
+        """Constructor
+
+        Args:
+            path : File to keep the checkpoint in.
+        """
+        self.path = path
+    def load(self):
+        """Return the stored checkpoint as a dict with 'block' and 'bots' keys, or None if there is none."""
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "r") as cpfile:
+            data = json.load(cpfile)
+        if not isinstance(data, dict) or not "block" in data:
+            return None
+        if not "bots" in data:
+            data["bots"] = dict()
+        return data
+    def save(self, block, bots=None):
+        """Atomically replace the stored checkpoint.
+
+        Args:
+            block : Highest block number for which it and all blocks before it have been processed.
+            bots  : Dict of JSON serializable state, keyed by bot name.
+        """
+        data = dict()
+        data["block"] = block
+        data["bots"] = bots if bots != None else dict()
+        data["time"] = int(time.time())
+        tmppath = self.path + ".tmp"
+        #Write to a temporary file and rename it over the old checkpoint, so a crash leaves either the old or the new one.
+        with open(tmppath, "w") as cpfile:
+            json.dump(data, cpfile)
+            cpfile.flush()
+            os.fsync(cpfile.fileno())
+        os.replace(tmppath, self.path)
+        dirpath = os.path.dirname(os.path.abspath(self.path))
+        if hasattr(os, "O_DIRECTORY"):
+            dirfd = os.open(dirpath, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
@@ -0,0 +1,63 @@
+"""JSON encoding and decoding for JSON-RPC traffic, using orjson or ujson if one is installed."""
+import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+def _available():
+    """Return the names of the installed backends, fastest first."""
+    result = list()
+    if orjson != None:
+        result.append("orjson")
+    if ujson != None:
+        result.append("ujson")
+    result.append("json")
+    return result
+
+class Codec(object):
+    """JSON codec that encodes straight to bytes and builds JSON-RPC request bodies from precomputed per method prefixes."""
+    def __init__(self, backend=None):
+        """Constructor
+
+        Args:
+            backend : "orjson", "ujson" or "json", or None for the fastest one installed.
+        """
+        if backend == None:
+            backend = _available()[0]
+        if not backend in _available():
+            raise ValueError("JSON backend %r is not installed" % backend)
+        self.backend = backend
+        if backend == "orjson":
+            self.dumps = orjson.dumps
+            self.loads = orjson.loads
+        elif backend == "ujson":
+            self.dumps = self._ujson_dumps
+            self.loads = ujson.loads
+        else:
+            self.dumps = self._json_dumps
+            self.loads = json.loads
+        self.prefixes = dict()   #Method name to the encoded start of a request for that method.
+    @staticmethod
+    def _json_dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
+    @staticmethod
+    def _ujson_dumps(obj):
+        return ujson.dumps(obj, escape_forward_slashes=False).encode()
+    def request(self, method, params, cmd_id):
+        """Return the encoded JSON-RPC request object for a single call."""
+        prefix = self.prefixes.get(method)
+        if prefix == None:
+            prefix = b'{"jsonrpc":"2.0","method":' + self.dumps(method) + b',"params":'
+            self.prefixes[method] = prefix
+        return b"".join((prefix, self.dumps(params), b',"id":', str(cmd_id).encode(), b"}"))
+    def batch(self, requests):
+        """Return the encoded JSON-RPC batch for a list of encoded requests."""
+        return b"[" + b",".join(requests) + b"]"
+
+#Codec using the fastest backend available, shared by default.
+default_codec = Codec()
@@ -0,0 +1,85 @@
+"""Priority lane command queue for the JSON-RPC client."""
+import time
+import collections
+
+class _Lane(object):
+    """Helper class holding a single priority lane and its statistics."""
+    def __init__(self, name):
+        self.name = name
+        self.entries = collections.deque()  #(command sequence number, time queued) pairs.
+        self.dequeued = 0                   #Number of commands taken from this lane.
+        self.total_wait = 0.0               #Summed queue wait time of the dequeued commands.
+        self.max_wait = 0.0                 #Longest queue wait time of a dequeued command.
+
+class CommandQueue(object):
+    """Queue of command sequence numbers with strict priority lanes and aging so lower lanes don't starve."""
+    def __init__(self, lanes=("stream", "normal", "bulk"), max_wait=5.0, aged_interval=4):
+        """Constructor
+
+        Args:
+            lanes : Lane names, highest priority first.
+            max_wait : Seconds after which commands of a lower priority lane start going ahead of higher lanes.
+            aged_interval : While a lower lane is starving, one of its commands goes ahead after every this many commands.
+        """
+        self.max_wait = max_wait
+        self.aged_interval = aged_interval
+        self.since_aged = 0            #Number of commands taken by strict priority since a starving lane was served.
+        self.lanes = collections.OrderedDict()
+        for name in lanes:
+            self.lanes[name] = _Lane(name)
+        self.size = 0
+    def push(self, cmd_id, lane):
+        """Add a command to the back of its lane."""
+        self.lanes[lane].entries.append((cmd_id, time.time()))
+        self.size = self.size + 1
+    def requeue(self, commands):
+        """Put (command sequence number, lane) pairs back at the front of their lanes, keeping their order."""
+        now = time.time()
+        for cmd_id, lane in reversed(commands):
+            self.lanes[lane].entries.appendleft((cmd_id, now))
+        self.size = self.size + len(commands)
+    def _next_lane(self, now):
+        """Pick the lane to take the next command from."""
+        first = None
+        for lane in self.lanes.values():
+            if lane.entries:
+                if first == None:
+                    first = lane
+                elif now - lane.entries[0][1] > self.max_wait and self.since_aged >= self.aged_interval:
+                    #This lane has waited long enough, let it go ahead once.
+                    self.since_aged = 0
+                    return lane
+        if first != None:
+            self.since_aged = self.since_aged + 1
+        return first
+    def pop(self, count):
+        """Take up to count command sequence numbers from the queue."""
+        now = time.time()
+        result = list()
+        while len(result) < count and self.size > 0:
+            lane = self._next_lane(now)
+            cmd_id, queued = lane.entries.popleft()
+            self.size = self.size - 1
+            wait = now - queued
+            lane.dequeued = lane.dequeued + 1
+            lane.total_wait = lane.total_wait + wait
+            if wait > lane.max_wait:
+                lane.max_wait = wait
+            result.append(cmd_id)
+        return result
+    def depth(self, lanes):
+        """Return the number of commands waiting in the given lanes."""
+        return sum(len(self.lanes[lane].entries) for lane in lanes if lane in self.lanes)
+    def stats(self):
+        """Return per lane depth and wait time statistics."""
+        now = time.time()
+        result = dict()
+        for lane in self.lanes.values():
+            result[lane.name] = {"depth" : len(lane.entries),
+                                 "oldest_wait" : (now - lane.entries[0][1]) if lane.entries else 0.0,
+                                 "dequeued" : lane.dequeued,
+                                 "average_wait" : (lane.total_wait / lane.dequeued) if lane.dequeued else 0.0,
+                                 "max_wait" : lane.max_wait}
+        return result
+    def __len__(self):
+        return self.size
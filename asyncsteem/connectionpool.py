@@ -0,0 +1,47 @@
+"""Persistent HTTP(S) connection pool for the JSON-RPC client, with usage statistics."""
+from twisted.web.client import HTTPConnectionPool
+
+class StatsConnectionPool(HTTPConnectionPool):
+    """HTTPConnectionPool that keeps count of opened, reused and dropped connections."""
+    def __init__(self, reactor, persistent=True, max_per_node=16, idle_timeout=60):
+        """Constructor
+
+        Args:
+            reactor : The Twisted reactor.
+            persistent : Keep connections open after a request so the next request to the same node can reuse them.
+            max_per_node : Maximum number of idle connections kept open per node.
+            idle_timeout : Seconds an idle connection is kept open before it is closed.
+        """
+        HTTPConnectionPool.__init__(self, reactor, persistent=persistent)
+        self.maxPersistentPerHost = max_per_node
+        self.cachedConnectionTimeout = idle_timeout
+        self.requests = 0   #Number of connections handed out for a request.
+        self.opened = 0     #Number of new connections set up, each one costs a TCP and TLS handshake.
+        self.dropped = 0    #Number of idle connections closed because of the idle timeout or the per node limit.
+    def getConnection(self, key, endpoint):
+        self.requests = self.requests + 1
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
+    def _newConnection(self, key, endpoint):
+        self.opened = self.opened + 1
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+    def _removeConnection(self, key, connection):
+        #Called when an idle connection times out.
+        self.dropped = self.dropped + 1
+        HTTPConnectionPool._removeConnection(self, key, connection)
+    def _putConnection(self, key, connection):
+        if len(self._connections.get(key, ())) >= self.maxPersistentPerHost:
+            #The pool drops the oldest idle connection to make room for this one.
+            self.dropped = self.dropped + 1
+        HTTPConnectionPool._putConnection(self, key, connection)
+    def stats(self):
+        """Return connection counters and the number of idle connections per node."""
+        idle = dict()
+        for key, connections in self._connections.items():
+            if connections:
+                #Keys are (scheme, host, port) tuples.
+                idle[key[1].decode() if isinstance(key[1], bytes) else str(key[1])] = len(connections)
+        return {"requests" : self.requests,
+                "opened" : self.opened,
+                "reused" : self.requests - self.opened,
+                "dropped" : self.dropped,
+                "idle" : idle}
@@ -0,0 +1,435 @@
+"""Dispatching of block, transaction and operation events to registered bots."""
+from .events import TransactionMeta, OperationEvent
+from .timestamps import parse_timestamp, epoch_to_datetime
+import copy
+import time
+from types import MappingProxyType
+from twisted.internet import defer
+from twisted.python.threadpool import ThreadPool
+from .quarantine import OffloadedBot
+
+#Events that aren't operations, these can't be filtered.
+_NON_OPERATION_EVENTS = set(["block", "transaction", "hour", "day", "week"])
+
+def _compile_filter(spec):
+    """Turn a filter spec into a list of (fields, values, predicate) clauses that all have to match.
+
+    A spec is either a callable taking the operation body, or a dict mapping a field name, or a tuple of field names of
+    which any may match, to a single value, a collection of values or a callable taking the field value.
+    """
+    if callable(spec):
+        return [(None, None, spec)]
+    clauses = list()
+    for fields, condition in spec.items():
+        if not isinstance(fields, tuple):
+            fields = (fields,)
+        if callable(condition):
+            clauses.append((fields, None, condition))
+        elif isinstance(condition, (list, tuple, set, frozenset)):
+            clauses.append((fields, frozenset(condition), None))
+        else:
+            clauses.append((fields, frozenset([condition]), None))
+    return clauses
+
+def _matches(clauses, body):
+    """Check an operation body against a list of compiled clauses."""
+    for fields, values, predicate in clauses:
+        if fields == None:
+            if not predicate(body):
+                return False
+            continue
+        for field in fields:
+            value = body.get(field)
+            try:
+                if (predicate(value) if values == None else value in values):
+                    break
+            except TypeError:
+                #Unhashable field value, or one the predicate can't handle.
+                pass
+        else:
+            return False
+    return True
+
+class _FilterIndex(object):
+    """Helper class holding the handlers for a single operation event, with the filtered ones indexed by field value."""
+    def __init__(self):
+        self.unfiltered = list()  #(order, botname, handler) for bots without a filter on this event.
+        self.fields = dict()      #Field name to dict of field value to list of (order, botname, handler, remaining clauses).
+        self.scan = list()        #(order, botname, handler, clauses) for filters without any value set to index on.
+    def add(self, order, botname, handler, clauses):
+        """Add a handler, indexing it on the first clause with a set of values."""
+        if clauses == None:
+            self.unfiltered.append((order, botname, handler))
+            return
+        for index in range(0, len(clauses)):
+            fields, values, predicate = clauses[index]
+            if values != None:
+                remaining = clauses[:index] + clauses[index+1:]
+                for field in fields:
+                    byvalue = self.fields.setdefault(field, dict())
+                    for value in values:
+                        byvalue.setdefault(value, list()).append((order, botname, handler, remaining))
+                return
+        self.scan.append((order, botname, handler, clauses))
+    def match(self, body):
+        """Return the (botname, handler) pairs that want an operation, in registration order."""
+        found = dict()
+        for field, byvalue in self.fields.items():
+            try:
+                candidates = byvalue.get(body.get(field))
+            except TypeError:
+                continue
+            if candidates:
+                for order, botname, handler, remaining in candidates:
+                    if not order in found and _matches(remaining, body):
+                        found[order] = (botname, handler)
+        for order, botname, handler, clauses in self.scan:
+            if _matches(clauses, body):
+                found[order] = (botname, handler)
+        if not found:
+            return tuple((botname, handler) for order, botname, handler in self.unfiltered)
+        for order, botname, handler in self.unfiltered:
+            found[order] = (botname, handler)
+        return tuple(found[order] for order in sorted(found))
+
+class _HandlerStats(object):
+    """Helper class holding the timing of a single (bot, event) handler."""
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0        #Cumulative wall time in seconds.
+        self.max = 0.0
+        self.over_budget = 0    #Number of calls that took longer than the handler budget.
+        self.streak = 0         #Number of calls in a row that took longer than the handler budget.
+
+class BlockDispatcher(object):
+    """Base class turning blocks into events for registered bots, without any knowledge of where the blocks come from."""
+    def __init__(self, log, zero_copy=False, profile_handlers=False, handler_budget=None, quarantine_after=None,
+                 quarantine_threads=4, reactor=None):
+        """Constructor
+
+        Args:
+            log : The Twisted asynchonous logger.
+            zero_copy : Hand bots read-only event objects that share block and transaction meta instead of per event dict copies.
+            profile_handlers : Record the number of calls and the cumulative and maximum wall time of each (bot, event) handler.
+            handler_budget : Seconds a single handler call may take, slower calls are logged. Implies profile_handlers.
+            quarantine_after : Number of calls in a row over budget after which the bot is quarantined. The handlers of a
+                               quarantined bot run in a thread pool, so they no longer hold back the other bots. Needs reactor.
+            quarantine_threads : Maximum number of threads for quarantined bots.
+            reactor : The Twisted reactor, needed for quarantining bots.
+        """
+        self.log = log
+        self.reactor = reactor
+        self.handlers = dict()      #Per bot name, the handlers of the events the bot is subscribed to.
+        self.dispatch = MappingProxyType(dict()) #Event name to tuple of (botname, handler) pairs, rebuilt on (un)registration.
+        self.hour_mark = None  #Hours since the epoch of the block that last triggered (or would have triggered) an hour event.
+        self.last_time = None  #Timestamp, in seconds since the epoch, of the newest block seen so far.
+        self.synced = False
+        self.eventtypes = set()
+        self.zero_copy = zero_copy
+        self.bots = dict()         #Registered bots by name.
+        self.await_bots = set()  #Names of the bots whose returned Deferreds are awaited before the next block is released.
+        self.awaiting = 0      #Number of returned Deferreds that haven't fired yet.
+        self.filters = dict()  #Per bot name, the compiled filters for the operation events the bot filters on.
+        self.filtered = MappingProxyType(dict()) #Operation event name to _FilterIndex, for events some bot filters on.
+        self.clock = time.time     #Current time, replaced by a simulated clock when replaying an archive.
+        self.metrics = None        #Optional asyncsteem.metrics.Metrics that handler times are reported to.
+        self.profile_handlers = profile_handlers or handler_budget != None
+        self.handler_budget = handler_budget
+        self.quarantine_after = quarantine_after
+        self.quarantine_threads = quarantine_threads
+        self.profile = dict()      #(botname, event) to _HandlerStats.
+        self.quarantined = dict()  #Name of each quarantined bot to the OffloadedBot running its handlers.
+        self.quarantine_pool = None #Thread pool for quarantined bots, started when the first bot gets quarantined.
+    def register_bot(self,bot,botname,await_deferreds=False,filters=None):
+        """Register a bot with the dispatcher.
+
+        Args:
+            bot: The bot object to register
+            botname: A unique name for this bot.
+            await_deferreds: If a handler of this bot returns a Deferred, hold back the next block untill it has fired.
+            filters: Optional dict mapping operation event names to a filter, the bot only gets the operations that match.
+                     A filter maps a field name to a value, a collection of values or a callable taking the field value.
+                     All fields have to match, use a tuple of field names as key to match any of those fields.
+                     A filter may also be a callable taking the operation body.
+                     For example {"vote" : {("voter","author") : ["alice","bob"], "weight" : lambda w: w < 0}}.
+        """
+        try:
+            self.bots[botname] = bot
+            if await_deferreds:
+                self.await_bots.add(botname)
+            else:
+                self.await_bots.discard(botname)
+            self.filters[botname] = dict()
+            if filters != None:
+                for event in filters:
+                    if event in _NON_OPERATION_EVENTS:
+                        self.log.error("Ignoring filter for non-operation event {op!r} of bot {bot!r}",op=event, bot=botname)
+                    else:
+                        self.filters[botname][event] = _compile_filter(filters[event])
+            #Each method of the object not starting with an underscore is a handler of operation events
+            handlers = dict()
+            for key in dir(bot):
+                if key[0] != "_":
+                    handler = getattr(bot,key)
+                    if callable(handler):
+                        handlers[key] = handler
+            self.handlers[botname] = handlers
+            self._rebuild_dispatch()
+        except Exception as ex:
+            self.log.failure("Error in BlockDispatcher::register_bot : {err!r}",err=str(ex))
+    def unregister_bot(self,botname):
+        """Remove a previously registered bot from the dispatcher.
+
+        Args:
+            botname: The name the bot was registered with.
+        """
+        try:
+            if botname in self.bots:
+                del self.bots[botname]
+                del self.handlers[botname]
+                del self.filters[botname]
+                self.quarantined.pop(botname, None)
+                self.await_bots.discard(botname)
+                self._rebuild_dispatch()
+            else:
+                self.log.error("Can't unregister unknown bot {bot!r}",bot=botname)
+        except Exception as ex:
+            self.log.failure("Error in BlockDispatcher::unregister_bot : {err!r}",err=str(ex))
+    def _rebuild_dispatch(self):
+        """Rebuild the read-only event name to (botname, handler) tuple dispatch table and the filter indexes."""
+        table = dict()
+        filtered = set()
+        for botname in self.filters:
+            filtered.update(event for event in self.filters[botname] if event in self.handlers[botname])
+        indexes = dict((event,_FilterIndex()) for event in filtered)
+        order = 0
+        for botname in self.handlers:
+            for event in self.handlers[botname]:
+                order = order + 1
+                if event in indexes:
+                    #Some bot filters this event, all its handlers go in the index.
+                    indexes[event].add(order,botname,self.handlers[botname][event],self.filters[botname].get(event))
+                    continue
+                if not event in table:
+                    table[event] = list()
+                table[event].append((botname,self.handlers[botname][event]))
+        self.dispatch = MappingProxyType(dict((event,tuple(table[event])) for event in table))
+        self.filtered = MappingProxyType(indexes)
+    def _await(self,botname,event,deferred):
+        """Hold back the next block untill a Deferred returned by a handler has fired."""
+        self.awaiting = self.awaiting + 1
+        def handler_failed(failure):
+            self.log.failure("Error in bot '{bot!r}' processing '{op!r}' event.",failure,bot=botname, op=event)
+        def fired(result):
+            self.awaiting = self.awaiting - 1
+            self._drain()
+        deferred.addErrback(handler_failed)
+        deferred.addBoth(fired)
+    def _drain(self):
+        """Hand out the blocks held back while a returned Deferred was outstanding, implemented by subclasses."""
+        pass
+    def _invoke(self,handlers,event,ts,obj):
+        """Invoke the given (botname, handler) pairs for a single event."""
+        timed = self.metrics != None or self.profile_handlers
+        quarantined = self.quarantined
+        for botname, handler in handlers:
+            try:
+                if quarantined and botname in quarantined:
+                    #Let the thread pool deal with this one.
+                    quarantined[botname].handle(event,handler,ts,obj)
+                    continue
+                if timed:
+                    start = time.time()
+                    result = handler(ts,obj,self.rpc)
+                    self._handler_timed(botname,event,time.time() - start)
+                else:
+                    result = handler(ts,obj,self.rpc)
+                if isinstance(result,defer.Deferred) and botname in self.await_bots:
+                    self._await(botname,event,result)
+            except Exception as e:
+                self.log.failure("Error in bot '{bot!r}' processing '{op!r}' event.",bot=botname, op=event)
+    def _handler_timed(self,botname,event,elapsed):
+        """Record the wall time of a handler call, log calls over budget and quarantine persistently slow bots."""
+        if self.metrics != None:
+            self.metrics.observe("handler_seconds",elapsed,{"bot" : botname, "event" : event})
+        if not self.profile_handlers:
+            return
+        key = (botname,event)
+        stats = self.profile.get(key)
+        if stats == None:
+            stats = _HandlerStats()
+            self.profile[key] = stats
+        stats.calls = stats.calls + 1
+        stats.total = stats.total + elapsed
+        if elapsed > stats.max:
+            stats.max = elapsed
+        if self.handler_budget == None:
+            return
+        if elapsed <= self.handler_budget:
+            stats.streak = 0
+            return
+        stats.over_budget = stats.over_budget + 1
+        stats.streak = stats.streak + 1
+        if stats.over_budget == 1 or stats.over_budget % 100 == 0:
+            #Don't flood the log with a handler that is always slow.
+            self.log.warn("Bot {bot!r} took {ms!r} ms for a {op!r} event, over its {budget!r} ms budget ({count!r} times so far).",
+                          bot=botname, op=event, ms=int(elapsed * 1000), budget=int(self.handler_budget * 1000), count=stats.over_budget)
+        if self.quarantine_after != None and stats.streak >= self.quarantine_after and self.reactor != None:
+            self.quarantine_bot(botname)
+    def quarantine_bot(self,botname):
+        """Run the handlers of a bot in a thread pool from now on, so it no longer holds back the other bots.
+
+        The handlers of a quarantined bot still run one at a time and in order, with a client that can be used from a thread.
+        Deferreds returned by its handlers are no longer awaited.
+        """
+        try:
+            if botname in self.quarantined or not botname in self.bots:
+                return
+            if self.quarantine_pool == None:
+                self.quarantine_pool = ThreadPool(0, self.quarantine_threads, "asyncsteem-quarantine")
+                self.quarantine_pool.start()
+                self.reactor.addSystemEventTrigger("during", "shutdown", self.quarantine_pool.stop)
+            self.log.error("Quarantining bot {bot!r}, its handlers will run in a thread pool.",bot=botname)
+            def on_timed(event,elapsed):
+                self._handler_timed(botname,event,elapsed)
+            self.quarantined[botname] = OffloadedBot(self.reactor,self.quarantine_pool,self.rpc,botname,self.log,on_timed)
+        except Exception as ex:
+            self.log.failure("Error in BlockDispatcher::quarantine_bot : {err!r}",err=str(ex))
+    def quarantine_backlog(self):
+        """Return the largest number of blocks a quarantined bot has not finished handling."""
+        if not self.quarantined:
+            return 0
+        return max(offloaded.blocks for offloaded in self.quarantined.values())
+    def handler_profile(self):
+        """Return the handler timings as a dict of bot name to a dict of event name to calls, total, mean and max
+        wall time in seconds and the number of calls over budget."""
+        result = dict()
+        for (botname, event), stats in self.profile.items():
+            result.setdefault(botname, dict())[event] = {"calls" : stats.calls,
+                                                         "total" : stats.total,
+                                                         "mean" : stats.total / stats.calls if stats.calls else 0.0,
+                                                         "max" : stats.max,
+                                                         "over_budget" : stats.over_budget,
+                                                         "quarantined" : botname in self.quarantined}
+        return result
+    def _transaction_meta(self,blk_meta,transaction,txid):
+        """Build the transaction meta handed to transaction and operation handlers."""
+        if self.zero_copy:
+            #A view on the transaction, nothing gets copied.
+            return TransactionMeta(blk_meta,transaction,txid)
+        transaction_meta = dict()
+        #Start off transaction meta with our block level meta.
+        transaction_meta["block_meta"] = copy.copy(blk_meta)
+        #Copy the transaction id
+        if txid != None:
+            transaction_meta["id"] = txid
+        #And copy some relevant transaction meta
+        for k in ["ref_block_prefix","ref_block_num","expiration"]:
+            if k in transaction:
+                transaction_meta[k] = transaction[k]
+        return transaction_meta
+    #The __call__ method is to be called only by the jsonrpc client!
+    def _process_block(self,blk):
+        try:
+            dispatch = self.dispatch
+            if blk != None and "timestamp" in blk:
+                ts = blk["timestamp"]
+                blktime = None
+                try:
+                    #Parse the time from the block
+                    blktime = parse_timestamp(ts)
+                except:
+                    pass
+                if blktime !=None:
+                    #If this is a valid block with a valid time, check if we are synced yet
+                    if self.last_time == None or self.last_time < blktime:
+                        self.last_time = blktime
+                        #We consider ourselves synced if we are behind no more than two minutes
+                        if self.synced == False and self.clock() - self.last_time < 120:
+                            self.synced  = True
+                    hour = blktime // 3600
+                    if self.hour_mark == None:
+                        self.hour_mark = hour
+                    elif hour > self.hour_mark:
+                        #Hour event
+                        self.hour_mark = hour
+                        ddt = epoch_to_datetime(hour * 3600)
+                        obj = dict()
+                        obj["year"] = ddt.year
+                        obj["month"] = ddt.month
+                        obj["day"] = ddt.day
+                        obj["weekday"] = ddt.weekday()
+                        obj["hour"] = ddt.hour
+                        if "hour" in dispatch:
+                            #Invoke hour event on all bots that implement the hour method
+                            self._invoke(dispatch["hour"],"hour",ts,obj)
+                        if ddt.hour == 0 and "day" in dispatch:
+                            #Invoke day event on all bots that implement the day method
+                            self._invoke(dispatch["day"],"day",ts,obj)
+                        if ddt.hour == 0 and obj["weekday"] == 0 and "week" in dispatch:
+                            #Invoke week event on all bots that implement the week method
+                            self._invoke(dispatch["week"],"week",ts,obj)
+                blk_meta = dict()
+                #Copy relevant keys to block level meta.
+                for k in ["witness_signature",
+                          "block_id",
+                          "signing_key",
+                          "transaction_merkle_root",
+                          "witness","previous"]:
+                    if k in blk:
+                        blk_meta[k] = blk[k]
+                if self.zero_copy:
+                    #Share a single read-only block meta between all events of this block.
+                    blk_meta = MappingProxyType(blk_meta)
+                if "block" in dispatch:
+                    #Invoke block event  on all bots that implement the block method
+                    self._invoke(dispatch["block"],"block",ts,blk_meta)
+                if "transactions" in blk and isinstance(blk["transactions"],list):
+                    filtered = self.filtered
+                    for index in range(0,len(blk["transactions"])):
+                        transaction = blk["transactions"][index]
+                        txid = None
+                        if "transaction_ids" in blk and isinstance(blk["transaction_ids"],list) and len(blk["transaction_ids"]) > index:
+                            txid = blk["transaction_ids"][index]
+                        #Transaction meta is only built once some bot needs it.
+                        transaction_meta = None
+                        if "transaction" in dispatch:
+                            #Invoke transaction event  on all bots that implement the transaction method
+                            transaction_meta = self._transaction_meta(blk_meta,transaction,txid)
+                            self._invoke(dispatch["transaction"],"transaction",ts,transaction_meta)
+                        if "operations" in transaction and isinstance(transaction["operations"],list):
+                            for oindex in range(0,len(transaction["operations"])):
+                                #Get the name of the operation.
+                                operation = transaction["operations"][oindex]
+                                handlers = dispatch.get(operation[0])
+                                filter_index = filtered.get(operation[0]) if filtered else None
+                                if handlers == None and filter_index == None:
+                                    #Do some logging of unimplemented methods on first occurance.
+                                    if not operation[0] in self.eventtypes:
+                                        self.eventtypes.add(operation[0])
+                                        self.log.info("Received an operation not implemented by any bot: {op!r}",op=operation[0])
+                                    continue
+                                if isinstance(operation,list) and \
+                                   len(operation) == 2 and \
+                                   isinstance(operation[1],dict):
+                                    if filter_index != None:
+                                        #Only the bots whose filters match, checked before anything gets copied.
+                                        handlers = filter_index.match(operation[1])
+                                        if not handlers:
+                                            continue
+                                    if transaction_meta == None:
+                                        transaction_meta = self._transaction_meta(blk_meta,transaction,txid)
+                                    if self.zero_copy:
+                                        op = OperationEvent(operation[1],oindex,transaction_meta)
+                                    else:
+                                        #Start off with operation meta copied from the operation.
+                                        op = copy.copy(operation[1])
+                                        op["operation_no"] = oindex
+                                        #Copy in thansaction (and block) level meta.
+                                        op["transaction_meta"] = copy.copy(transaction_meta)
+                                    #Invoke specific operation event  on all bots that implement the specific operation method
+                                    self._invoke(handlers,operation[0],ts,op)
+                for offloaded in self.quarantined.values():
+                    offloaded.end_block()
+        except Exception as ex:
+            self.log.failure("Error in BlockDispatcher::_process_block : {err!r}",err=str(ex))
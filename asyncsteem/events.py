@@ -0,0 +1,76 @@
+"""Read-only event objects that share block and transaction data by reference instead of copying it."""
+from collections.abc import Mapping
+
+class TransactionMeta(Mapping):
+    """Read-only dict-like view of the meta data of a transaction."""
+    __slots__ = ("block_meta", "transaction", "txid")
+    _KEYS = ("ref_block_prefix", "ref_block_num", "expiration")
+    def __init__(self, block_meta, transaction, txid):
+        """Constructor
+
+        Args:
+            block_meta : Read-only block level meta, shared by all transactions in the block.
+            transaction : The transaction from the block, not copied.
+            txid : The transaction id or None if the block has none for it.
+        """
+        self.block_meta = block_meta
+        self.transaction = transaction
+        self.txid = txid
+    def __getitem__(self, key):
+        if key == "block_meta":
+            return self.block_meta
+        if key == "id" and self.txid != None:
+            return self.txid
+        if key in self._KEYS and key in self.transaction:
+            return self.transaction[key]
+        raise KeyError(key)
+    def __iter__(self):
+        yield "block_meta"
+        if self.txid != None:
+            yield "id"
+        for key in self._KEYS:
+            if key in self.transaction:
+                yield key
+    def __len__(self):
+        return sum(1 for key in self)
+    def __repr__(self):
+        return repr(dict(self))
+
+class OperationEvent(Mapping):
+    """Read-only dict-like view of an operation, with its operation_no and transaction_meta keys added."""
+    __slots__ = ("body", "operation_no", "transaction_meta")
+    def __init__(self, body, operation_no, transaction_meta):
+        """Constructor
+
+        Args:
+            body : The operation dict from the block, not copied.
+            operation_no : Index of the operation within its transaction.
+            transaction_meta : TransactionMeta shared by all operations of the transaction.
+        """
+        self.body = body
+        self.operation_no = operation_no
+        self.transaction_meta = transaction_meta
+    def __getitem__(self, key):
+        if key == "operation_no":
+            return self.operation_no
+        if key == "transaction_meta":
+            return self.transaction_meta
+        return self.body[key]
+    def __contains__(self, key):
+        return key == "operation_no" or key == "transaction_meta" or key in self.body
+    def get(self, key, default=None):
+        if key == "operation_no":
+            return self.operation_no
+        if key == "transaction_meta":
+            return self.transaction_meta
+        return self.body.get(key, default)
+    def __iter__(self):
+        for key in self.body:
+            if key != "operation_no" and key != "transaction_meta":
+                yield key
+        yield "operation_no"
+        yield "transaction_meta"
+    def __len__(self):
+        return sum(1 for key in self)
+    def __repr__(self):
+        return repr(dict(self))
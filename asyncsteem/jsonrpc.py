@@ -1,12 +1,40 @@
 """Version of the JSON-RPC library that should work as soon as full-API nodes start implementing the actual JSON-RPC specification"""
 import time
-import json
+import copy
+import collections
 from . import nodesets
+from .timestamps import parse_timestamp
+from .nodescheduler import NodeScheduler
+from .commandqueue import CommandQueue
+from .rpccache import IRREVERSIBLE_AGE
+from .connectionpool import StatsConnectionPool
+from .jsonstream import read_json, StreamedArray, ResponseTooLarge
+from .codec import Codec, default_codec
 from io import BytesIO
-from twisted.web.client import Agent, readBody, FileBodyProducer
+from twisted.web.client import Agent, readBody, FileBodyProducer, BrowserLikePolicyForHTTPS, HostnameCachingHTTPSPolicy
 from twisted.web.http_headers import Headers
 from twisted.internet import defer
 
+#Methods used for streaming blocks, these go ahead of other commands in the command queue.
+_STREAM_LANE_METHODS = {"get_block" : "stream",
+                        "get_block_header" : "stream",
+                        "get_dynamic_global_properties" : "stream",
+                        "call" : "stream"}
+
+#List taking methods that may be merged by the aggregator. True for methods that answer positionally, with null for
+#names that don't exist, False for methods that leave out missing names and return objects with a "name" field.
+_AGGREGATE_METHODS = {"get_accounts" : False,
+                      "lookup_account_names" : True}
+
+def _is_read_only(name, args):
+    """Check if a call only reads chain state, so its result may be shared or cached."""
+    if name == "call":
+        return len(args) > 1 and isinstance(args[1], str) and (args[1].startswith("get_") or args[1].startswith("lookup_"))
+    return name.startswith("get_") or name.startswith("lookup_")
+
+#Argument types that can go into a coalescing and result cache key as they are.
+_SCALARS = (str, int, float, bool, type(None))
+
 #This class holds a queued JSON-RPC command and also holds references to it's callbacks
 class _QueueEntry(object):
     """Helper class for managing in-queue JSON-RPC command invocations"""
@@ -18,22 +46,29 @@ class _QueueEntry(object):
         self.result_callback = None    #Callback for the result, defaults to None
         self.error_callback = None     #Callback for error results, defaults to None
         self.log = log                 #The asynchonous logger
+        self.lane = "normal"           #The priority lane of the command queue this command goes in.
+        self.cache_key = None          #Key for coalescing and result caching, None for calls that aren't read-only.
+        self.followers = list()        #Identical calls that share the result of this one.
+        self.single = False            #Send in a batch of its own, set once a batch holding it got a too large response.
     def on_result(self, callback):
         """Set the on_result callback"""
         self.result_callback = callback
     def on_error(self, callback):
         """Set the on_error callback"""
         self.error_callback = callback
-    def _get_rpc_call_object(self):
-        """Return a partial JSON-RPC structure for this object."""
-        callobj = dict()
-        callobj["jsonrpc"] = "2.0"
-        callobj["method"] = self.command
-        callobj["id"] = self.cmd_id
-        callobj["params"] = self.arguments
-        return callobj
+    def _get_rpc_call_bytes(self, codec):
+        """Return this call as an encoded JSON-RPC request object."""
+        return codec.request(self.command, self.arguments, self.cmd_id)
+    def _take_followers(self):
+        """Return the followers and detach them, so calls made from the callbacks never join this one."""
+        followers = self.followers
+        self.followers = list()
+        return followers
     def _handle_result(self, result):
         """Call the supplied user result handler or act as default result handler."""
+        followers = self._take_followers()
+        #Identical calls that shared this one each get a copy of their own, so changes made by one caller stay local.
+        copies = [copy.deepcopy(result) for follower in followers]
         if self.result_callback != None:
             #Call the result callback but expect failure.
             try:
@@ -42,18 +77,22 @@ class _QueueEntry(object):
                 self.log.failure("Error in result handler for '{cmd!r}'.",cmd=self.command)
         else:
             #If no handler is set, all we do is log.
-            self.logg.error("Error: no on_result defined for '{cmd!r}' command result: {res!r}.",cmd=self.command,res=result)
+            self.log.error("Error: no on_result defined for '{cmd!r}' command result: {res!r}.",cmd=self.command,res=result)
+        for follower, own in zip(followers, copies):
+            follower._handle_result(own)
     def _handle_error(self, errno, msg):
         """Call the supplied user error handler or act as default error handler."""
         if self.error_callback != None:
             #Call the error callback but expect failure.
             try:
-                self.error_callback(errno, msg, rpcclient)
+                self.error_callback(errno, msg, self.rpcclient)
             except Exception as ex:
                 self.log.failure("Error in error handler for '{cmd!r}'.",cmd=self.command)
         else:
             #If no handler is set, all we do is log.
-            self.log.err("Notice: no on_error defined for '{cmd!r}, command result: {msg!r}",cmd=self.command,msg=msg)
+            self.log.error("Notice: no on_error defined for '{cmd!r}, command result: {msg!r}",cmd=self.command,msg=msg)
+        for follower in self._take_followers():
+            follower._handle_error(errno, msg)
 
 
 class RpcClient(object):
@@ -67,19 +106,75 @@ class RpcClient(object):
                                            # with a max_batch_size of 16
                  parallel=16,              #Maximum number of paralel outstanding HTTPS JSON-RPC at any point in time.
                  rpc_timeout=15,           #Timeout for a single HTTPS JSON-RPC query.
-                 stop_when_empty= False):  #Stop the reactor then the command queue is empty.
+                 stop_when_empty= False,   #Stop the reactor then the command queue is empty.
+                 block_cache=None,         #Optional BlockCache to consult before fetching blocks from the network.
+                 node_selection="roundrobin", #Either "roundrobin" or "scored".
+                 probe_interval=30,        #Seconds between health probes of all nodes in "scored" node selection mode.
+                 hedge_percentile=None,    #If set, resend batches slower than this latency percentile to a second node.
+                 hedge_min_samples=20,     #Number of latency measurements needed before hedging starts.
+                 adaptive_batching=False,  #Detect batch support and tune the batch size per node.
+                 lane_methods=None,        #Dict mapping method names to priority lanes.
+                 queue_max_wait=5.0,       #Seconds after which lower priority lanes go ahead once.
+                 coalesce=False,           #Let identical in-flight read-only calls share a single network call.
+                 result_cache=None,        #Optional ResultCache for read-only call results.
+                 aggregate_window=None,    #If set, merge get_accounts style lookups made within this many seconds.
+                 aggregate_limit=100,      #Maximum number of unique names in a single merged lookup.
+                 persistent=True,          #Keep HTTPS connections to the nodes open between requests.
+                 max_connections_per_node=None, #Maximum number of idle connections kept open per node, defaults to parallel.
+                 idle_timeout=60,          #Seconds an idle connection is kept open.
+                 streaming_decode=False,   #Process batch replies while the response body is still coming in.
+                 max_response_size=None,   #Maximum size in bytes of a streamed response body.
+                 json_backend=None,        #"orjson", "ujson" or "json", None for the fastest one installed.
+                 metrics=None):            #Optional asyncsteem.metrics.Metrics to report to.
         """Constructor for asynchonour JSON-RPC client.
 
         Args:
                 areactor : The Twisted reactor
                 log      : The Twisted asynchonous logger
                 nodes    : List of API nodes, you normally should NOT use this, if you use this variable, also use max_batch_size!
+                           Nodes are host names reached over HTTPS, or full URLs such as "http://127.0.0.1:8765" for a local asyncsteem.mocknode.
                 max_batch_size : The max batch size to use for JSON-RPC batched calls. Only use with nodes that support batched RPC calls!
                 nodelist : Name of the nodelist to use. "default" and "stage" are currently valid values for this field.
                 parallel : Maximum number of paralel outstanding HTTPS JSON-RPC at any point in time.
                 rpc_timeout : Timeout (in seconds) for a single HTTPS JSON-RPC query.
                 stop_when_empty : Boolean indicating if reactor should be stopped when the command queue is empty and no active HTTPS
                                   sessions remain.
+                block_cache : Optional asyncsteem.blockcache.BlockCache, get_block is served from it when possible and
+                              irreversible blocks fetched from the network are added to it.
+                node_selection : "roundrobin" sticks to one node and moves on to the next on errors. "scored" sends each batch
+                                 to the best node by latency, error rate, head block lag and outstanding requests.
+                probe_interval : Seconds between health probes of all nodes in "scored" mode, these bring recovered nodes back.
+                hedge_percentile : If set (for example 0.95), a batch that has not been answered within this percentile of
+                                   recently observed latencies is sent to a second node as well. The first valid response
+                                   wins, the other request is cancelled.
+                hedge_min_samples : Number of latency measurements needed before hedging starts.
+                adaptive_batching : Find out per node if JSON-RPC batches are supported, and grow or shrink the batch size
+                                    per node based on response time, response size and errors. An explicit max_batch_size
+                                    is used as upper limit, 64 otherwise.
+                lane_methods : Dict mapping method names to one of the "stream", "normal" or "bulk" priority lanes. Commands
+                               in higher lanes are sent first. Block fetching methods default to "stream", others to "normal".
+                queue_max_wait : Seconds after which the oldest command of a lower priority lane goes ahead of higher lanes,
+                                 so bot queries keep making progress while blocks are streamed.
+                coalesce : Identical read-only calls (same method and arguments) made while one is in flight share its result.
+                result_cache : Optional asyncsteem.rpccache.ResultCache, read-only calls are answered from it when possible.
+                aggregate_window : If set, get_accounts and lookup_account_names calls with a single list of names made
+                                   within this many seconds are merged into one call with the unique names, and the result
+                                   is split up again for each caller.
+                aggregate_limit : A merged call is sent as soon as it holds this many unique names.
+                persistent : Keep HTTPS connections open after a request, so later requests to the same node skip the TCP
+                             and TLS handshakes. TLS settings are cached per node so TLS sessions can be resumed as well.
+                max_connections_per_node : Maximum number of idle connections kept open per node, defaults to parallel.
+                idle_timeout : Seconds an idle connection is kept open before it is closed.
+                streaming_decode : Decode batch responses while they are received and process each reply as soon as it is
+                                   complete, instead of reading and decoding the whole body first. If the POST fails half way,
+                                   only the commands without a processed reply are sent again.
+                max_response_size : With streaming_decode, the maximum size of a response body in bytes. Reading larger
+                                    bodies is stopped and the commands without a processed reply are sent again, each in
+                                    a batch of its own. A single command with a too large reply fails with error -1.
+                json_backend : JSON library used for requests and responses, "orjson", "ujson" or "json". By default the
+                               fastest one installed is used.
+                metrics : Optional asyncsteem.metrics.Metrics, or an object with the same interface, to report call counts,
+                          latencies, batch sizes, errors, node rotations and queue depths to.
         """
         self.reactor = areactor
         self.log = log
@@ -93,19 +188,125 @@ class RpcClient(object):
             self.max_batch_size = nodesets.nodeset[nodelist]["max_batch_size"]
         if max_batch_size != None:
             self.max_batch_size = max_batch_size
+        self.adaptive_batching = adaptive_batching
         self.parallel = parallel
         self.rpc_timeout = rpc_timeout
         self.node_index = 0            #Start of with the first JSON-RPC node in the node list.
-        self.agent = Agent(areactor)   #HTTP(s) Agent
+        #Connection pool shared by all requests, with counters for opened, reused and dropped connections.
+        self.pool = StatsConnectionPool(areactor,
+                                        persistent=persistent,
+                                        max_per_node=max_connections_per_node if max_connections_per_node != None else parallel,
+                                        idle_timeout=idle_timeout)
+        #HTTP(s) Agent, reusing the TLS settings for a node keeps its TLS session cache around.
+        self.agent = Agent(areactor, contextFactory=HostnameCachingHTTPSPolicy(BrowserLikePolicyForHTTPS()), pool=self.pool)
+        self.persistent = persistent
+        self.shutting_down = False     #Set on reactor shutdown, POSTs aborted from then on are not errors.
+        areactor.addSystemEventTrigger("before", "shutdown", self._shutdown)
         self.cmd_seq = 0               #Unique sequence number used for commands in the command queue.
         self.last_rotate = 0           #Errors may come in batches, we keep track of the last rotate to an other node to avoid responding to
                                        #errors from previois nodes.
         self.errorcount = 0            #The number of errors seen since the previous node rotation.
         self.entries = dict()          #Here the actual commands from the command queue are stored, keyed by sequence number.
-        self.queue = list()            #The actual command queue is just a list of sequence numbers.
+        self.queue = CommandQueue(max_wait=queue_max_wait)  #The actual command queue holds sequence numbers in priority lanes.
+        self.coalesce = coalesce
+        self.result_cache = result_cache
+        self.inflight = dict()         #Read-only calls in flight, keyed by method and arguments, see _cache_key.
+        self.coalesced_count = 0       #Number of calls that shared an identical in-flight call.
+        self.codec = Codec(json_backend) if json_backend != None else default_codec
+        self.streaming_decode = streaming_decode
+        self.max_response_size = max_response_size
+        self.aggregate_window = aggregate_window
+        self.aggregate_limit = aggregate_limit
+        self.aggregates = dict()       #Lookups waiting to be merged, keyed by method name.
+        self.aggregated_count = 0      #Number of calls that were merged into an other call.
+        self.lane_methods = dict(_STREAM_LANE_METHODS)
+        if lane_methods != None:
+            self.lane_methods.update(lane_methods)
         self.active_call_count = 0     #The current number of active HTTPS POST calls.
         self.stop_when_empty = stop_when_empty
+        self.block_cache = block_cache
+        self.pending_local = 0         #Number of results served locally that have not been handed to their callbacks yet.
+        self.last_irreversible_block = 0  #Last irreversible block number as seen in get_dynamic_global_properties results.
+        self.node_selection = node_selection
+        self.probe_interval = probe_interval
+        #Per node latency, health and batch size statistics.
+        self.scheduler = NodeScheduler(self.nodes,
+                                       max_batch_size=max_batch_size if max_batch_size != None else 64,
+                                       target_latency=rpc_timeout / 5.0)
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.latencies = collections.deque(maxlen=256)  #Recent batch latencies, used for picking the hedge delay.
+        self.hedge_count = 0           #Number of hedged requests sent.
+        self.requeue_count = 0         #Number of batches added back to the queue after failing.
+        self.metrics = metrics
+        if metrics != None:
+            metrics.add_collector(self._collect_metrics)
+        if node_selection == "scored":
+            self.reactor.callLater(0, self._probe_nodes)
         self.log.info("Starting off with node {node!r}.",node = self.nodes[self.node_index])
+    def _shutdown(self):
+        """Stop treating failed POSTs as node errors, and close idle connections cleanly."""
+        self.shutting_down = True
+        if self.persistent:
+            return self.pool.closeCachedConnections()
+    def _select_node(self):
+        """Pick the node to send the next batch to."""
+        if self.node_selection == "scored":
+            return self.scheduler.select()
+        return self.nodes[self.node_index]
+    def _node_failed(self, node, reason):
+        """Register an error for a node."""
+        if self.metrics != None:
+            self.metrics.inc("rpc_node_errors_total", labels={"node" : node})
+        if self.node_selection == "scored":
+            if self.scheduler.failed(node):
+                self.log.error("Taking {node!r} out of rotation due to error : {reason!r}",node=node, reason=reason)
+                if self.metrics != None:
+                    self.metrics.inc("rpc_node_rotations_total")
+        else:
+            self.scheduler.failed(node)
+            self._next_node(reason)
+    def _post(self, node, body):
+        """Start a single HTTPS POST of a JSON-RPC body to a node."""
+        if "://" in node:
+            #A full URL, for example the http:// address of a local mock node.
+            url = node
+        else:
+            url = "https://" + node + "/"
+        url = str.encode(str(url))
+        return self.agent.request(b'POST',
+                                  url,
+                                  Headers({"User-Agent"  : ['Async Steem for Python v0.6.1'],
+                                           "Content-Type": ["application/json"]}),
+                                  FileBodyProducer(BytesIO(body)))
+    def _probe_nodes(self):
+        """Ask every node for its head block, bringing recovered nodes back into rotation."""
+        def probe(node):
+            start = time.time()
+            deferred = self._post(node, self.codec.request("get_dynamic_global_properties", [], 0))
+            timeoutCall = self.reactor.callLater(self.rpc_timeout, deferred.cancel)
+            def process_probe(body):
+                if timeoutCall.active():
+                    timeoutCall.cancel()
+                result = self.codec.loads(body)["result"]
+                self.scheduler.report_head(node, result["head_block_number"])
+                self.scheduler.measured(node, time.time() - start)
+                if self.scheduler.is_down(node):
+                    self.log.info("Node {node!r} is healthy again, putting it back into rotation.",node=node)
+                    self.scheduler.revive(node)
+            def probe_failed(error):
+                if timeoutCall.active():
+                    timeoutCall.cancel()
+                self.scheduler.failed(node, in_flight=False)
+            deferred.addCallback(readBody)
+            deferred.addCallback(process_probe)
+            deferred.addErrback(probe_failed)
+        try:
+            for node in self.nodes:
+                probe(node)
+        except Exception as ex:
+            self.log.failure("Error in _probe_nodes {err!r}",err=str(ex))
+        self.reactor.callLater(self.probe_interval, self._probe_nodes)
     def _next_node(self, reason):
         #We may have reason to move on to the next node, check how long ago we did so before and how many errors we have seen since.
         now = time.time()
@@ -115,6 +316,8 @@ class RpcClient(object):
         # paralel HTTPS requests in errors, then it will be OK to rotate once more.
         if ago > (self.rpc_timeout + 2) or self.errorcount > (self.parallel + 1) :
             self.log.error("Switching from {oldnode!r} to an other node due to error : {reason!r}",oldnode=self.nodes[self.node_index], reason=reason)
+            if self.metrics != None:
+                self.metrics.inc("rpc_node_rotations_total")
             self.last_rotate = now
             self.node_index = (self.node_index + 1) % len(self.nodes)
             self.errorcount = 0
@@ -124,51 +327,116 @@ class RpcClient(object):
         dv = None
         #Push as many queued calls as the self.max_batch_size and the max number of paralel HTTPS sessions allow for.
         while self.active_call_count < self.parallel and self.queue:
+            node = self._select_node()
+            batch_size = self.max_batch_size
+            if self.adaptive_batching:
+                batch_size = self.scheduler.batch_size(node)
             #Get a chunk of entries from the command queue so we can make a batch.
-            subqueue = self.queue[:self.max_batch_size]
-            self.queue = self.queue[self.max_batch_size:]
+            subqueue = self.queue.pop(batch_size)
+            for index in range(0, len(subqueue)):
+                if len(subqueue) > 1 and self.entries[subqueue[index]].single:
+                    #Send commands whose reply made a batch response too large on their own.
+                    keep = max(index, 1)
+                    self.queue.requeue([(request_id, self.entries[request_id].lane) for request_id in subqueue[keep:]])
+                    subqueue = subqueue[:keep]
+                    break
             #Send a single batch to the currently selected RPC node.
-            dv = self._process_batch(subqueue)
+            dv = self._process_batch(subqueue, node)
         #If there is nothing left to do, there is nothing left to do
-        if not self.queue and self.active_call_count == 0:
+        if not self.queue and self.active_call_count == 0 and self.pending_local == 0:
             self.log.error("Queue is empty and no active HTTPS-POSTs remaining.")
             if self.stop_when_empty:
                 #On request, stop reactor when queue empty while no active queries remain.
                 self.reactor.stop()
         return dv
-    def _process_batch(self, subqueue):
+    def _hedge_node(self, node, batch_size):
+        """Pick a node other than the given one for a hedged request."""
+        if len(self.nodes) < 2:
+            return None
+        if self.node_selection == "scored":
+            other = self.scheduler.select(exclude=node)
+        else:
+            other = self.nodes[(self.nodes.index(node) + 1) % len(self.nodes)]
+        if other == node or (batch_size > 1 and self.scheduler.nodes[other].batch_capable == False):
+            #Don't send a batch to a node we know can't handle it.
+            return None
+        return other
+    def _hedge_delay(self):
+        """Return the latency percentile after which a batch gets hedged, or None if we can't tell yet."""
+        if self.hedge_percentile == None or len(self.latencies) < self.hedge_min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile))]
+    def _process_batch(self, subqueue, first=None):
         """Send a single batch of JSON-RPC commands to the server and process the result."""
         try:
-            timeoutCall = None
-            jo = None
-            if self.max_batch_size == 1:
+            body = None
+            if len(subqueue) == 1:
                 #At time of writing, the regular nodes have broken JSON-RPC batch handling.
-                #So when max_batch_size is set to one, we assume we need to work around this fact.
-                jo = json.dumps(self.entries[subqueue[0]]._get_rpc_call_object())
+                #So when there is just one command, we send it as a plain call to work around this fact.
+                body = self.entries[subqueue[0]]._get_rpc_call_bytes(self.codec)
             else:
                 #The api.steemitstage.com node properly supports JSON-RPC batches, and so, hopefully soon, will the other nodes.
-                qarr = list()
-                for num in subqueue:
-                    qarr.append(self.entries[num]._get_rpc_call_object())
-                jo = json.dumps(qarr)
-
-            call = FileBodyProducer(BytesIO(str.encode(str(jo))))
-            url = "https://" + self.nodes[self.node_index] + "/"
-            url = str.encode(str(url))
-            deferred = self.agent.request(b'POST',
-                                          url,
-                                          Headers({"User-Agent"  : ['Async Steem for Python v0.6.1'],
-                                                   "Content-Type": ["application/json"]}),
-                                          call)
-
-            def process_one_result(reply):
+                body = self.codec.batch([self.entries[num]._get_rpc_call_bytes(self.codec) for num in subqueue])
+            #State shared between the original HTTPS POST for this batch and a possible hedged one.
+            batch = dict()
+            batch["done"] = False      #Set once a response was processed or the batch was requeued.
+            batch["attempts"] = list() #Per POST state dicts.
+            batch["hedge"] = None      #Delayed call that sends the hedged request.
+            batch["owner"] = None      #With streaming decoding, the POST whose replies are being processed.
+            batch["handled"] = set()   #With streaming decoding, the ids of the commands already processed.
+            def stop_others(winner):
+                """Stop the hedge timer and all POSTs for this batch other than winner."""
+                if batch["hedge"] != None and batch["hedge"].active():
+                    batch["hedge"].cancel()
+                for other in batch["attempts"]:
+                    if other["active"] and not other is winner:
+                        #Cancel the loser, it will be ignored when it's errback fires.
+                        other["cancelled"] = True
+                        other["deferred"].cancel()
+            def finish():
+                """The batch is fully processed, stop any other POSTs for it."""
+                batch["done"] = True
+                stop_others(None)
+                #This HTTPS POST is now fully processed.
+                self.active_call_count = self.active_call_count - 1
+                #Invoke self, possibly sending new queues RPC calls to the current node
+                self()
+            def failed(attempt):
+                """An HTTPS POST for this batch failed, requeue the batch unless an other POST is still running."""
+                if batch["done"]:
+                    return
+                for other in batch["attempts"]:
+                    if other["active"]:
+                        return
+                if batch["hedge"] != None and batch["hedge"].active():
+                    batch["hedge"].cancel()
+                self.requeue_count = self.requeue_count + 1
+                #Commands already processed from a partially streamed response are done.
+                for request_id in batch["handled"]:
+                    if request_id in self.entries:
+                        del self.entries[request_id]
+                #Add the rest of the failed sub-queue back to the command queue, we shall try again soon.
+                self.queue.requeue([(request_id, self.entries[request_id].lane) for request_id in subqueue
+                                    if not request_id in batch["handled"]])
+                finish()
+            def process_one_result(reply, node, start):
                 """Process a single response from an JSON-RPC command."""
                 try:
                     if "id" in reply:
                         reply_id = reply["id"]
                         if reply_id in self.entries:
                             match = self.entries[reply_id]
+                            if self.metrics != None:
+                                self.metrics.observe("rpc_latency_seconds", time.time() - start,
+                                                     {"method" : match.command, "node" : node})
+                                if not "result" in reply:
+                                    self.metrics.inc("rpc_call_errors_total", labels={"method" : match.command})
+                            #No longer in flight, so a callback making the identical call again gets a fresh one.
+                            self._done_inflight(match)
                             if "result" in reply:
+                                #Remember irreversible blocks and the last irreversible block number.
+                                self._observe_result(match, reply["result"], node)
                                 #Call the proper result handler for the request that this response belongs to.
                                 match._handle_result(reply["result"])
                             else:
@@ -187,103 +455,357 @@ class RpcClient(object):
                         self.log.error("Error: Invalid JSON-RPC response without id in entry: {ris!r}.")
                 except Exception as ex:
                     self.log.failure("Error in _process_one_result {err!r}",err=str(ex))
-            def handle_response(response):
-                """Handle response for JSON-RPC batch query invocation."""
-                try:
+            def send(node):
+                """Send this batch to a node as a single HTTPS POST."""
+                attempt = dict()
+                attempt["node"] = node
+                attempt["active"] = True
+                attempt["cancelled"] = False
+                start = time.time()
+                if self.metrics != None:
+                    self.metrics.inc("rpc_requests_total", labels={"node" : node})
+                deferred = self._post(node, body)
+                attempt["deferred"] = deferred
+                batch["attempts"].append(attempt)
+                self.scheduler.started(node)
+                timeoutCall = None
+                def handle_response(response):
+                    """Handle response for JSON-RPC batch query invocation."""
                     #Cancel any active timeout for this HTTPS call.
-                    if timeoutCall.active():
+                    if timeoutCall != None and timeoutCall.active():
                         timeoutCall.cancel()
                     def cbBody(bodystring):
                         """Process response body for JSON-RPC batch query invocation."""
+                        attempt["active"] = False
+                        results = None
+                        #The body SHOULD be JSON, it not always is.
+                        try:
+                            results = self.codec.loads(bodystring)
+                        except Exception as ex:
+                            #If the result is NON-JSON, may want to move to the next node in the node list
+                            self._node_failed(node, "Non-JSON response from server")
+                        handle_results(results, len(bodystring))
+                    def on_element(reply):
+                        """Process a single reply as soon as it has been decoded from a streamed batch response."""
+                        if batch["done"] or (batch["owner"] != None and not batch["owner"] is attempt):
+                            return
+                        if batch["owner"] == None:
+                            #The first reply commits the batch to this POST, stop the others.
+                            batch["owner"] = attempt
+                            stop_others(attempt)
+                        if isinstance(reply, dict):
+                            batch["handled"].add(reply.get("id"))
+                        process_one_result(reply, node, start)
+                    def cbStream(outcome):
+                        """Process the end of a streamed response body."""
+                        attempt["active"] = False
+                        if isinstance(outcome, StreamedArray):
+                            #All replies have been processed already.
+                            handle_results(list(), outcome.size)
+                        else:
+                            handle_results(outcome[0], outcome[1])
+                    def ebStream(failure):
+                        """Handle a streamed response body that was too large or not JSON, pass on network errors."""
+                        if not failure.check(ResponseTooLarge, ValueError):
+                            return failure
+                        attempt["active"] = False
+                        try:
+                            self.scheduler.batch_done(node, len(subqueue), False)
+                            if failure.check(ResponseTooLarge):
+                                #Not a fault of the node, release its slot without counting an error.
+                                self.scheduler.abandoned(node)
+                                self.log.error("Error: Response from {node!r} too large, {count!r} replies were processed.",
+                                               node=node, count=len(batch["handled"]))
+                                if len(subqueue) == 1 and not batch["done"]:
+                                    #Sending a single call again would only get the same reply, fail it instead.
+                                    entry = self.entries.pop(subqueue[0], None)
+                                    if entry != None:
+                                        self._done_inflight(entry)
+                                        entry._handle_error(-1, "Response larger than max_response_size")
+                                    finish()
+                                    return
+                                for request_id in subqueue:
+                                    if request_id in self.entries and not request_id in batch["handled"]:
+                                        #Retry the commands without a reply one at a time, so only too large ones fail.
+                                        self.entries[request_id].single = True
+                            else:
+                                self._node_failed(node, "Non-JSON response from server")
+                        except Exception as ex:
+                            self.log.failure("Error in ebStream {err!r}",err=str(ex))
+                        failed(attempt)
+                    def handle_results(results, size):
+                        """Process a decoded response body, results is None if the body was not JSON."""
                         try:
-                            results = None
-                            #The body SHOULD be JSON, it not always is.
-                            try:
-                                results = json.loads(bodystring)
-                            except Exception as ex:
-                                #If the result is NON-JSON, may want to move to the next node in the node list
-                                self._next_node("Non-JSON response from server")
-                                #Add the failed sub-queue back to the command queue, we shall try again soon.
-                                self.queue = subqueue + self.queue
-                            if results != None:
-                                ok = False
+                            if results == None:
+                                self.scheduler.batch_done(node, len(subqueue), False)
+                            elif len(subqueue) > 1 and isinstance(results, dict) and self.adaptive_batching:
+                                #A single response to a batch request, this node can't handle batches.
+                                self.log.info("Node {node!r} does not handle JSON-RPC batches.",node=node)
+                                self.scheduler.batch_unsupported(node)
+                                self.scheduler.failed(node)
+                            elif isinstance(results, dict) or isinstance(results, list):
+                                latency = time.time() - start
+                                self.scheduler.succeeded(node, latency)
+                                self.scheduler.batch_done(node, len(subqueue), True, latency, size)
+                                self.latencies.append(latency)
+                                if batch["done"]:
+                                    #An other POST for this batch already won, ignore this response.
+                                    return
                                 if isinstance(results, dict):
                                     #Running in legacy single JSON-RPC call mode (no batches), process the result of the single call.
-                                    process_one_result(results)
-                                    ok = True
+                                    process_one_result(results, node, start)
                                 else:
-                                    if isinstance(results, list):
-                                        #Running in batch mode, process the batch result, one response at a time
-                                        for reply in results:
-                                            process_one_result(reply)
-                                        ok = True
+                                    #Running in batch mode, process the batch result, one response at a time
+                                    for reply in results:
+                                        process_one_result(reply, node, start)
+                                #Clean up the entries dict by removing all fully processed commands that now are no longer in the queu.
+                                for request_id in subqueue:
+                                    if request_id in self.entries:
+                                        self._done_inflight(self.entries[request_id])
+                                        del self.entries[request_id]
                                     else:
-                                        #Completely unexpected result type, may want to move to the next node in the node list.
-                                        self._next_node("JSON response neither list nor object")
-                                        self.log.error("Error: Invalid JSON-RPC response, expecting list as response on batch.")
-                                        #Add the failed sub-queue back to the command queue, we shall try again soon.
-                                        self.queue = subqueue + self.queue
-                                if ok == True:
-                                    #Clean up the entries dict by removing all fully processed commands that now are no longer in the queu.
-                                    for request_id in subqueue:
-                                        if request_id in self.entries:
-                                            del self.entries[request_id]
-                                        else:
-                                            self.log.error("Error: No response entry for request entry in result: {rid!r}.",rid=request_id)
+                                        self.log.error("Error: No response entry for request entry in result: {rid!r}.",rid=request_id)
+                                finish()
+                                return
+                            else:
+                                #Completely unexpected result type, may want to move to the next node in the node list.
+                                self.scheduler.batch_done(node, len(subqueue), False)
+                                self._node_failed(node, "JSON response neither list nor object")
+                                self.log.error("Error: Invalid JSON-RPC response, expecting list as response on batch.")
                         except Exception as ex:
-                            self.log.failure("Error in cbBody {err!r}",err=str(ex))
-                        #This HTTPS POST is now fully processed.
-                        self.active_call_count = self.active_call_count - 1
-                        #Invoke self, possibly sending new queues RPC calls to the current node
-                        self()
-                    deferred2 = readBody(response)
-                    deferred2.addCallback(cbBody)
+                            self.log.failure("Error in handle_results {err!r}",err=str(ex))
+                        failed(attempt)
+                    if self.streaming_decode:
+                        deferred2 = read_json(response, on_element, self.max_response_size, self.codec.loads)
+                        deferred2.addCallbacks(cbStream, ebStream)
+                    else:
+                        deferred2 = readBody(response)
+                        deferred2.addCallback(cbBody)
                     return deferred2
-                except Exception as ex:
-                    self.log.failure("Error in handle_response {err!r}",err=str(ex))
-                    #If something went wrong, the HTTPS POST isn't active anymore.
-                    self.active_call_count = self.active_call_count - 1
-                    #Invoke self, possibly sending new queues RPC calls to the current node
-                    self()
-            deferred.addCallback(handle_response)
-            def _handle_error(error):
-                """Handle network level error for JSON-RPC request."""
-                try:
-                    #Abandon any active timeout triggers
-                    if timeoutCall.active():
-                        timeoutCall.cancel()
-                    #Unexpected error on HTTPS POST, we may want to move to the next node.
-                    self._next_node(error.getErrorMessage())
-                    self.log.error("Error on HTTPS POST : {err!r}",err=error.getErrorMessage())
-                except Exception as ex:
-                    self.log.failure("Error in _handle_error {err!r}",err=str(ex))
-                #Add the failed sub-queue back to the command queue, we shall try again soon.
-                self.queue = subqueue + self.queue
-                ##If something went wrong, the HTTPS POST isn't active anymore.
-                self.active_call_count = self.active_call_count - 1
-                #Invoke self, possibly sending new queues RPC calls to the current node
-                self()
-            deferred.addErrback(_handle_error)
-            timeoutCall = self.reactor.callLater(self.rpc_timeout, deferred.cancel)
+                def _handle_error(error):
+                    """Handle network level error for JSON-RPC request."""
+                    attempt["active"] = False
+                    try:
+                        #Abandon any active timeout triggers
+                        if timeoutCall != None and timeoutCall.active():
+                            timeoutCall.cancel()
+                        if attempt["cancelled"] or self.shutting_down:
+                            #We cancelled this POST ourselves because an other one won, or it was aborted on shutdown.
+                            self.scheduler.abandoned(node)
+                            return
+                        #Unexpected error on HTTPS POST, we may want to move to the next node.
+                        self.scheduler.batch_done(node, len(subqueue), False)
+                        self._node_failed(node, error.getErrorMessage())
+                        self.log.error("Error on HTTPS POST : {err!r}",err=error.getErrorMessage())
+                    except Exception as ex:
+                        self.log.failure("Error in _handle_error {err!r}",err=str(ex))
+                    failed(attempt)
+                deferred.addCallback(handle_response)
+                deferred.addErrback(_handle_error)
+                timeoutCall = self.reactor.callLater(self.rpc_timeout, deferred.cancel)
+                return deferred
             #Keep track of the number of active parallel HTTPS posts.
             self.active_call_count = self.active_call_count + 1
+            if self.metrics != None:
+                self.metrics.observe("rpc_batch_size", len(subqueue))
+            if first == None:
+                first = self._select_node()
+            deferred = send(first)
+            delay = self._hedge_delay()
+            if delay != None and not batch["done"]:
+                def hedge():
+                    if not batch["done"]:
+                        node = self._hedge_node(first, len(subqueue))
+                        if node != None:
+                            self.hedge_count = self.hedge_count + 1
+                            self.log.info("Hedging slow batch to {node!r}",node=node)
+                            send(node)
+                batch["hedge"] = self.reactor.callLater(delay, hedge)
             return deferred
         except Exception as ex:
             self.log.failure("Error in _process_batch {err!r}",err=str(ex))
+    def _observe_result(self, entry, result, node):
+        """Keep track of chain state from results, and store irreversible blocks in the block cache."""
+        if result == None:
+            return
+        if entry.command == "get_dynamic_global_properties" and "last_irreversible_block_num" in result:
+            self.last_irreversible_block = max(self.last_irreversible_block, result["last_irreversible_block_num"])
+            if self.result_cache != None:
+                self.result_cache.last_irreversible_block = self.last_irreversible_block
+            if "head_block_number" in result:
+                self.scheduler.report_head(node, result["head_block_number"])
+        if entry.cache_key != None and self.result_cache != None:
+            self.result_cache.put(entry.cache_key, entry.command, entry.arguments, result)
+        if entry.command == "get_block":
+            self.cache_block(int(entry.arguments[0]), result)
+    def cache_block(self, blockno, blk):
+        """Store a block in the block cache, if there is one and the block is irreversible.
+
+        Args:
+            blockno: The block number.
+            blk: The block, in the form get_block returns it.
+        """
+        if self.block_cache != None and "timestamp" in blk:
+            age = time.time() - parse_timestamp(blk["timestamp"])
+            if blockno <= self.last_irreversible_block or age > IRREVERSIBLE_AGE:
+                self.block_cache.put(blockno, blk)
+    def _done_inflight(self, entry):
+        """Forget about a read-only call being in flight, so new identical calls go to the network again."""
+        if entry.cache_key != None and self.inflight.get(entry.cache_key) is entry:
+            del self.inflight[entry.cache_key]
+    def cache_stats(self):
+        """Return result cache hit and miss counters and the number of coalesced and aggregated calls."""
+        stats = dict()
+        if self.result_cache != None:
+            stats.update(self.result_cache.stats())
+        stats["coalesced"] = self.coalesced_count
+        stats["aggregated"] = self.aggregated_count
+        return stats
+    def _collect_metrics(self, metrics):
+        """Report queue depths, outstanding POSTs and the counters kept by the client itself."""
+        for lane, stats in self.queue.stats().items():
+            metrics.set("rpc_queue_depth", stats["depth"], {"lane" : lane})
+        metrics.set("rpc_active_calls", self.active_call_count)
+        for node, state in self.scheduler.nodes.items():
+            metrics.set("rpc_in_flight", state.in_flight, {"node" : node})
+        metrics.set_counter("rpc_requeues_total", self.requeue_count)
+        metrics.set_counter("rpc_hedges_total", self.hedge_count)
+        metrics.set_counter("rpc_coalesced_total", self.coalesced_count)
+        metrics.set_counter("rpc_aggregated_total", self.aggregated_count)
+        pool = self.pool.stats()
+        metrics.set_counter("rpc_connections_opened_total", pool["opened"])
+        metrics.set_counter("rpc_connections_reused_total", pool["reused"])
+    def pool_stats(self):
+        """Return connection pool statistics: requests, opened, reused and dropped connections and idle connections per node."""
+        return self.pool.stats()
+    def pending_commands(self, lanes=("normal", "bulk")):
+        """Return the number of commands waiting in the given priority lanes, by default the ones used for bot queries."""
+        return self.queue.depth(lanes)
+    def queue_stats(self):
+        """Return per priority lane queue depth and wait time statistics."""
+        return self.queue.stats()
+    def _local_result(self, entry, result):
+        """Hand a locally served result to its callback."""
+        self.pending_local = self.pending_local - 1
+        entry._handle_result(result)
+        #Invoke self, the callback may have queued new commands.
+        self()
+    def _aggregate(self, name, entry):
+        """Add a list taking lookup to the pending merged call for its method."""
+        pending = self.aggregates.get(name)
+        if pending == None:
+            pending = {"entries" : list(), "names" : list(), "seen" : set(), "timer" : None}
+            self.aggregates[name] = pending
+            #Keep stop_when_empty from stopping the reactor while the window is open.
+            self.pending_local = self.pending_local + 1
+            pending["timer"] = self.reactor.callLater(self.aggregate_window, self._flush_aggregate, name)
+        else:
+            #Only calls joining an open window are merged into an other call.
+            self.aggregated_count = self.aggregated_count + 1
+        pending["entries"].append(entry)
+        for account in entry.arguments[0]:
+            if not account in pending["seen"]:
+                pending["seen"].add(account)
+                pending["names"].append(account)
+        if len(pending["names"]) >= self.aggregate_limit:
+            self._flush_aggregate(name)
+    def _flush_aggregate(self, name):
+        """Send the merged call for a method and split its result up for the original callers."""
+        pending = self.aggregates.pop(name, None)
+        if pending == None:
+            return
+        if pending["timer"].active():
+            pending["timer"].cancel()
+        self.pending_local = self.pending_local - 1
+        callers = pending["entries"]
+        names = pending["names"]
+        positional = _AGGREGATE_METHODS[name]
+        def on_result(result, client):
+            """Hand each caller the part of the merged result for the names it asked for, in its own order."""
+            by_name = dict()
+            if positional:
+                if isinstance(result, list) and len(result) == len(names):
+                    by_name = dict(zip(names, result))
+            elif isinstance(result, list):
+                for item in result:
+                    if isinstance(item, dict) and "name" in item:
+                        by_name[item["name"]] = item
+            for caller in callers:
+                if positional:
+                    caller._handle_result([by_name.get(account) for account in caller.arguments[0]])
+                else:
+                    caller._handle_result([by_name[account] for account in caller.arguments[0] if account in by_name])
+        def on_error(errno, msg, client):
+            """Forward an error for the merged call to every caller."""
+            for caller in callers:
+                caller._handle_error(errno, msg)
+        merged = self._add_entry(name, (names,), False)
+        if merged != None:
+            merged.on_result(on_result)
+            merged.on_error(on_error)
+        #Invoke self, we may have been called from the window timer with nothing else waking up the queue.
+        self()
+    def _cache_key(self, name, args):
+        """Return the coalescing and result cache key for a call, without encoding plain scalar arguments."""
+        for arg in args:
+            if not isinstance(arg, _SCALARS):
+                return (name, self.codec.dumps(args))
+        return (name, args)
+    def _add_entry(self, name, args, aggregate=True):
+        """Return a new in-queue JSON-RPC command invocation object."""
+        try:
+            #A unique id for each command.
+            self.cmd_seq = self.cmd_seq + 1
+            if self.metrics != None and aggregate:
+                self.metrics.inc("rpc_calls_total", labels={"method" : name})
+            if aggregate and self.aggregate_window != None and name in _AGGREGATE_METHODS and \
+               len(args) == 1 and isinstance(args[0], list):
+                #Hold the lookup so it can be merged with others made shortly after it.
+                entry = _QueueEntry(self, name, args, self.cmd_seq, self.log)
+                self._aggregate(name, entry)
+                return entry
+            if name == "get_block" and self.block_cache != None and len(args) == 1:
+                blk = self.block_cache.get(int(args[0]))
+                if blk != None:
+                    #Serve the block from the local cache, without queueing it for the network.
+                    entry = _QueueEntry(self, name, args, self.cmd_seq, self.log)
+                    self.pending_local = self.pending_local + 1
+                    self.reactor.callLater(0, self._local_result, entry, blk)
+                    return entry
+            #Create a new queu entry
+            key = None
+            if (self.coalesce or self.result_cache != None) and _is_read_only(name, args):
+                key = self._cache_key(name, args)
+                if self.result_cache != None and self.result_cache.caches(name):
+                    found, result = self.result_cache.get(key)
+                    if found:
+                        #Answer from the result cache, without queueing it for the network.
+                        entry = _QueueEntry(self, name, args, self.cmd_seq, self.log)
+                        self.pending_local = self.pending_local + 1
+                        self.reactor.callLater(0, self._local_result, entry, result)
+                        return entry
+                if self.coalesce and key in self.inflight:
+                    #An identical call is already on its way, share its result.
+                    entry = _QueueEntry(self, name, args, self.cmd_seq, self.log)
+                    self.inflight[key].followers.append(entry)
+                    self.coalesced_count = self.coalesced_count + 1
+                    return entry
+            self.entries[self.cmd_seq] = _QueueEntry(self, name, args, self.cmd_seq, self.log)
+            self.entries[self.cmd_seq].lane = self.lane_methods.get(name, "normal")
+            if key != None:
+                self.entries[self.cmd_seq].cache_key = key
+                if self.coalesce:
+                    self.inflight[key] = self.entries[self.cmd_seq]
+            #append it to the command queue
+            self.queue.push(self.cmd_seq, self.entries[self.cmd_seq].lane)
+            #Return handle to the new entry for setting callbacks on.
+            return self.entries[self.cmd_seq]
+        except Exception as ex:
+            self.log.failure("Error in addQueueEntry {err!r}",err=str(ex))
     def __getattr__(self, name):
         def addQueueEntry(*args):
             """Return a new in-queue JSON-RPC command invocation object with auto generated command name from __getattr__."""
-            try:
-                #A unique id for each command.
-                self.cmd_seq = self.cmd_seq + 1
-                #Create a new queu entry
-                self.entries[self.cmd_seq] = _QueueEntry(self, name, args, self.cmd_seq, self.log)
-                #append it to the command queue
-                self.queue.append(self.cmd_seq)
-                #Return handle to the new entry for setting callbacks on.
-                return self.entries[self.cmd_seq]
-            except Exception as ex:
-                self.log.failure("Error in addQueueEntry {err!r}",err=str(ex))
+            return self._add_entry(name, args)
         return addQueueEntry
     #Need to be able to check if RpcClient equatesNone
     def __eq__(self, val):
@@ -0,0 +1,154 @@
+"""Incremental decoding of JSON-RPC batch responses while they are being received."""
+import re
+import json
+from twisted.internet import defer
+from twisted.internet.protocol import Protocol
+from twisted.web.client import ResponseDone
+
+#Characters that matter for finding the end of an array element outside of and within strings.
+_STRUCTURAL = re.compile(b'["\\[\\]{},]')
+_STRING_SPECIAL = re.compile(b'["\\\\]')
+_WHITESPACE = b" \t\r\n"
+
+class ResponseTooLarge(Exception):
+    """The response body grew beyond the maximum response size."""
+
+class StreamedArray(object):
+    """Result of a JsonArrayProtocol for a body that was a JSON array and was handed out element by element."""
+    def __init__(self, count, size):
+        self.count = count   #Number of array elements handed to the element callback.
+        self.size = size     #Size of the body in bytes.
+
+class JsonArrayProtocol(Protocol):
+    """Protocol for a response body that hands each element of a top level JSON array to a callback as soon as it is complete.
+
+    The finished Deferred fires with a StreamedArray if the body was a JSON array, or with a (value, size) tuple
+    holding the decoded value for any other JSON body. It fails with ValueError for bodies that aren't valid JSON and
+    with ResponseTooLarge if the body exceeds the maximum size. Cancelling it stops reading the body.
+    """
+    def __init__(self, on_element, max_size=None, loads=json.loads):
+        """Constructor
+
+        Args:
+            on_element : Callable taking a single decoded array element.
+            max_size : Maximum size of the body in bytes, None for no limit.
+            loads : Function decoding a bytes string of JSON.
+        """
+        self.on_element = on_element
+        self.max_size = max_size
+        self.loads = loads
+        self.finished = defer.Deferred(self._cancel)
+        self.buf = bytearray()
+        self.size = 0
+        self.is_array = None     #None until the first non whitespace byte is seen.
+        self.pos = 0             #Scan position within buf.
+        self.depth = 0
+        self.in_string = False
+        self.element_start = 0   #Start within buf of the array element being received.
+        self.count = 0
+        self.closed = False      #The closing bracket of the array was seen.
+    def _cancel(self, deferred):
+        if self.transport != None:
+            self.transport.stopProducing()
+    def _fail(self, error):
+        if not self.finished.called:
+            self.finished.errback(error)
+            if self.transport != None:
+                self.transport.stopProducing()
+    def dataReceived(self, data):
+        if self.finished.called:
+            return
+        self.size = self.size + len(data)
+        too_large = self.max_size != None and self.size > self.max_size
+        if too_large:
+            #Still hand out the elements that fit within the maximum size.
+            data = data[:len(data) - (self.size - self.max_size)]
+        self.buf.extend(data)
+        if self.is_array == None:
+            stripped = self.buf.lstrip(_WHITESPACE)
+            if not stripped:
+                if too_large:
+                    self._fail(ResponseTooLarge("Response larger than %d bytes" % self.max_size))
+                return
+            self.is_array = stripped[:1] == b"["
+            if self.is_array:
+                self.pos = len(self.buf) - len(stripped) + 1
+                self.element_start = self.pos
+                self.depth = 1
+        if self.is_array == True and not self.closed:
+            try:
+                self._scan()
+            except ValueError as ex:
+                self._fail(ex)
+        if too_large:
+            self._fail(ResponseTooLarge("Response larger than %d bytes" % self.max_size))
+    def _scan(self):
+        """Find and hand out the array elements completed by the data received so far."""
+        buf = self.buf
+        while self.pos < len(buf):
+            if self.in_string:
+                match = _STRING_SPECIAL.search(buf, self.pos)
+                if match == None:
+                    self.pos = len(buf)
+                    break
+                if buf[match.start()] == 0x5c:
+                    #Skip the escaped character, even if it hasn't arrived yet.
+                    self.pos = match.start() + 2
+                    continue
+                self.in_string = False
+                self.pos = match.end()
+                continue
+            match = _STRUCTURAL.search(buf, self.pos)
+            if match == None:
+                self.pos = len(buf)
+                break
+            char = buf[match.start()]
+            self.pos = match.end()
+            if char == 0x22:
+                self.in_string = True
+            elif char == 0x5b or char == 0x7b:
+                self.depth = self.depth + 1
+            elif char == 0x5d or char == 0x7d:
+                self.depth = self.depth - 1
+                if self.depth == 0:
+                    self._element(match.start())
+                    self.closed = True
+                    break
+            elif self.depth == 1:
+                self._element(match.start())
+                self.element_start = self.pos
+        #Drop the bytes of the elements already handed out.
+        if self.element_start > 0:
+            del buf[:self.element_start]
+            self.pos = self.pos - self.element_start
+            self.element_start = 0
+    def _element(self, end):
+        """Decode and hand out the array element ending at end."""
+        raw = bytes(self.buf[self.element_start:end])
+        if raw.strip(_WHITESPACE):
+            value = self.loads(raw)
+            self.count = self.count + 1
+            self.on_element(value)
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return
+        if not reason.check(ResponseDone):
+            self.finished.errback(reason)
+        elif self.is_array:
+            if not self.closed:
+                self.finished.errback(ValueError("Truncated JSON array"))
+            else:
+                self.finished.callback(StreamedArray(self.count, self.size))
+        else:
+            try:
+                value = self.loads(bytes(self.buf))
+            except ValueError as ex:
+                self.finished.errback(ex)
+                return
+            self.finished.callback((value, self.size))
+
+def read_json(response, on_element, max_size=None, loads=json.loads):
+    """Start reading a response body with a JsonArrayProtocol, returns its finished Deferred."""
+    protocol = JsonArrayProtocol(on_element, max_size, loads)
+    response.deliverBody(protocol)
+    return protocol.finished
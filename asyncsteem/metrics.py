@@ -0,0 +1,199 @@
+"""Counters, gauges and histograms for RpcClient and ActiveBlockChain, exposed as Prometheus text or periodic snapshots.
+
+Pass a Metrics object as the metrics argument of RpcClient or ActiveBlockChain. Any other object with the same inc,
+set_counter, set, observe and add_collector methods can be passed instead, for example to forward to statsd.
+"""
+from twisted.internet import task
+from twisted.web import server, resource
+
+#Default histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+#Histogram buckets for batch sizes.
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+#Help text and buckets for the metrics reported by asyncsteem, by metric name without prefix.
+_DESCRIPTIONS = {
+    "rpc_calls_total" : ("JSON-RPC calls made, including the ones served locally.", None),
+    "rpc_call_errors_total" : ("JSON-RPC calls answered with an error.", None),
+    "rpc_requests_total" : ("HTTP(S) POSTs sent to a node.", None),
+    "rpc_node_errors_total" : ("Failed HTTP(S) POSTs and unusable responses, per node.", None),
+    "rpc_node_rotations_total" : ("Switches to an other node, or nodes taken out of rotation, because of errors.", None),
+    "rpc_requeues_total" : ("Batches added back to the command queue after a failed POST.", None),
+    "rpc_hedges_total" : ("Hedged POSTs sent for slow batches.", None),
+    "rpc_coalesced_total" : ("Calls that shared an identical in-flight call.", None),
+    "rpc_aggregated_total" : ("Lookups merged into an other call.", None),
+    "rpc_connections_opened_total" : ("New connections to the nodes.", None),
+    "rpc_connections_reused_total" : ("Requests that reused an idle connection.", None),
+    "rpc_latency_seconds" : ("Time from sending a batch to the reply for a call, per method and node.", LATENCY_BUCKETS),
+    "rpc_batch_size" : ("Number of calls per POST.", SIZE_BUCKETS),
+    "rpc_queue_depth" : ("Calls waiting in the command queue, per priority lane.", None),
+    "rpc_active_calls" : ("HTTP(S) POSTs outstanding.", None),
+    "rpc_in_flight" : ("HTTP(S) POSTs outstanding, per node.", None),
+    "blocks_processed_total" : ("Blocks handed to the bots.", None),
+    "block_fetch_retries_total" : ("get_block calls retried after an error.", None),
+    "blocks_per_second" : ("Blocks handed to the bots per second since the previous collection.", None),
+    "last_block" : ("Number of the newest block fetched.", None),
+    "block_lag_seconds" : ("Age of the newest block handed to the bots.", None),
+    "ready_blocks" : ("Fetched blocks waiting to be handed to the bots.", None),
+    "awaiting_deferreds" : ("Deferreds returned by bots that haven't fired yet.", None),
+    "flow_paused" : ("1 while block fetching is paused by flow control.", None),
+    "quarantined_bots" : ("Bots whose handlers run in a thread pool because they were too slow.", None),
+    "handler_seconds" : ("Time spent in bot handlers, per bot and event.", LATENCY_BUCKETS),
+}
+
+def _label_key(labels):
+    if not labels:
+        return ()
+    return tuple(sorted(labels.items()))
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(key, extra=None):
+    items = list(key)
+    if extra != None:
+        items.append(extra)
+    if not items:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, _escape(value)) for name, value in items) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class _Histogram(object):
+    """Helper class holding the bucket counts, sum and count of a single histogram series."""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+    def observe(self, value):
+        self.sum = self.sum + value
+        self.count = self.count + 1
+        for index in range(0, len(self.buckets)):
+            if value <= self.buckets[index]:
+                self.counts[index] = self.counts[index] + 1
+                break
+
+class Metrics(object):
+    """Registry of metrics that the instrumented code reports to."""
+    def __init__(self, prefix="asyncsteem_"):
+        """Constructor
+
+        Args:
+            prefix : Prefix for all metric names in the Prometheus output.
+        """
+        self.prefix = prefix
+        self.counters = dict()     #Metric name to a dict of label key to value.
+        self.gauges = dict()
+        self.histograms = dict()   #Metric name to a dict of label key to _Histogram.
+        self.collectors = list()   #Callables taking this object, run before every snapshot to update gauges.
+    def inc(self, name, value=1, labels=None):
+        """Add to a counter."""
+        series = self.counters.setdefault(name, dict())
+        key = _label_key(labels)
+        series[key] = series.get(key, 0) + value
+    def set_counter(self, name, value, labels=None):
+        """Set a counter that is kept elsewhere to its current total."""
+        self.counters.setdefault(name, dict())[_label_key(labels)] = value
+    def set(self, name, value, labels=None):
+        """Set a gauge."""
+        self.gauges.setdefault(name, dict())[_label_key(labels)] = value
+    def observe(self, name, value, labels=None):
+        """Add a measurement to a histogram."""
+        series = self.histograms.setdefault(name, dict())
+        key = _label_key(labels)
+        histogram = series.get(key)
+        if histogram == None:
+            buckets = _DESCRIPTIONS.get(name, (None, None))[1]
+            histogram = _Histogram(buckets if buckets != None else LATENCY_BUCKETS)
+            series[key] = histogram
+        histogram.observe(value)
+    def add_collector(self, collector):
+        """Add a callable that is called with this object before every snapshot, for gauges that are read on demand."""
+        self.collectors.append(collector)
+    def collect(self):
+        for collector in self.collectors:
+            try:
+                collector(self)
+            except Exception:
+                #A broken collector should not keep the other metrics from being reported.
+                pass
+    def snapshot(self):
+        """Collect and return all metrics as a dict of metric name to a list of (labels dict, value) pairs.
+
+        Histogram values are dicts with the bucket upper bounds, cumulative bucket counts, sum and count.
+        """
+        self.collect()
+        result = dict()
+        for kind in (self.counters, self.gauges):
+            for name, series in kind.items():
+                result[name] = [(dict(key), value) for key, value in series.items()]
+        for name, series in self.histograms.items():
+            result[name] = list()
+            for key, histogram in series.items():
+                cumulative = list()
+                total = 0
+                for count in histogram.counts:
+                    total = total + count
+                    cumulative.append(total)
+                result[name].append((dict(key), {"buckets" : list(histogram.buckets),
+                                                 "counts" : cumulative,
+                                                 "sum" : histogram.sum,
+                                                 "count" : histogram.count}))
+        return result
+    def prometheus(self):
+        """Collect and return all metrics in the Prometheus text exposition format."""
+        self.collect()
+        lines = list()
+        for kind, metrics in (("counter", self.counters), ("gauge", self.gauges), ("histogram", self.histograms)):
+            for name in sorted(metrics):
+                fullname = self.prefix + name
+                description = _DESCRIPTIONS.get(name)
+                if description != None:
+                    lines.append("# HELP %s %s" % (fullname, description[0]))
+                lines.append("# TYPE %s %s" % (fullname, kind))
+                for key in sorted(metrics[name]):
+                    value = metrics[name][key]
+                    if kind != "histogram":
+                        lines.append("%s%s %s" % (fullname, _format_labels(key), _format_value(value)))
+                        continue
+                    total = 0
+                    for index in range(0, len(value.buckets)):
+                        total = total + value.counts[index]
+                        lines.append("%s_bucket%s %d" % (fullname, _format_labels(key, ("le", _format_value(float(value.buckets[index])))), total))
+                    lines.append("%s_bucket%s %d" % (fullname, _format_labels(key, ("le", "+Inf")), value.count))
+                    lines.append("%s_sum%s %s" % (fullname, _format_labels(key), _format_value(value.sum)))
+                    lines.append("%s_count%s %d" % (fullname, _format_labels(key), value.count))
+        return "\n".join(lines) + "\n"
+
+class MetricsResource(resource.Resource):
+    """Twisted web resource serving the Prometheus text output of a Metrics object."""
+    isLeaf = True
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+    def render_GET(self, request):
+        request.setHeader(b"Content-Type", b"text/plain; version=0.0.4; charset=utf-8")
+        return self.metrics.prometheus().encode("utf-8")
+
+def serve_metrics(reactor, metrics, port=9102, interface="127.0.0.1"):
+    """Serve the metrics for Prometheus to scrape on http://interface:port/, returns the listening port."""
+    return reactor.listenTCP(port, server.Site(MetricsResource(metrics)), interface=interface)
+
+def report_snapshots(reactor, metrics, interval, callback):
+    """Call callback with a snapshot of the metrics every interval seconds, returns the running LoopingCall."""
+    def report():
+        try:
+            callback(metrics.snapshot())
+        except Exception:
+            #An exception would stop the LoopingCall, keep reporting.
+            pass
+    loop = task.LoopingCall(report)
+    loop.clock = reactor
+    loop.start(interval, now=False)
+    return loop
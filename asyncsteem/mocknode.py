@@ -0,0 +1,329 @@
+"""Local fake Steem JSON-RPC node serving synthetic or archived blocks, for reproducible benchmarks and stress tests.
+
+Run it on its own with "python -m asyncsteem.mocknode --port 8765", or start it inside the reactor of a test with listen(),
+and point RpcClient or ActiveBlockChain at it with nodes=["http://127.0.0.1:8765"].
+"""
+import sys
+import time
+import random
+import hashlib
+from twisted.web import server, resource
+from .codec import default_codec
+from .timestamps import epoch_to_datetime
+
+#Blocks behind the head block that are not irreversible yet.
+IRREVERSIBLE_DISTANCE = 20
+
+def _timestamp(seconds):
+    return epoch_to_datetime(seconds).strftime("%Y-%m-%dT%H:%M:%S")
+
+def _account(num):
+    return "user%d" % num
+
+class MockNode(resource.Resource):
+    """Twisted web resource answering a subset of the Steem condenser API.
+
+    Blocks are generated from the block number, so every run serves the same blockchain. The head block is at the
+    current time when the node starts, and advances every block_interval seconds unless advance is False.
+    """
+    isLeaf = True
+    def __init__(self, reactor, head_block=20000000, block_interval=3, advance=True, transactions=20, accounts=1000,
+                 blocks=None, batch=True, latency=0, jitter=0, error_rate=0, garbage_rate=0, seed=0, codec=None):
+        """Constructor
+
+        Args:
+            reactor : The Twisted reactor.
+            head_block : Block number of the head block at the time the node is created.
+            block_interval : Seconds between blocks.
+            advance : Let the head block advance with the wall clock.
+            transactions : Number of transactions in each synthetic block.
+            accounts : Number of synthetic accounts taking part in the operations.
+            blocks : Optional dict mapping block numbers to blocks, or the path of an archive written by
+                     asyncsteem.blocksource.ArchiveWriter, served instead of the synthetic blocks.
+            batch : Accept JSON-RPC batches, if False a batch gets a single error response.
+            latency : Seconds to wait before sending each response.
+            jitter : Maximum number of seconds randomly added to the latency.
+            error_rate : Fraction of calls that get a JSON-RPC error instead of their result.
+            garbage_rate : Fraction of HTTP requests that get a non-JSON (HTML) response.
+            seed : Seed for the synthetic blocks and for the injected latency and errors.
+            codec : Optional asyncsteem.codec.Codec, the fastest one installed by default.
+        """
+        resource.Resource.__init__(self)
+        self.reactor = reactor
+        self.head_block = head_block
+        self.block_interval = block_interval
+        self.advance = advance
+        self.transactions = transactions
+        self.accounts = accounts
+        self.batch = batch
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.garbage_rate = garbage_rate
+        self.seed = seed
+        self.codec = codec if codec != None else default_codec
+        self.random = random.Random(seed)
+        self.started = time.time()
+        #Line up the block timestamps so the head block is at the current time.
+        self.genesis = int(self.started) - head_block * block_interval
+        self.blocks = dict()
+        if isinstance(blocks, dict):
+            self.blocks = blocks
+        elif blocks != None:
+            self._load_archive(blocks)
+        self.methods = {"get_block" : self.get_block,
+                        "get_block_header" : self.get_block_header,
+                        "get_dynamic_global_properties" : self.get_dynamic_global_properties,
+                        "get_content" : self.get_content,
+                        "get_accounts" : self.get_accounts,
+                        "lookup_account_names" : self.lookup_account_names,
+                        "get_block_range" : self.get_block_range}
+        self.requests = 0   #Number of HTTP requests received.
+        self.calls = 0      #Number of JSON-RPC calls received.
+        self.errors = 0     #Number of injected JSON-RPC errors.
+        self.garbage = 0    #Number of injected non-JSON responses.
+    def _load_archive(self, path):
+        from .blocksource import _open
+        with _open(path, "rb") as archive:
+            for line in archive:
+                if line.strip():
+                    blockno, blk = self.codec.loads(line)
+                    self.blocks[blockno] = blk
+        if self.blocks:
+            #Serve the archive as the tail of the chain.
+            last = max(self.blocks)
+            self.head_block = last
+            self.genesis = int(self.started) - last * self.block_interval
+    def head(self):
+        """Return the current head block number."""
+        if not self.advance:
+            return self.head_block
+        return self.head_block + int((time.time() - self.started) / self.block_interval)
+    def stats(self):
+        return {"requests" : self.requests,
+                "calls" : self.calls,
+                "errors" : self.errors,
+                "garbage" : self.garbage,
+                "head_block" : self.head()}
+    def get_block(self, blockno):
+        blockno = int(blockno)
+        if blockno < 1 or blockno > self.head():
+            return None
+        if blockno in self.blocks:
+            return self.blocks[blockno]
+        return self._synthetic_block(blockno)
+    def get_block_header(self, blockno):
+        blk = self.get_block(blockno)
+        if blk == None:
+            return None
+        return dict((key, blk[key]) for key in ("previous", "timestamp", "witness", "transaction_merkle_root", "extensions") if key in blk)
+    def _synthetic_block(self, blockno):
+        rnd = random.Random(blockno * 7919 + self.seed)
+        operations = list()
+        for index in range(0, self.transactions):
+            kind = rnd.random()
+            author = _account(rnd.randrange(self.accounts))
+            if kind < 0.6:
+                operation = ["vote", {"voter" : _account(rnd.randrange(self.accounts)),
+                                      "author" : author,
+                                      "permlink" : "post-%d" % rnd.randrange(1000),
+                                      "weight" : rnd.choice((10000, 5000, 100, -10000))}]
+            elif kind < 0.75:
+                operation = ["comment", {"parent_author" : "",
+                                         "parent_permlink" : "steem",
+                                         "author" : author,
+                                         "permlink" : "post-%d" % rnd.randrange(1000),
+                                         "title" : "Post %d" % blockno,
+                                         "body" : "Synthetic post in block %d." % blockno,
+                                         "json_metadata" : "{}"}]
+            elif kind < 0.9:
+                operation = ["custom_json", {"required_auths" : [],
+                                             "required_posting_auths" : [author],
+                                             "id" : "follow",
+                                             "json" : '["follow",{"follower":"%s","following":"%s","what":["blog"]}]' %
+                                                      (author, _account(rnd.randrange(self.accounts)))}]
+            else:
+                operation = ["transfer", {"from" : author,
+                                          "to" : _account(rnd.randrange(self.accounts)),
+                                          "amount" : "%d.%03d STEEM" % (rnd.randrange(100), rnd.randrange(1000)),
+                                          "memo" : ""}]
+            operations.append(operation)
+        blktime = _timestamp(self.genesis + blockno * self.block_interval)
+        return {"previous" : self._block_id(blockno - 1),
+                "timestamp" : blktime,
+                "witness" : _account(blockno % 21),
+                "transaction_merkle_root" : "0" * 40,
+                "extensions" : [],
+                "witness_signature" : "",
+                "transactions" : [{"ref_block_num" : (blockno - 1) & 0xffff,
+                                   "ref_block_prefix" : 0,
+                                   "expiration" : blktime,
+                                   "operations" : [operation],
+                                   "extensions" : [],
+                                   "signatures" : [],
+                                   "transaction_id" : self._transaction_id(blockno, index),
+                                   "block_num" : blockno,
+                                   "transaction_num" : index} for index, operation in enumerate(operations)],
+                "block_id" : self._block_id(blockno),
+                "signing_key" : "",
+                "transaction_ids" : [self._transaction_id(blockno, index) for index in range(0, len(operations))]}
+    @staticmethod
+    def _block_id(blockno):
+        return "%08x" % blockno + hashlib.sha1(str(blockno).encode()).hexdigest()[8:]
+    @staticmethod
+    def _transaction_id(blockno, index):
+        return hashlib.sha1(("%d/%d" % (blockno, index)).encode()).hexdigest()
+    def get_dynamic_global_properties(self):
+        head = self.head()
+        return {"head_block_number" : head,
+                "head_block_id" : self._block_id(head),
+                "time" : _timestamp(self.genesis + head * self.block_interval),
+                "current_witness" : _account(head % 21),
+                "last_irreversible_block_num" : max(head - IRREVERSIBLE_DISTANCE, 0)}
+    def get_content(self, author, permlink):
+        return {"author" : author,
+                "permlink" : permlink,
+                "category" : "steem",
+                "parent_author" : "",
+                "parent_permlink" : "steem",
+                "title" : permlink,
+                "body" : "Synthetic post by %s." % author,
+                "json_metadata" : "{}",
+                "created" : _timestamp(self.genesis + self.head_block * self.block_interval),
+                "net_votes" : len(author) + len(permlink),
+                "active_votes" : []}
+    def _account_object(self, name):
+        rnd = random.Random(name + str(self.seed))
+        return {"name" : name,
+                "balance" : "%d.000 STEEM" % rnd.randrange(10000),
+                "sbd_balance" : "%d.000 SBD" % rnd.randrange(1000),
+                "vesting_shares" : "%d.000000 VESTS" % rnd.randrange(10000000),
+                "reputation" : str(rnd.randrange(10**12)),
+                "post_count" : rnd.randrange(5000),
+                "voting_power" : rnd.randrange(10000)}
+    def _known(self, name):
+        return name.startswith("user") and name[4:].isdigit() and int(name[4:]) < self.accounts
+    def get_accounts(self, names):
+        return [self._account_object(name) for name in names if self._known(name)]
+    def lookup_account_names(self, names):
+        return [self._account_object(name) if self._known(name) else None for name in names]
+    def get_block_range(self, params):
+        #The block_api version, reached through "call".
+        start = params["starting_block_num"]
+        head = self.head()
+        blocks = list()
+        for blockno in range(start, min(start + params["count"], head + 1)):
+            blocks.append(self.get_block(blockno))
+        return {"blocks" : blocks}
+    def _answer(self, call):
+        """Return the response object for a single JSON-RPC call object."""
+        self.calls = self.calls + 1
+        response = {"jsonrpc" : "2.0", "id" : call.get("id") if isinstance(call, dict) else None}
+        if not isinstance(call, dict) or not "method" in call:
+            response["error"] = {"code" : -32600, "message" : "Invalid Request"}
+            return response
+        method = call["method"]
+        params = call.get("params", [])
+        if method == "call" and len(params) == 3:
+            #call(api, method, arguments), as used for appbase APIs.
+            method = params[1]
+            params = [params[2]]
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors = self.errors + 1
+            response["error"] = {"code" : -32000, "message" : "Injected error"}
+            return response
+        handler = self.methods.get(method)
+        if handler == None:
+            response["error"] = {"code" : -32601, "message" : "Method not found: %s" % method}
+            return response
+        try:
+            response["result"] = handler(*params)
+        except Exception as ex:
+            response["error"] = {"code" : -32602, "message" : "Invalid params: %s" % str(ex)}
+        return response
+    def render_POST(self, request):
+        self.requests = self.requests + 1
+        request.setHeader(b"Content-Type", b"application/json")
+        if self.garbage_rate and self.random.random() < self.garbage_rate:
+            self.garbage = self.garbage + 1
+            request.setResponseCode(502)
+            request.setHeader(b"Content-Type", b"text/html")
+            body = b"<html><body><h1>502 Bad Gateway</h1></body></html>"
+        else:
+            try:
+                calls = self.codec.loads(request.content.read())
+            except ValueError:
+                calls = None
+            if calls == None:
+                body = self.codec.dumps({"jsonrpc" : "2.0", "id" : None, "error" : {"code" : -32700, "message" : "Parse error"}})
+            elif isinstance(calls, list):
+                if self.batch:
+                    body = self.codec.dumps([self._answer(call) for call in calls])
+                else:
+                    body = self.codec.dumps({"jsonrpc" : "2.0", "id" : None,
+                                             "error" : {"code" : -32600, "message" : "Batch requests not supported"}})
+            else:
+                body = self.codec.dumps(self._answer(calls))
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay <= 0:
+            return body
+        def respond():
+            request.write(body)
+            request.finish()
+        delayed = self.reactor.callLater(delay, respond)
+        def disconnected(failure):
+            #The client went away before the response was due, for example a cancelled hedge or timeout.
+            if delayed.active():
+                delayed.cancel()
+        request.notifyFinish().addErrback(disconnected)
+        return server.NOT_DONE_YET
+
+class _QuietSite(server.Site):
+    """Site without an access log line for every request."""
+    def log(self, request):
+        pass
+
+def listen(reactor, node, port=0, interface="127.0.0.1"):
+    """Start serving a MockNode, port 0 picks a free port. Returns the node address to hand to RpcClient."""
+    site = _QuietSite(node)
+    site.noisy = False
+    listening = reactor.listenTCP(port, site, interface=interface)
+    return "http://%s:%d" % (interface, listening.getHost().port)
+
+def main():
+    import argparse
+    from twisted.internet import reactor
+    parser = argparse.ArgumentParser(description="Fake Steem JSON-RPC node serving synthetic blocks.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--interface", default="127.0.0.1")
+    parser.add_argument("--head-block", type=int, default=20000000)
+    parser.add_argument("--block-interval", type=float, default=3)
+    parser.add_argument("--no-advance", action="store_true", help="Keep the head block where it is.")
+    parser.add_argument("--transactions", type=int, default=20, help="Transactions per synthetic block.")
+    parser.add_argument("--archive", default=None, help="Serve the blocks from an archive written by ArchiveWriter.")
+    parser.add_argument("--no-batch", action="store_true", help="Refuse JSON-RPC batches.")
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--jitter", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--garbage-rate", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    node = MockNode(reactor,
+                    head_block=args.head_block,
+                    block_interval=args.block_interval,
+                    advance=not args.no_advance,
+                    transactions=args.transactions,
+                    blocks=args.archive,
+                    batch=not args.no_batch,
+                    latency=args.latency,
+                    jitter=args.jitter,
+                    error_rate=args.error_rate,
+                    garbage_rate=args.garbage_rate,
+                    seed=args.seed)
+    address = listen(reactor, node, args.port, args.interface)
+    print("Mock node listening on", address)
+    sys.stdout.flush()
+    reactor.run()
+
+if __name__ == "__main__":
+    main()
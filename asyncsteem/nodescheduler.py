@@ -0,0 +1,160 @@
+"""Latency and health based scoring of JSON-RPC API nodes."""
+import time
+
+class _NodeState(object):
+    """Helper class holding the health statistics of a single API node."""
+    def __init__(self, name):
+        self.name = name
+        self.latency = None            #Exponentially weighted moving average of the response time in seconds.
+        self.error_rate = 0.0          #Exponentially weighted moving average of failures, 0.0 is healthy, 1.0 is always failing.
+        self.consecutive_errors = 0
+        self.head_block = None         #Last head block number reported by this node.
+        self.in_flight = 0             #Number of HTTPS POSTs currently outstanding at this node.
+        self.down_until = 0            #Time until which the node is out of rotation.
+        self.batch_capable = None      #True or False once we know if the node handles JSON-RPC batches.
+        self.batch_size = 2.0          #Current batch size limit, grown and shrunk AIMD style.
+
+class NodeScheduler(object):
+    """Class for picking the best API node to send the next batch to."""
+    def __init__(self, nodes, alpha=0.2, max_consecutive_errors=3, max_error_rate=0.5, down_time=30,
+                 max_batch_size=64, target_latency=3.0, max_response_bytes=8*1024*1024):
+        """Constructor
+
+        Args:
+            nodes : List of API node host names.
+            alpha : Weight of a new measurement in the moving averages.
+            max_consecutive_errors : Number of errors in a row after which a node is taken out of rotation.
+            max_error_rate : Error rate above which a node is taken out of rotation.
+            down_time : Seconds a failing node stays out of rotation if no probe finds it healthy again.
+            max_batch_size : Upper limit for adaptive batch sizes.
+            target_latency : Batch sizes only grow while responses come in faster than this many seconds.
+            max_response_bytes : Batch sizes only grow while responses are smaller than this.
+        """
+        self.alpha = alpha
+        self.max_consecutive_errors = max_consecutive_errors
+        self.max_error_rate = max_error_rate
+        self.down_time = down_time
+        self.max_batch_size = max_batch_size
+        self.target_latency = target_latency
+        self.max_response_bytes = max_response_bytes
+        self.nodes = dict()
+        self.order = list(nodes)
+        for node in nodes:
+            self.nodes[node] = _NodeState(node)
+    def _head(self):
+        heads = [state.head_block for state in self.nodes.values() if state.head_block != None]
+        if heads:
+            return max(heads)
+        return None
+    def score(self, node, head=None, default_latency=1.0):
+        """Return the score of a node, lower is better."""
+        state = self.nodes[node]
+        latency = state.latency if state.latency != None else default_latency
+        #Spread parallel requests, each outstanding request makes a node look slower.
+        score = latency * (1 + state.in_flight) * (1 + 4 * state.error_rate)
+        if head != None and state.head_block != None:
+            #A node lagging behind the head is only useful for old blocks, three seconds per block behind.
+            score = score + 3 * (head - state.head_block)
+        return score
+    def select(self, exclude=None):
+        """Return the best scoring node that is in rotation, or the node that comes back soonest if none is."""
+        now = time.time()
+        head = self._head()
+        known = [state.latency for state in self.nodes.values() if state.latency != None]
+        default_latency = sum(known) / len(known) if known else 1.0
+        best = None
+        best_score = None
+        for node in self.order:
+            if node == exclude or self.nodes[node].down_until > now:
+                continue
+            score = self.score(node, head, default_latency)
+            if best == None or score < best_score:
+                best = node
+                best_score = score
+        if best == None:
+            candidates = [node for node in self.order if node != exclude] or self.order
+            best = min(candidates, key=lambda node: self.nodes[node].down_until)
+        return best
+    def started(self, node):
+        """Register the start of an HTTPS POST to a node."""
+        self.nodes[node].in_flight = self.nodes[node].in_flight + 1
+    def succeeded(self, node, latency):
+        """Register a successful response and its latency."""
+        state = self.nodes[node]
+        state.in_flight = max(0, state.in_flight - 1)
+        self.measured(node, latency)
+    def abandoned(self, node):
+        """Register a request we cancelled ourselves, without counting it as success or failure."""
+        state = self.nodes[node]
+        state.in_flight = max(0, state.in_flight - 1)
+    def measured(self, node, latency):
+        """Register a healthy response that was not counted as in flight, such as a probe."""
+        state = self.nodes[node]
+        if state.latency == None:
+            state.latency = latency
+        else:
+            state.latency = (1 - self.alpha) * state.latency + self.alpha * latency
+        state.error_rate = (1 - self.alpha) * state.error_rate
+        state.consecutive_errors = 0
+    def failed(self, node, in_flight=True):
+        """Register a failed request, returns True if the node was taken out of rotation because of it."""
+        state = self.nodes[node]
+        if in_flight:
+            state.in_flight = max(0, state.in_flight - 1)
+        state.error_rate = (1 - self.alpha) * state.error_rate + self.alpha
+        state.consecutive_errors = state.consecutive_errors + 1
+        if state.down_until <= time.time() and \
+           (state.consecutive_errors >= self.max_consecutive_errors or state.error_rate > self.max_error_rate):
+            state.down_until = time.time() + self.down_time
+            return True
+        return False
+    def batch_size(self, node):
+        """Return the number of commands to put in the next batch for a node."""
+        state = self.nodes[node]
+        if state.batch_capable == False:
+            return 1
+        if state.batch_capable == None:
+            #Try a small batch first to find out if the node handles batches at all.
+            return min(2, self.max_batch_size)
+        return max(1, min(self.max_batch_size, int(state.batch_size)))
+    def batch_unsupported(self, node):
+        """Register that a node answered a batch with something other than a list of responses."""
+        self.nodes[node].batch_capable = False
+        self.nodes[node].batch_size = 1.0
+    def batch_done(self, node, size, ok, latency=None, response_bytes=0):
+        """Grow the batch size of a node by one on fast, small, successful responses, halve it on anything else."""
+        state = self.nodes[node]
+        if ok and size > 1:
+            state.batch_capable = True
+        if ok and latency < self.target_latency and response_bytes < self.max_response_bytes:
+            if size >= int(state.batch_size):
+                #Only grow if the batch was actually limited by the current size.
+                state.batch_size = min(self.max_batch_size, state.batch_size + 1)
+        else:
+            state.batch_size = max(1.0, state.batch_size / 2)
+    def report_head(self, node, head_block):
+        """Register the head block number as reported by a node."""
+        self.nodes[node].head_block = head_block
+    def is_down(self, node):
+        """Check if a node is currently out of rotation."""
+        return self.nodes[node].down_until > time.time()
+    def revive(self, node):
+        """Put a node that responded to a probe back into rotation."""
+        state = self.nodes[node]
+        state.down_until = 0
+        state.consecutive_errors = 0
+        state.error_rate = state.error_rate / 2
+    def stats(self):
+        """Return a dict with per node statistics."""
+        result = dict()
+        head = self._head()
+        for node in self.order:
+            state = self.nodes[node]
+            result[node] = {"latency" : state.latency,
+                            "error_rate" : state.error_rate,
+                            "in_flight" : state.in_flight,
+                            "head_lag" : (head - state.head_block) if head != None and state.head_block != None else None,
+                            "down" : self.is_down(node),
+                            "batch_capable" : state.batch_capable,
+                            "batch_size" : self.batch_size(node)}
+        return result
@@ -0,0 +1,131 @@
+"""Running the handlers of a slow bot in a thread pool, so it does not hold back the block stream for the other bots."""
+import time
+import threading
+from twisted.internet import defer, threads
+from twisted.python import failure
+
+class _ThreadEntry(object):
+    """Helper class for a call made from a handler thread, mirroring the on_result/on_error interface of RpcClient.
+
+    The callbacks run in the thread pool too, one at a time with the handlers of the same bot.
+    """
+    def __init__(self, client, command):
+        self.client = client
+        self.command = command
+        self.lock = threading.Lock()
+        self.result_callback = None
+        self.error_callback = None
+        self.outcome = None    #Result or error that came in before its callback was set.
+    def on_result(self, callback):
+        """Set the on_result callback"""
+        self._set_callback("result", callback)
+    def on_error(self, callback):
+        """Set the on_error callback"""
+        self._set_callback("error", callback)
+    def _set_callback(self, kind, callback):
+        with self.lock:
+            if kind == "result":
+                self.result_callback = callback
+            else:
+                self.error_callback = callback
+            outcome = self.outcome
+            if outcome != None and outcome[0] == kind:
+                self.outcome = None
+        if outcome != None and outcome[0] == kind:
+            #The reply beat us to it, hand it over now.
+            self.client.reactor.callFromThread(self.client.offloaded.run, kind, callback, *(outcome[1:] + (self.client,)))
+    def _deliver(self, kind, *args):
+        """Hand a result or error to its callback, called from the reactor thread."""
+        with self.lock:
+            callback = self.result_callback if kind == "result" else self.error_callback
+            if callback == None:
+                self.outcome = (kind,) + args
+                return
+        self.client.offloaded.run(kind, callback, *(args + (self.client,)))
+
+class ThreadSafeClient(object):
+    """Stand-in for the RpcClient handed to the handlers of a bot running in a thread pool.
+
+    Calls are forwarded to the RpcClient on the reactor thread, and their results are handed back in the thread pool.
+    """
+    def __init__(self, reactor, rpc, offloaded):
+        self.reactor = reactor
+        self.rpc = rpc
+        self.offloaded = offloaded
+    def _forward(self, name, args, entry):
+        """Queue a call with the RpcClient, called from the reactor thread."""
+        real = getattr(self.rpc, name)(*args)
+        if real == None:
+            entry._deliver("error", -1, "Call could not be queued")
+            return
+        real.on_result(lambda result, client: entry._deliver("result", result))
+        real.on_error(lambda errno, msg, client: entry._deliver("error", errno, msg))
+        self.rpc()
+    def __call__(self):
+        #Calls are sent as soon as they are forwarded.
+        pass
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        def forward(*args):
+            """Forward a call to the reactor thread and return a handle for setting callbacks on."""
+            entry = _ThreadEntry(self, name)
+            self.reactor.callFromThread(self._forward, name, args, entry)
+            return entry
+        return forward
+    def __eq__(self, val):
+        if val is None:
+            return False
+        return True
+
+class OffloadedBot(object):
+    """Runs the handlers and RPC callbacks of a single bot in a thread pool, one at a time and in order."""
+    def __init__(self, reactor, pool, rpc, botname, log, on_timed=None):
+        """Constructor
+
+        Args:
+            reactor : The Twisted reactor.
+            pool : Started twisted.python.threadpool.ThreadPool to run the handlers in.
+            rpc : The RpcClient the bot's queries go to.
+            botname : Name of the bot, used in log messages.
+            log : The Twisted asynchonous logger.
+            on_timed : Optional callable taking an event name and the wall time of a handler call, called in the reactor thread.
+        """
+        self.reactor = reactor
+        self.on_timed = on_timed
+        self.pool = pool
+        self.botname = botname
+        self.log = log
+        self.client = ThreadSafeClient(reactor, rpc, self)
+        self.tail = defer.succeed(None)   #Every call is chained onto this Deferred, so they run one at a time.
+        self.pending = 0                  #Calls queued or running.
+        self.blocks = 0                   #Blocks with handler calls queued or running.
+    def run(self, event, func, *args):
+        """Queue a call of func(*args) in the thread pool, after all calls queued before it."""
+        self.pending = self.pending + 1
+        def call(ignored):
+            return threads.deferToThreadPool(self.reactor, self.pool, func, *args)
+        def done(result):
+            self.pending = self.pending - 1
+            if isinstance(result, failure.Failure):
+                self.log.failure("Error in bot '{bot!r}' processing '{op!r}' event.",result,bot=self.botname, op=event)
+        self.tail.addCallback(call)
+        self.tail.addBoth(done)
+    def end_block(self):
+        """Mark the end of the handler calls for a block."""
+        self.blocks = self.blocks + 1
+        def block_done(ignored):
+            self.blocks = self.blocks - 1
+        self.tail.addCallback(block_done)
+    def handle(self, event, handler, ts, obj):
+        """Queue a handler invocation."""
+        if self.on_timed == None:
+            self.run(event, handler, ts, obj, self.client)
+            return
+        def timed():
+            start = time.time()
+            try:
+                return handler(ts, obj, self.client)
+            finally:
+                self.reactor.callFromThread(self.on_timed, event, time.time() - start)
+        self.run(event, timed)
@@ -0,0 +1,71 @@
+"""In-memory TTL/LRU cache for results of read-only JSON-RPC calls."""
+import time
+import copy
+import collections
+from .timestamps import parse_timestamp
+
+#Blocks older than this many seconds are considered irreversible even if we don't know the last irreversible block number.
+IRREVERSIBLE_AGE = 3600
+
+class ResultCache(object):
+    """Class holding results of read-only JSON-RPC calls with per method expiry policies.
+
+    Results are copied on the way in and on the way out, so callers are free to modify the results they get.
+    """
+    def __init__(self, policies=None, max_entries=10000):
+        """Constructor
+
+        Args:
+            policies : Dict mapping method names to a policy. A policy is a number of seconds to keep a result, None to keep it
+                       until it is pushed out, or a callable taking the call arguments and the result and returning one of those
+                       or False for results that should not be cached. The "irreversible" policy keeps get_block results of
+                       irreversible blocks only. Methods without a policy are not cached.
+            max_entries : Maximum number of results kept, the least recently used ones are dropped first.
+        """
+        self.policies = dict(policies) if policies != None else dict()
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()  #Key to (expiry time or None, result).
+        self.hits = 0
+        self.misses = 0
+        self.last_irreversible_block = 0  #Kept up to date by the RpcClient using this cache.
+    def caches(self, method):
+        """Check if there is a policy for a method."""
+        return method in self.policies
+    def get(self, key):
+        """Look up a result, returns a (found, result) tuple."""
+        item = self.entries.get(key)
+        if item != None:
+            expires, result = item
+            if expires == None or expires > time.time():
+                self.entries.move_to_end(key)
+                self.hits = self.hits + 1
+                return True, copy.deepcopy(result)
+            del self.entries[key]
+        self.misses = self.misses + 1
+        return False, None
+    def put(self, key, method, args, result):
+        """Store a result according to the policy for its method."""
+        if not method in self.policies:
+            return
+        ttl = self.policies[method]
+        if ttl == "irreversible":
+            ttl = self._irreversible_block(args, result)
+        elif callable(ttl):
+            ttl = ttl(args, result)
+        if ttl != None and ttl <= 0:
+            #False or a zero ttl, don't cache this one.
+            return
+        self.entries[key] = (time.time() + ttl if ttl != None else None, copy.deepcopy(result))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+    def _irreversible_block(self, args, result):
+        """Keep a block forever if it is irreversible, don't cache it otherwise."""
+        if result == None or not "timestamp" in result:
+            return False
+        if int(args[0]) <= self.last_irreversible_block or time.time() - parse_timestamp(result["timestamp"]) > IRREVERSIBLE_AGE:
+            return None
+        return False
+    def stats(self):
+        """Return hit and miss counters."""
+        return {"hits" : self.hits, "misses" : self.misses, "entries" : len(self.entries)}
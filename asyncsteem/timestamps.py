@@ -0,0 +1,36 @@
+"""Fast decoding of the fixed format "%Y-%m-%dT%H:%M:%S" timestamps used in blocks."""
+import calendar
+import datetime
+import dateutil.parser
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_DAY_CACHE_SIZE = 64
+_day_cache = dict()   #Date part of a timestamp to epoch seconds at midnight of that day.
+
+def _is_fixed_format(timestamp):
+    return len(timestamp) == 19 and timestamp[4] == "-" and timestamp[7] == "-" and timestamp[10] == "T" and \
+           timestamp[13] == ":" and timestamp[16] == ":"
+
+def parse_timestamp(timestamp):
+    """Convert a block timestamp to integer seconds since the epoch, timestamps are in UTC."""
+    if _is_fixed_format(timestamp):
+        day = _day_cache.get(timestamp[:10])
+        if day == None:
+            #New date, a day worth of blocks will hit the cache from here on.
+            day = calendar.timegm((int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]), 0, 0, 0))
+            if len(_day_cache) >= _DAY_CACHE_SIZE:
+                _day_cache.clear()
+            _day_cache[timestamp[:10]] = day
+        return day + int(timestamp[11:13]) * 3600 + int(timestamp[14:16]) * 60 + int(timestamp[17:19])
+    #Not the format we expected, let the generic parser have a go at it.
+    return datetime_to_epoch(dateutil.parser.parse(timestamp))
+
+def datetime_to_epoch(ddt):
+    """Convert a date or datetime to integer seconds since the epoch, naive values are taken to be UTC."""
+    if hasattr(ddt, "utctimetuple"):
+        return calendar.timegm(ddt.utctimetuple())
+    return calendar.timegm(ddt.timetuple())
+
+def epoch_to_datetime(seconds):
+    """Convert seconds since the epoch to a naive UTC datetime."""
+    return _EPOCH + datetime.timedelta(seconds=seconds)
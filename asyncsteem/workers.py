@@ -0,0 +1,294 @@
+"""Worker processes hosting bots, fed with blocks by the parent over line delimited JSON on stdin and stdout.
+
+Workers are started by ActiveBlockChain, running main() from this module.
+"""
+import os
+import sys
+import importlib
+import collections
+from twisted.internet import protocol
+from twisted.protocols.basic import LineReceiver
+from .dispatcher import BlockDispatcher
+from .codec import default_codec
+
+#Blocks are sent as a single line, so lines can get long.
+MAX_LINE_LENGTH = 256*1024*1024
+
+def load_factory(path):
+    """Import a "package.module:callable" path and return the callable."""
+    modulename, _, name = path.partition(":")
+    obj = importlib.import_module(modulename)
+    for part in name.split("."):
+        obj = getattr(obj, part)
+    return obj
+
+def encode_filters(filters):
+    """Make operation filters JSON serializable, tuple keys become "|" separated field names and sets become lists."""
+    if filters == None:
+        return None
+    result = dict()
+    for event, spec in filters.items():
+        result[event] = dict()
+        for fields, condition in spec.items():
+            if isinstance(condition, (set, frozenset, tuple)):
+                condition = list(condition)
+            result[event]["|".join(fields) if isinstance(fields, tuple) else fields] = condition
+    return result
+
+def decode_filters(filters):
+    """Turn operation filters encoded by encode_filters back into filters for register_bot."""
+    if filters == None:
+        return None
+    return dict((event, dict((tuple(fields.split("|")) if "|" in fields else fields, condition)
+                             for fields, condition in spec.items()))
+                for event, spec in filters.items())
+
+class _LineSplitter(LineReceiver):
+    """Helper class splitting a byte stream from a worker process into lines and handing each line to a callback."""
+    delimiter = b"\n"
+    MAX_LENGTH = MAX_LINE_LENGTH
+    def __init__(self, on_line, log):
+        self.on_line = on_line
+        self.log = log
+    def lineReceived(self, line):
+        self.on_line(line)
+    def lineLengthExceeded(self, line):
+        self.log.error("Dropping message of {size!r} bytes from worker pipe, too long.",size=len(line))
+
+class _ProxyEntry(object):
+    """Helper class for a call forwarded to the parent process, mirroring the on_result/on_error interface of RpcClient."""
+    def __init__(self, proxy, command, arguments, cmd_id, log):
+        self.proxy = proxy
+        self.command = command
+        self.arguments = arguments
+        self.cmd_id = cmd_id
+        self.result_callback = None
+        self.error_callback = None
+        self.log = log
+    def on_result(self, callback):
+        """Set the on_result callback"""
+        self.result_callback = callback
+    def on_error(self, callback):
+        """Set the on_error callback"""
+        self.error_callback = callback
+    def _handle_result(self, result):
+        if self.result_callback != None:
+            try:
+                self.result_callback(result, self.proxy)
+            except Exception as ex:
+                self.log.failure("Error in result handler for '{cmd!r}'.",cmd=self.command)
+    def _handle_error(self, errno, msg):
+        if self.error_callback != None:
+            try:
+                self.error_callback(errno, msg, self.proxy)
+            except Exception as ex:
+                self.log.failure("Error in error handler for '{cmd!r}'.",cmd=self.command)
+        else:
+            self.log.error("Error {errno!r} in '{cmd!r}' : {msg!r}",errno=errno, cmd=self.command, msg=msg)
+
+class RpcProxy(object):
+    """Stand-in for the RpcClient inside a worker, calls are forwarded to the RpcClient of the parent process."""
+    def __init__(self, send, log):
+        self.send = send
+        self.log = log
+        self.cmd_seq = 0
+        self.entries = dict()   #Forwarded calls waiting for their result, keyed by sequence number.
+    def _reply(self, message):
+        """Hand a result or error from the parent to the call it belongs to."""
+        entry = self.entries.pop(message.get("id"), None)
+        if entry == None:
+            self.log.error("Reply for unknown forwarded call {rid!r}",rid=message.get("id"))
+        elif message["type"] == "result":
+            entry._handle_result(message.get("result"))
+        else:
+            entry._handle_error(message.get("code"), message.get("message"))
+    def __call__(self):
+        #The parent process runs the command queue.
+        pass
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        def forward(*args):
+            """Forward a call to the parent process and return a handle for setting callbacks on."""
+            self.cmd_seq = self.cmd_seq + 1
+            entry = _ProxyEntry(self, name, args, self.cmd_seq, self.log)
+            self.entries[self.cmd_seq] = entry
+            self.send({"type" : "call", "id" : self.cmd_seq, "method" : name, "params" : list(args)})
+            return entry
+        return forward
+    def __eq__(self, val):
+        if val is None:
+            return False
+        return True
+
+class WorkerDispatcher(BlockDispatcher):
+    """Dispatcher inside a worker process, handling the messages from the parent."""
+    def __init__(self, log, send, zero_copy=False):
+        BlockDispatcher.__init__(self, log, zero_copy)
+        self.send = send
+        self.rpc = RpcProxy(send, log)
+        self.ready = collections.deque()
+        self.draining = False
+    def handle(self, message):
+        """Handle a single message from the parent."""
+        try:
+            kind = message.get("type")
+            if kind == "block":
+                self.ready.append((message["block_num"], message["block"]))
+                self._drain()
+            elif kind == "result" or kind == "error":
+                self.rpc._reply(message)
+            elif kind == "bot":
+                bot = load_factory(message["factory"])(*message.get("args", []))
+                self.register_bot(bot, message["name"], message.get("await_deferreds", False), decode_filters(message.get("filters")))
+            elif kind == "unregister":
+                self.unregister_bot(message["name"])
+            else:
+                self.log.error("Unknown message type from parent : {kind!r}",kind=kind)
+        except Exception as ex:
+            self.log.failure("Error in WorkerDispatcher::handle : {err!r}",err=str(ex))
+    def _drain(self):
+        """Process the received blocks in order, telling the parent about each one processed."""
+        if self.draining:
+            return
+        self.draining = True
+        try:
+            while self.ready and self.awaiting == 0:
+                blockno, blk = self.ready.popleft()
+                self._process_block(blk)
+                self.send({"type" : "done", "block_num" : blockno})
+        finally:
+            self.draining = False
+
+class _WorkerProtocol(LineReceiver):
+    """Worker side of the pipe to the parent, running on stdin and stdout."""
+    delimiter = b"\n"
+    MAX_LENGTH = MAX_LINE_LENGTH
+    def __init__(self, reactor, log, zero_copy):
+        self.reactor = reactor
+        self.log = log
+        self.dispatcher = WorkerDispatcher(log, self.send_message, zero_copy)
+    def send_message(self, message):
+        self.sendLine(default_codec.dumps(message))
+    def lineReceived(self, line):
+        self.dispatcher.handle(default_codec.loads(line))
+    def lineLengthExceeded(self, line):
+        self.log.error("Dropping message of {size!r} bytes from parent, too long.",size=len(line))
+    def connectionLost(self, reason):
+        #The parent closed our stdin, we are done.
+        if self.reactor.running:
+            self.reactor.stop()
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """Parent side of a worker process, forwarding the RPC calls of its bots to the parent RpcClient."""
+    def __init__(self, index, rpc, log, on_done=None, on_ended=None):
+        """Constructor
+
+        Args:
+            index : Number of the worker, used in log messages.
+            rpc : The RpcClient to forward calls from the bots in the worker to.
+            log : The Twisted asynchonous logger.
+            on_done : Optional callable, called each time the worker has processed a block.
+            on_ended : Optional callable taking this WorkerProcess, called when the worker process has ended.
+        """
+        self.index = index
+        self.rpc = rpc
+        self.log = log
+        self.on_done = on_done
+        self.on_ended = on_ended
+        self.lines = _LineSplitter(self._message_line, log)
+        self.errors = _LineSplitter(self._stderr_line, log)
+        self.pending = list()     #Lines written before the process was started.
+        self.outstanding = 0      #Blocks sent to the worker that it has not processed yet.
+        self.ended = False
+    def connectionMade(self):
+        for line in self.pending:
+            self.transport.write(line)
+        self.pending = list()
+    def send(self, message):
+        """Send a single message to the worker."""
+        self.write_line(default_codec.dumps(message) + b"\n")
+    def write_line(self, line):
+        """Send an already encoded, newline terminated, message to the worker."""
+        if self.ended:
+            return
+        if self.transport == None:
+            self.pending.append(line)
+        else:
+            self.transport.write(line)
+    def childDataReceived(self, childFD, data):
+        if childFD == 1:
+            self.lines.dataReceived(data)
+        else:
+            self.errors.dataReceived(data)
+    def _stderr_line(self, line):
+        self.log.info("Worker {index!r}: {line}",index=self.index, line=line.decode("utf-8","replace"))
+    def _message_line(self, line):
+        """Handle a single message line from the worker."""
+        try:
+            message = default_codec.loads(line)
+            kind = message.get("type")
+            if kind == "call":
+                self._forward(message["id"], message["method"], message.get("params", []))
+            elif kind == "done":
+                self.outstanding = self.outstanding - 1
+                if self.on_done != None:
+                    self.on_done()
+            else:
+                self.log.error("Unknown message type from worker {index!r} : {kind!r}",index=self.index, kind=kind)
+        except Exception as ex:
+            self.log.failure("Error in WorkerProcess::_message_line : {err!r}",err=str(ex))
+    def _forward(self, cmd_id, method, params):
+        """Queue a call from a bot in the worker with the parent RpcClient and send its result back."""
+        def on_result(result, client):
+            self.send({"type" : "result", "id" : cmd_id, "result" : result})
+        def on_error(errno, msg, client):
+            self.send({"type" : "error", "id" : cmd_id, "code" : errno, "message" : msg})
+        entry = getattr(self.rpc, method)(*params)
+        if entry == None:
+            on_error(-1, "Call could not be queued", None)
+            return
+        entry.on_result(on_result)
+        entry.on_error(on_error)
+        self.rpc()
+    def stop(self):
+        """Close the stdin of the worker, making it exit once it has processed everything sent to it."""
+        if self.transport != None and not self.ended:
+            self.transport.closeStdin()
+    def processEnded(self, reason):
+        self.ended = True
+        self.log.error("Worker {index!r} ended : {reason!r}",index=self.index, reason=reason.getErrorMessage())
+        #The blocks it didn't get to will never be processed, don't let them hold back flow control.
+        self.outstanding = 0
+        try:
+            if self.on_ended != None:
+                self.on_ended(self)
+            if self.on_done != None:
+                self.on_done()
+        except Exception as ex:
+            self.log.failure("Error in WorkerProcess::processEnded : {err!r}",err=str(ex))
+
+def spawn_workers(reactor, count, rpc, log, zero_copy=False, on_done=None, on_ended=None):
+    """Start count worker processes running this module with the current interpreter, returns their WorkerProcess objects."""
+    env = dict(os.environ)
+    #Let the workers import the same modules, including the ones with the bot factories.
+    env["PYTHONPATH"] = os.pathsep.join([path if path else os.getcwd() for path in sys.path])
+    #Not "-m asyncsteem.workers", the package imports this module before runpy would run it as __main__.
+    args = [sys.executable, "-c", "from asyncsteem.workers import main; main()"]
+    if zero_copy:
+        args.append("--zero-copy")
+    workers = list()
+    for index in range(0, count):
+        worker = WorkerProcess(index, rpc, log, on_done, on_ended)
+        reactor.spawnProcess(worker, sys.executable, args, env=env)
+        workers.append(worker)
+    return workers
+
+def main():
+    from twisted.internet import reactor, stdio
+    from twisted.logger import Logger, globalLogBeginner, textFileLogObserver
+    #Our stdout is the pipe to the parent, log to stderr so the parent can pass it on.
+    globalLogBeginner.beginLoggingTo([textFileLogObserver(sys.stderr)], redirectStandardIO=False)
+    log = Logger(namespace="asyncsteem.workers")
+    stdio.StandardIO(_WorkerProtocol(reactor, log, "--zero-copy" in sys.argv[1:]))
+    reactor.run()
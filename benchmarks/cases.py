@@ -0,0 +1,162 @@
+"""Benchmark cases, each one a function taking the quick flag and returning a dict of metric name to value.
+
+Every case runs in a fresh process started by run.py, as the Twisted reactor can only be run once and peak memory
+is measured for the whole process.
+"""
+import os
+import sys
+import time
+import resource
+import tempfile
+import datetime
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from twisted.logger import Logger
+from asyncsteem import ActiveBlockChain, DateFinder, RpcClient
+from asyncsteem.dispatcher import BlockDispatcher
+from asyncsteem.blocksource import ArchiveWriter, ArchiveBlockSource
+from asyncsteem.mocknode import MockNode, listen
+
+#Keep log output from skewing the numbers.
+log = Logger(observer=lambda event: None, namespace="benchmark")
+
+def _percentile(values, fraction):
+    """Return a percentile of a sorted list."""
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class _CountingBot(object):
+    """Bot doing a little work for the most common events."""
+    def __init__(self):
+        self.count = 0
+    def block(self, tm, event, client):
+        self.count = self.count + 1
+    def vote(self, tm, event, client):
+        if event["weight"] < 0:
+            self.count = self.count + 1
+    def comment(self, tm, event, client):
+        self.count = self.count + len(event["body"])
+    def transfer(self, tm, event, client):
+        self.count = self.count + 1
+    def custom_json(self, tm, event, client):
+        self.count = self.count + 1
+
+def dispatch(quick):
+    """Blocks per second through _process_block for a number of bots, with and without zero copy events."""
+    count = 500 if quick else 3000
+    node = MockNode(None, advance=False)
+    blocks = [node.get_block(node.head_block - count + index) for index in range(0, count)]
+    results = dict()
+    for bots, zero_copy in ((1, False), (10, False), (10, True)):
+        dispatcher = BlockDispatcher(log, zero_copy)
+        dispatcher.rpc = None
+        for index in range(0, bots):
+            dispatcher.register_bot(_CountingBot(), "bot%d" % index)
+        start = time.time()
+        for blk in blocks:
+            dispatcher._process_block(blk)
+        name = "blocks_per_s_%dbots" % bots + ("_zero_copy" if zero_copy else "")
+        results[name] = count / (time.time() - start)
+    return results
+
+def rpc(quick):
+    """Calls per second and p50/p99 call latency through RpcClient, for several parallel/max_batch_size settings.
+
+    Calls are paced: parallel times max_batch_size calls are kept outstanding and every finished call issues the next
+    one, so latency is measured from about when a call goes out rather than including time spent queued behind the rest.
+    """
+    from twisted.internet import reactor
+    calls = 400 if quick else 3000
+    settings = ((4, 1), (16, 1), (16, 16), (8, 64))
+    node = MockNode(reactor, advance=False, transactions=5, latency=0.005, jitter=0.005)
+    address = listen(reactor, node)
+    results = dict()
+    def run(index):
+        if index == len(settings):
+            reactor.stop()
+            return
+        parallel, batch_size = settings[index]
+        client = RpcClient(reactor, log, nodes=[address], parallel=parallel, max_batch_size=batch_size)
+        latencies = list()
+        issued = [0]
+        requests = node.requests
+        start = time.time()
+        def done():
+            elapsed = time.time() - start
+            latencies.sort()
+            key = "p%d_b%d" % (parallel, batch_size)
+            results["calls_per_s_" + key] = calls / elapsed
+            results["requests_per_s_" + key] = (node.requests - requests) / elapsed
+            results["p50_ms_" + key] = _percentile(latencies, 0.5) * 1000
+            results["p99_ms_" + key] = _percentile(latencies, 0.99) * 1000
+            reactor.callLater(0, run, index + 1)
+        def issue():
+            sent = time.time()
+            def finished(*args):
+                latencies.append(time.time() - sent)
+                if len(latencies) == calls:
+                    done()
+                elif issued[0] < calls:
+                    issue()
+            cmd = client.get_block(node.head_block - issued[0])
+            issued[0] = issued[0] + 1
+            cmd.on_result(finished)
+            cmd.on_error(finished)
+        for offset in range(0, min(calls, parallel * batch_size)):
+            issue()
+        client()
+    reactor.callWhenRunning(run, 0)
+    reactor.run()
+    return results
+
+def datefinder(quick):
+    """Round trips and seconds DateFinder needs to locate the block of a day ago, bisecting and interpolating."""
+    from twisted.internet import reactor
+    node = MockNode(reactor, advance=False, transactions=5, latency=0.02)
+    address = listen(reactor, node)
+    results = dict()
+    modes = (("bisect", False), ("interpolate", True))
+    def run(index):
+        if index == len(modes):
+            reactor.stop()
+            return
+        name, interpolate = modes[index]
+        client = RpcClient(reactor, log, nodes=[address], max_batch_size=16)
+        finder = DateFinder(client, log, interpolate=interpolate)
+        requests = node.requests
+        start = time.time()
+        def found(blockno):
+            results["round_trips_" + name] = node.requests - requests
+            results["seconds_" + name] = time.time() - start
+            reactor.callLater(0, run, index + 1)
+        finder(found, datetime.datetime.utcnow() - datetime.timedelta(days=1))
+        client()
+    reactor.callWhenRunning(run, 0)
+    reactor.run()
+    return results
+
+def replay(quick):
+    """Blocks per second and peak memory replaying a day of blocks from an archive through ActiveBlockChain."""
+    from twisted.internet import reactor
+    count = 2880 if quick else 28800
+    node = MockNode(reactor, advance=False)
+    address = listen(reactor, node)
+    path = os.path.join(tempfile.mkdtemp(), "replay.jsonl")
+    writer = ArchiveWriter(path)
+    for blockno in range(node.head_block - count + 1, node.head_block + 1):
+        writer.write(blockno, node.get_block(blockno))
+    writer.close()
+    bots = [_CountingBot() for index in range(0, 10)]
+    start = time.time()
+    blockchain = ActiveBlockChain(reactor, log, nodes=[address], ordered=True, stop_when_empty=True,
+                                  block_source=ArchiveBlockSource(reactor, path))
+    for index in range(0, len(bots)):
+        blockchain.register_bot(bots[index], "bot%d" % index)
+    reactor.run()
+    elapsed = time.time() - start
+    os.remove(path)
+    os.rmdir(os.path.dirname(path))
+    return {"blocks_per_s" : count / elapsed,
+            #ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+            "peak_rss_mb" : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0)}
+
+BENCHMARKS = ["dispatch", "rpc", "datefinder", "replay"]
@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+"""Run the benchmark suite against a local mock node, write the results as JSON and compare them with a baseline.
+
+Usage:
+    python3 benchmarks/run.py                    Run everything and compare with benchmarks/baseline.json if it exists.
+    python3 benchmarks/run.py --quick rpc        Run a shorter version of the rpc benchmark only.
+    python3 benchmarks/run.py --save-baseline    Run everything and store the results as the new baseline.
+
+Every benchmark runs --repeat times and the median of each metric is reported. The exit code is 1 if any metric got
+worse than the baseline by more than its tolerance.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+#Metric name prefixes for which lower values are better, higher values are better for all other metrics.
+LOWER_IS_BETTER = ("p50_ms", "p99_ms", "round_trips", "seconds", "peak_rss_mb")
+
+#Allowed relative change per metric name prefix before it counts as a regression. Timings on a shared machine easily
+#swing 30% between identical runs, even as a median, round trips and memory use are far more stable.
+TOLERANCES = (("round_trips", 0.1),
+              ("peak_rss_mb", 0.25),
+              ("p99_ms", 1.0),
+              ("", 0.5))
+
+def tolerance_for(metric, override=None):
+    """Return the allowed relative change for a metric, override applies to all metrics if set."""
+    if override != None:
+        return override
+    for prefix, tolerance in TOLERANCES:
+        if metric.startswith(prefix):
+            return tolerance
+
+def median(values):
+    """Return the median of a list of numbers."""
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+def run_one(name, quick):
+    """Run a single benchmark in a fresh process, returns its metrics."""
+    args = [sys.executable, os.path.join(HERE, "run.py"), "--child", name]
+    if quick:
+        args.append("--quick")
+    output = subprocess.check_output(args)
+    #The child prints its metrics as JSON on the last line.
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+def run_repeated(name, quick, repeat):
+    """Run a single benchmark repeat times, returns the median of each metric."""
+    runs = [run_one(name, quick) for index in range(0, repeat)]
+    return dict((metric, median([run[metric] for run in runs if metric in run])) for metric in runs[0])
+
+def compare(results, baseline, tolerance=None):
+    """Print the change of every metric against the baseline, returns the list of regressions.
+
+    Args:
+        results : Dict of benchmark name to a dict of metric name to value.
+        baseline : Results to compare with, in the same form.
+        tolerance : Allowed relative change for all metrics, None for the per metric TOLERANCES.
+    """
+    regressions = list()
+    for name in sorted(results):
+        for metric in sorted(results[name]):
+            value = results[name][metric]
+            old = baseline.get(name, dict()).get(metric)
+            if old == None or old == 0:
+                print("  %-10s %-36s %12.3f" % (name, metric, value))
+                continue
+            change = (value - old) / old
+            allowed = tolerance_for(metric, tolerance)
+            worse = change > allowed if metric.startswith(LOWER_IS_BETTER) else change < -allowed
+            print("  %-10s %-36s %12.3f %12.3f %+8.1f%%%s" % (name, metric, value, old, change * 100, "  REGRESSION" if worse else ""))
+            if worse:
+                regressions.append((name, metric, old, value))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="asyncsteem benchmark suite")
+    parser.add_argument("benchmarks", nargs="*", help="Benchmarks to run, all of them by default.")
+    parser.add_argument("--quick", action="store_true", help="Shorter runs, for a quick check.")
+    parser.add_argument("--output", default=os.path.join(HERE, "results.json"), help="File to write the results to.")
+    parser.add_argument("--baseline", default=os.path.join(HERE, "baseline.json"), help="Baseline results to compare with.")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs of each benchmark to take the median of.")
+    parser.add_argument("--tolerance", type=float, default=None,
+                        help="Allowed relative change before a metric counts as a regression, per metric defaults if not set.")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child != None:
+        import cases
+        print(json.dumps(getattr(cases, args.child)(args.quick)))
+        return 0
+    import cases
+    names = args.benchmarks if args.benchmarks else cases.BENCHMARKS
+    for name in names:
+        if not name in cases.BENCHMARKS:
+            parser.error("Unknown benchmark %r, choose from %s" % (name, ", ".join(cases.BENCHMARKS)))
+    results = dict()
+    for name in names:
+        print("Running", name, "...")
+        sys.stdout.flush()
+        results[name] = run_repeated(name, args.quick, max(1, args.repeat))
+    report = {"time" : time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()),
+              "python" : platform.python_version(),
+              "platform" : platform.platform(),
+              "host" : platform.node(),
+              "quick" : args.quick,
+              "repeat" : max(1, args.repeat),
+              "results" : results}
+    with open(args.output, "w") as outfile:
+        json.dump(report, outfile, indent=2, sort_keys=True)
+    baseline = dict()
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as infile:
+            stored = json.load(infile)
+        if stored.get("quick") != args.quick:
+            print("NOTE: baseline was", "a quick run" if stored.get("quick") else "a full run", ", comparing anyway.")
+        if stored.get("host") != report["host"] or stored.get("platform") != report["platform"]:
+            #Timings only compare between runs on the same machine.
+            print("NOTE: baseline was taken on", stored.get("host"), "(" + str(stored.get("platform")) + "),",
+                  "store one for this machine with --save-baseline before comparing timings.")
+        baseline = stored["results"]
+        print("Results (current, baseline, change):")
+    else:
+        print("Results:")
+    regressions = compare(results, baseline, args.tolerance)
+    if args.save_baseline:
+        with open(args.baseline, "w") as outfile:
+            json.dump(report, outfile, indent=2, sort_keys=True)
+        print("Baseline written to", args.baseline)
+    if regressions:
+        print(len(regressions), "metric(s) regressed by more than their tolerance")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
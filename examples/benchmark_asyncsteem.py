@@ -38,9 +38,16 @@ class TestBot:
 obs = textFileLogObserver(io.open("benchmark_asyncsteem.log", "a"))
 print("NOTE: asyncsteem logging to benchmark_asyncsteem.log")
 log = Logger(observer=obs,namespace="asyncsteem")
-nl = "stage" #"bench_stage","bench1","bench2","bench3","bench4","bench5","bench6","bench7","bench8"]:
-print("Benchmarking a full day of blocks for",nl)
-bc = ActiveBlockChain(reactor,log=log,rewind_days=1,nodelist=nl)
+if len(sys.argv) > 1 and sys.argv[1] == "mock":
+    #Benchmark against a local fake node, so the numbers don't depend on the public API nodes.
+    from asyncsteem.mocknode import MockNode, listen
+    node = listen(reactor, MockNode(reactor, latency=0.02, jitter=0.02))
+    print("Benchmarking a full day of blocks for a local mock node")
+    bc = ActiveBlockChain(reactor,log=log,rewind_days=1,nodes=[node],max_batch_size=16)
+else:
+    nl = "stage" #"bench_stage","bench1","bench2","bench3","bench4","bench5","bench6","bench7","bench8"]:
+    print("Benchmarking a full day of blocks for",nl)
+    bc = ActiveBlockChain(reactor,log=log,rewind_days=1,nodelist=nl)
 tb = TestBot()
 bc.register_bot(tb,"benchmark")
 reactor.run()
@@ -0,0 +1,33 @@
+#!/usr/bin/python3
+"""Write the blocks of the last days to a block archive that ArchiveBlockSource can replay.
+
+Usage: export_archive.py <archive.jsonl.gz> [days] [hours]
+"""
+import sys
+sys.path.append('../')
+
+from twisted.internet import reactor
+from twisted.logger import Logger, textFileLogObserver
+from asyncsteem import ActiveBlockChain
+from asyncsteem.blocksource import ArchiveWriter
+
+log = Logger(observer=textFileLogObserver(sys.stderr))
+
+path = sys.argv[1]
+days = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+hours = int(sys.argv[3]) if len(sys.argv) > 3 else days * 24
+
+class ExportBot(object):
+    def __init__(self):
+        self.hours = 0
+    def hour(self,tm,event,client):
+        self.hours = self.hours + 1
+        print("Exported hour", self.hours, "of", hours, tm)
+        if self.hours >= hours:
+            reactor.stop()
+
+writer = ArchiveWriter(path)
+blockchain = ActiveBlockChain(reactor, log, rewind_days=days, ordered=True, archive=writer)
+blockchain.register_bot(ExportBot(),"export")
+reactor.run()
+print("Wrote", writer.count, "blocks to", path)
@@ -0,0 +1,40 @@
+"""Tests for merging get_accounts style lookups made within a short window in RpcClient."""
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from twisted.internet import task
+from twisted.logger import Logger
+from asyncsteem import RpcClient
+
+class _Clock(task.Clock):
+    """Clock that also takes system event triggers, as RpcClient registers one."""
+    def addSystemEventTrigger(self, phase, event, callable, *args):
+        pass
+
+class AggregationTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = _Clock()
+        self.client = RpcClient(self.clock, Logger(observer=lambda event: None), nodes=["http://127.0.0.1:1"],
+                                aggregate_window=0.05)
+        #Keep the merged calls in the queue instead of sending them.
+        self.client.parallel = 0
+    def test_merged_count(self):
+        for names in (["alice"], ["bob", "alice"], ["carol"]):
+            self.client.get_accounts(names)
+        #The first call opens the window, the other two are merged into it.
+        self.assertEqual(self.client.cache_stats()["aggregated"], 2)
+        self.clock.advance(0.1)
+        self.client.get_accounts(["dave"])
+        self.assertEqual(self.client.cache_stats()["aggregated"], 2)
+    def test_merged_call(self):
+        for names in (["alice"], ["bob", "alice"], ["carol"]):
+            self.client.get_accounts(names)
+        self.clock.advance(0.1)
+        entries = list(self.client.entries.values())
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0].arguments, (["alice", "bob", "carol"],))
+
+if __name__ == "__main__":
+    unittest.main()
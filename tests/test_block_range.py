@@ -0,0 +1,112 @@
+"""Tests for catching up with get_block_range in ActiveBlockChain, against a local mock node.
+
+Each scenario runs in a fresh process, as the Twisted reactor can only be run once.
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+#Seconds a scenario may take before we call it stuck.
+TIMEOUT = 15
+
+def _scenario(name):
+    """Rewind a day on a slow chain and catch up with get_block_range, called in the child process.
+
+    Prints the delivered block numbers and call counts as JSON once the head is reached.
+    """
+    import resource
+    resource.setrlimit(resource.RLIMIT_AS, (1 << 30, 1 << 30))
+    from twisted.internet import reactor
+    from twisted.logger import Logger
+    from asyncsteem import ActiveBlockChain
+    from asyncsteem.blockcache import BlockCache
+    from asyncsteem.mocknode import MockNode, listen
+    log = Logger(observer=lambda event: None, namespace="test")
+    #Ten minutes between blocks keeps a day of blocks small.
+    node = MockNode(reactor, block_interval=600, transactions=1)
+    outcome = {"blocks" : list(), "get_block" : 0, "get_block_range" : 0}
+    get_block = node.methods["get_block"]
+    get_block_range = node.methods["get_block_range"]
+    def counted_get_block(blockno):
+        outcome["get_block"] = outcome["get_block"] + 1
+        return get_block(blockno)
+    def counted_get_block_range(params):
+        outcome["get_block_range"] = outcome["get_block_range"] + 1
+        if name == "retry" and outcome["get_block_range"] <= 3:
+            raise RuntimeError("Node too busy")
+        return get_block_range(params)
+    node.methods["get_block"] = counted_get_block
+    node.methods["get_block_range"] = counted_get_block_range
+    if name == "unsupported":
+        del node.methods["get_block_range"]
+    address = listen(reactor, node)
+    cachedir = None
+    cache = None
+    if name == "cache":
+        cachedir = tempfile.mkdtemp()
+        cache = BlockCache(cachedir)
+    blockchain = ActiveBlockChain(reactor, log, nodes=[address], rewind_days=1, range_size=10, range_parallel=4,
+                                  block_cache=cache)
+    class Bot(object):
+        def block(self, tm, event, client):
+            outcome["blocks"].append(int(event["block_id"][:8], 16))
+    blockchain.register_bot(Bot(), "bot")
+    def check():
+        if outcome["blocks"] and max(outcome["blocks"]) >= node.head():
+            outcome["head"] = node.head()
+            outcome["last_block"] = blockchain.last_block
+            if cache != None:
+                outcome["cached"] = len(cache)
+            reactor.stop()
+        else:
+            reactor.callLater(0.1, check)
+    reactor.callLater(0.1, check)
+    reactor.callLater(TIMEOUT, reactor.stop)
+    reactor.run()
+    if cachedir != None:
+        cache.close()
+        shutil.rmtree(cachedir)
+    print(json.dumps(outcome))
+
+def run_scenario(name):
+    """Run a scenario in a child process and return its outcome."""
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child", name], timeout=TIMEOUT + 30)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+class BlockRangeTest(unittest.TestCase):
+    def check_caught_up(self, outcome):
+        self.assertIn("head", outcome)
+        #Polling with get_block after the fall back may hand out blocks out of order.
+        blocks = sorted(outcome["blocks"])
+        self.assertEqual(blocks, list(range(blocks[0], outcome["head"] + 1)))
+        self.assertGreaterEqual(outcome["last_block"], outcome["head"])
+
+    def test_retry_after_error(self):
+        #Errors other than an unknown method don't make it give up on get_block_range.
+        outcome = run_scenario("retry")
+        self.check_caught_up(outcome)
+        self.assertGreater(outcome["get_block_range"], 3)
+        self.assertLess(outcome["get_block"], len(outcome["blocks"]) // 2)
+
+    def test_fall_back_when_unsupported(self):
+        outcome = run_scenario("unsupported")
+        self.check_caught_up(outcome)
+        self.assertGreaterEqual(outcome["get_block"], len(outcome["blocks"]))
+
+    def test_irreversible_blocks_are_cached(self):
+        outcome = run_scenario("cache")
+        self.check_caught_up(outcome)
+        self.assertGreater(outcome["cached"], len(outcome["blocks"]) // 2)
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--child":
+        _scenario(sys.argv[2])
+    else:
+        unittest.main()
@@ -0,0 +1,79 @@
+"""Tests for the on-disk cache of irreversible blocks."""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+from asyncsteem.blockcache import BlockCache
+
+def _block(blockno):
+    return {"block_id" : "%08x" % blockno + "00" * 16, "timestamp" : "2018-01-01T00:00:00", "transactions" : []}
+
+class BlockCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = BlockCache(self.path)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.path)
+
+    def reopen(self, **kwargs):
+        self.cache.close()
+        self.cache = BlockCache(self.path, **kwargs)
+
+    def test_put_and_get(self):
+        self.cache.put(10, _block(10))
+        self.assertEqual(self.cache.get(10), _block(10))
+        self.assertEqual(self.cache.get(11), None)
+        self.assertIn(10, self.cache)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_duplicate_put_is_ignored(self):
+        self.cache.put(10, _block(10))
+        self.cache.put(10, {"other" : True})
+        self.assertEqual(self.cache.get(10), _block(10))
+        self.assertEqual(len(self.cache), 1)
+
+    def test_survives_reopen(self):
+        for blockno in range(1, 50):
+            self.cache.put(blockno, _block(blockno))
+        self.reopen()
+        self.assertEqual(len(self.cache), 49)
+        self.assertEqual(self.cache.get(25), _block(25))
+        #Appending after a reopen must not clobber the existing blocks.
+        self.cache.put(50, _block(50))
+        self.assertEqual(self.cache.get(1), _block(1))
+        self.assertEqual(self.cache.get(50), _block(50))
+
+    def test_new_segments(self):
+        self.reopen(segment_size=500)
+        for blockno in range(1, 30):
+            self.cache.put(blockno, _block(blockno))
+        self.assertGreater(self.cache.segment, 0)
+        self.reopen(segment_size=500)
+        for blockno in range(1, 30):
+            self.assertEqual(self.cache.get(blockno), _block(blockno))
+
+    def test_torn_write_is_dropped(self):
+        for blockno in range(1, 4):
+            self.cache.put(blockno, _block(blockno))
+        self.cache.close()
+        #A crash halfway through writing an index record, and a record pointing past the end of its segment.
+        with open(os.path.join(self.path, "index.dat"), "ab") as indexfile:
+            indexfile.write(b"\x01\x02\x03")
+        segment = os.path.join(self.path, "segment-000000.dat")
+        with open(segment, "r+b") as segfile:
+            segfile.truncate(os.path.getsize(segment) - 5)
+        self.cache = BlockCache(self.path)
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.get(2), _block(2))
+        self.assertNotIn(3, self.cache)
+        self.assertEqual(os.path.getsize(os.path.join(self.path, "index.dat")) % 24, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+"""Tests for coalescing identical read-only calls in RpcClient, against a local mock node.
+
+Each scenario runs in a fresh process, as the Twisted reactor can only be run once.
+"""
+import os
+import sys
+import json
+import unittest
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+#Seconds a scenario may take before we call it stuck.
+TIMEOUT = 10
+
+def _scenario(name):
+    """Run a coalescing scenario, called in the child process. Prints its outcome as JSON."""
+    import resource
+    #A runaway scenario should fail, not take the machine down with it.
+    resource.setrlimit(resource.RLIMIT_AS, (1 << 30, 1 << 30))
+    from twisted.internet import reactor
+    from twisted.logger import Logger
+    from asyncsteem import RpcClient, ResultCache
+    from asyncsteem.mocknode import MockNode, listen
+    log = Logger(observer=lambda event: None, namespace="test")
+    node = MockNode(reactor, advance=False, transactions=1)
+    address = listen(reactor, node)
+    client = RpcClient(reactor, log, nodes=[address], coalesce=True, result_cache=ResultCache({"get_content" : 60}))
+    outcome = {"results" : 0}
+    if name == "reissue":
+        #Like ActiveBlockChain at the head of the chain: ask for a block that doesn't exist yet, and ask again on a null result.
+        def on_result(result, client):
+            outcome["results"] = outcome["results"] + 1
+            if outcome["results"] < 10:
+                client.get_block(node.head_block + 1).on_result(on_result)
+            else:
+                reactor.stop()
+        client.get_block(node.head_block + 1).on_result(on_result)
+        client.get_block(node.head_block + 1).on_result(on_result)
+    if name == "mutate":
+        #The first caller changes its result, the coalesced second caller and a later cache hit should not see that.
+        outcome["titles"] = list()
+        def vandalize(result, client):
+            outcome["titles"].append(result["title"])
+            result["title"] = "changed"
+            def cached(result, client):
+                outcome["titles"].append(result["title"])
+                reactor.stop()
+            client.get_content("user1", "post-1").on_result(cached)
+        def follower(result, client):
+            outcome["titles"].append(result["title"])
+        client.get_content("user1", "post-1").on_result(vandalize)
+        client.get_content("user1", "post-1").on_result(follower)
+    client()
+    reactor.callLater(TIMEOUT, reactor.stop)
+    reactor.run()
+    outcome["requests"] = node.requests
+    print(json.dumps(outcome))
+
+def run_scenario(name):
+    """Run a scenario in a child process and return its outcome."""
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child", name], timeout=TIMEOUT + 30)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+class CoalescingTest(unittest.TestCase):
+    def test_reissue_from_result_callback(self):
+        outcome = run_scenario("reissue")
+        self.assertEqual(outcome["results"], 10)
+        #Each round the two callbacks make the call again, those two share a new request instead of the finished one.
+        self.assertEqual(outcome["requests"], 5)
+
+    def test_callers_get_their_own_copy(self):
+        outcome = run_scenario("mutate")
+        self.assertEqual(len(outcome["titles"]), 3)
+        self.assertNotEqual(outcome["titles"][0], "changed")
+        self.assertEqual(len(set(outcome["titles"])), 1)
+        self.assertEqual(outcome["requests"], 1)
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--child":
+        _scenario(sys.argv[2])
+    else:
+        unittest.main()
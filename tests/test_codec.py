@@ -0,0 +1,55 @@
+"""Tests for the pluggable JSON codec."""
+import os
+import sys
+import json
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+from asyncsteem import codec
+from asyncsteem.codec import Codec
+
+#A value with the kinds of content blocks and call arguments have.
+VALUE = {"author" : "user1", "body" : "Ünïcode 中文 and a / slash \"quoted\"", "weight" : -10000,
+         "amounts" : ["1.000 STEEM", 0.5, None, True], "nested" : {"list" : [[1, 2], {}]}}
+
+class CodecTest(unittest.TestCase):
+    def backends(self):
+        return [Codec(name) for name in codec._available()]
+
+    def test_round_trip(self):
+        for instance in self.backends():
+            encoded = instance.dumps(VALUE)
+            self.assertIsInstance(encoded, bytes)
+            self.assertEqual(instance.loads(encoded), VALUE)
+            self.assertEqual(json.loads(encoded.decode()), VALUE)
+
+    def test_request_and_batch(self):
+        for instance in self.backends():
+            first = instance.request("get_block", [20000000], 1)
+            #The second request for a method reuses the encoded prefix.
+            second = instance.request("get_block", [20000001], 2)
+            third = instance.request("call", ["condenser_api", "get_content", ["user1", "post-1"]], 3)
+            self.assertIn("get_block", instance.prefixes)
+            self.assertEqual(json.loads(first.decode()),
+                             {"jsonrpc" : "2.0", "method" : "get_block", "params" : [20000000], "id" : 1})
+            batch = json.loads(instance.batch([first, second, third]).decode())
+            self.assertEqual([request["id"] for request in batch], [1, 2, 3])
+            self.assertEqual(batch[2]["params"][2], ["user1", "post-1"])
+
+    def test_backends_agree(self):
+        encoded = [instance.dumps(VALUE) for instance in self.backends()]
+        for instance in self.backends():
+            for data in encoded:
+                self.assertEqual(instance.loads(data), VALUE)
+
+    def test_default_is_fastest(self):
+        self.assertEqual(Codec().backend, codec._available()[0])
+        self.assertEqual(codec._available()[-1], "json")
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, Codec, "simplejson")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+"""Tests for the priority lane command queue of the JSON-RPC client."""
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+from asyncsteem import commandqueue
+from asyncsteem.commandqueue import CommandQueue
+
+class _FakeTime(object):
+    """Stand in for the time module, so queue wait times are under test control."""
+    def __init__(self):
+        self.now = 1000.0
+    def time(self):
+        return self.now
+
+class CommandQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = _FakeTime()
+        self.real_time = commandqueue.time
+        commandqueue.time = self.clock
+        self.queue = CommandQueue(max_wait=5.0, aged_interval=2)
+
+    def tearDown(self):
+        commandqueue.time = self.real_time
+
+    def test_fifo_within_a_lane(self):
+        for cmd_id in range(1, 6):
+            self.queue.push(cmd_id, "normal")
+        self.assertEqual(len(self.queue), 5)
+        self.assertEqual(self.queue.pop(3), [1, 2, 3])
+        self.assertEqual(self.queue.pop(10), [4, 5])
+        self.assertEqual(self.queue.pop(10), [])
+        self.assertEqual(len(self.queue), 0)
+
+    def test_strict_priority(self):
+        self.queue.push(1, "bulk")
+        self.queue.push(2, "normal")
+        self.queue.push(3, "stream")
+        self.assertEqual(self.queue.pop(3), [3, 2, 1])
+
+    def test_requeue_goes_to_the_front(self):
+        for cmd_id in range(1, 4):
+            self.queue.push(cmd_id, "normal")
+        self.queue.push(4, "bulk")
+        taken = self.queue.pop(2)
+        self.queue.requeue([(cmd_id, "normal") for cmd_id in taken])
+        self.assertEqual(self.queue.pop(4), [1, 2, 3, 4])
+
+    def test_starving_lane_goes_ahead(self):
+        self.queue.push(100, "bulk")
+        for cmd_id in range(1, 10):
+            self.queue.push(cmd_id, "normal")
+        #Not waited long enough, strict priority.
+        self.assertEqual(self.queue.pop(3), [1, 2, 3])
+        self.clock.now = self.clock.now + 6
+        #Over aged_interval commands went by priority already, so the starving bulk command is let through first.
+        self.assertEqual(self.queue.pop(2), [100, 4])
+        self.queue.push(101, "bulk")
+        self.queue.push(102, "bulk")
+        self.clock.now = self.clock.now + 6
+        #Then once again after every aged_interval commands by priority.
+        self.assertEqual(self.queue.pop(6), [5, 101, 6, 7, 102, 8])
+
+    def test_stats(self):
+        self.queue.push(1, "normal")
+        self.queue.push(2, "normal")
+        self.clock.now = self.clock.now + 2
+        self.queue.pop(1)
+        stats = self.queue.stats()
+        self.assertEqual(stats["normal"]["depth"], 1)
+        self.assertEqual(stats["normal"]["dequeued"], 1)
+        self.assertEqual(stats["normal"]["max_wait"], 2)
+        self.assertEqual(stats["normal"]["oldest_wait"], 2)
+        self.assertEqual(self.queue.depth(["normal", "bulk", "unknown"]), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+"""Tests for the operation filters bots can be registered with."""
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+from twisted.logger import Logger
+from asyncsteem.dispatcher import BlockDispatcher, _compile_filter, _matches, _FilterIndex
+
+log = Logger(observer=lambda event: None, namespace="test")
+
+def _vote(voter, author, weight=10000):
+    return ["vote", {"voter" : voter, "author" : author, "permlink" : "post", "weight" : weight}]
+
+class _Bot(object):
+    def __init__(self):
+        self.votes = list()
+        self.transfers = list()
+    def vote(self, tm, event, client):
+        self.votes.append((event["voter"], event["author"]))
+    def transfer(self, tm, event, client):
+        self.transfers.append(event["to"])
+
+class FilterTest(unittest.TestCase):
+    def test_clauses(self):
+        clauses = _compile_filter({("voter", "author") : ["alice", "bob"], "weight" : lambda weight: weight < 0})
+        self.assertTrue(_matches(clauses, _vote("carol", "bob", -100)[1]))
+        self.assertTrue(_matches(clauses, _vote("alice", "carol", -100)[1]))
+        #All clauses have to match.
+        self.assertFalse(_matches(clauses, _vote("alice", "carol", 100)[1]))
+        self.assertFalse(_matches(clauses, _vote("carol", "dave", -100)[1]))
+        #A missing field or one that can't be hashed just doesn't match.
+        self.assertFalse(_matches(_compile_filter({"to" : "alice"}), {"from" : "alice"}))
+        self.assertFalse(_matches(_compile_filter({"to" : "alice"}), {"to" : ["alice"]}))
+        self.assertTrue(_matches(_compile_filter(lambda body: "memo" in body), {"memo" : ""}))
+
+    def test_index_keeps_registration_order(self):
+        index = _FilterIndex()
+        index.add(0, "first", "h0", _compile_filter({"voter" : ["alice", "bob"]}))
+        index.add(1, "second", "h1", None)
+        index.add(2, "third", "h2", _compile_filter({"weight" : lambda weight: weight < 0}))
+        index.add(3, "fourth", "h3", _compile_filter({"author" : "bob", "voter" : "alice"}))
+        self.assertEqual(index.match(_vote("alice", "bob", -1)[1]),
+                         (("first", "h0"), ("second", "h1"), ("third", "h2"), ("fourth", "h3")))
+        self.assertEqual(index.match(_vote("alice", "carol")[1]), (("first", "h0"), ("second", "h1")))
+        self.assertEqual(index.match(_vote("carol", "bob")[1]), (("second", "h1"),))
+        self.assertIn("alice", index.fields["voter"])
+
+    def test_dispatch(self):
+        dispatcher = BlockDispatcher(log)
+        dispatcher.rpc = None
+        everything = _Bot()
+        selective = _Bot()
+        dispatcher.register_bot(everything, "everything")
+        dispatcher.register_bot(selective, "selective", filters={"vote" : {("voter", "author") : ["alice"]},
+                                                                  "transfer" : {"to" : "selective"}})
+        block = {"timestamp" : "2018-01-01T00:00:00", "block_id" : "01312d0000", "transactions" : [
+                    {"operations" : [_vote("alice", "bob"), _vote("carol", "dave"),
+                                     ["transfer", {"from" : "x", "to" : "selective", "amount" : "1.000 STEEM"}]]},
+                    {"operations" : [_vote("dave", "alice"),
+                                     ["transfer", {"from" : "x", "to" : "y", "amount" : "1.000 STEEM"}]]}]}
+        dispatcher._process_block(block)
+        self.assertEqual(everything.votes, [("alice", "bob"), ("carol", "dave"), ("dave", "alice")])
+        self.assertEqual(everything.transfers, ["selective", "y"])
+        self.assertEqual(selective.votes, [("alice", "bob"), ("dave", "alice")])
+        self.assertEqual(selective.transfers, ["selective"])
+        dispatcher.unregister_bot("everything")
+        self.assertEqual(set(dispatcher.filtered), set(["vote", "transfer"]))
+
+    def test_non_operation_event_filters_are_ignored(self):
+        dispatcher = BlockDispatcher(log)
+        dispatcher.register_bot(_Bot(), "bot", filters={"block" : {"witness" : "x"}, "vote" : {"voter" : "alice"}})
+        self.assertEqual(list(dispatcher.filters["bot"]), ["vote"])
+
+if __name__ == "__main__":
+    unittest.main()
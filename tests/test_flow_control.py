@@ -0,0 +1,78 @@
+"""Regression tests for pausing and resuming block fetching with the flow control watermarks of ActiveBlockChain.
+
+Each scenario runs against a local mock node in a fresh process, as the Twisted reactor can only be run once.
+"""
+import os
+import sys
+import time
+import json
+import unittest
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+#Number of blocks each scenario has to get through, well beyond what the watermarks let through without resuming.
+BLOCKS = 400
+#Seconds a scenario may take before we call it stalled.
+TIMEOUT = 20
+
+def _scenario(name):
+    """Run a flow control scenario, called in the child process. Prints the number of processed blocks as JSON."""
+    from twisted.internet import reactor, defer
+    from twisted.logger import Logger
+    from asyncsteem import ActiveBlockChain
+    from asyncsteem.mocknode import MockNode, listen
+    log = Logger(observer=lambda event: None, namespace="test")
+    node = MockNode(reactor, advance=False, transactions=2, latency=0.002)
+    address = listen(reactor, node)
+    state = {"blocks" : 0}
+    class AwaitingBot(object):
+        """Bot that returns a Deferred fired from a timer for every block."""
+        def block(self, tm, event, client):
+            state["blocks"] = state["blocks"] + 1
+            deferred = defer.Deferred()
+            reactor.callLater(0.001, deferred.callback, None)
+            return deferred
+    class SlowBot(object):
+        """Bot that is slow enough to get quarantined, it then works through its blocks in a thread pool."""
+        def block(self, tm, event, client):
+            state["blocks"] = state["blocks"] + 1
+            time.sleep(0.002)
+    if name == "ready_blocks":
+        #Resumed from _drain once an awaited Deferred fires, and from the watermark poll timer.
+        blockchain = ActiveBlockChain(reactor, log, nodes=[address], max_batch_size=16, ordered=True, rewind_days=1,
+                                      ready_blocks_high=20, flow_poll_interval=0.01)
+        blockchain.register_bot(AwaitingBot(), "awaiting", await_deferreds=True)
+    else:
+        #The thread pool works through the backlog without telling the blockchain, only the watermark poll timer resumes.
+        blockchain = ActiveBlockChain(reactor, log, nodes=[address], max_batch_size=16, ordered=True, rewind_days=1,
+                                      ready_blocks_high=50, flow_poll_interval=0.01, handler_budget=0.001,
+                                      quarantine_after=3)
+        blockchain.register_bot(SlowBot(), "slow")
+    def check():
+        if state["blocks"] >= BLOCKS:
+            reactor.stop()
+        else:
+            reactor.callLater(0.1, check)
+    reactor.callLater(0.1, check)
+    reactor.callLater(TIMEOUT, reactor.stop)
+    reactor.run()
+    print(json.dumps({"blocks" : state["blocks"], "paused" : blockchain.flow_paused}))
+
+class FlowControlTest(unittest.TestCase):
+    def run_scenario(self, name):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child", name], timeout=TIMEOUT + 30)
+        return json.loads(output.decode().strip().splitlines()[-1])
+    def test_resume_after_ready_blocks_pause(self):
+        result = self.run_scenario("ready_blocks")
+        self.assertGreaterEqual(result["blocks"], BLOCKS)
+    def test_resume_with_quarantined_bot(self):
+        result = self.run_scenario("quarantine")
+        self.assertGreaterEqual(result["blocks"], BLOCKS)
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--child":
+        _scenario(sys.argv[2])
+    else:
+        unittest.main()
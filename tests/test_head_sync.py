@@ -0,0 +1,72 @@
+"""Tests for following the head of the chain with ActiveBlockChain, against a local mock node.
+
+Each scenario runs in a fresh process, as the Twisted reactor can only be run once.
+"""
+import os
+import sys
+import json
+import unittest
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+#Seconds each scenario follows the head.
+DURATION = 4
+#Seconds between blocks on the mock node, fast so the head moves a good bit during a scenario.
+BLOCK_INTERVAL = 0.1
+
+def _scenario(name):
+    """Start at the last irreversible block with many parallel get_block queries, called in the child process.
+
+    Prints the delivered block numbers and the head block at the end as JSON.
+    """
+    import resource
+    resource.setrlimit(resource.RLIMIT_AS, (1 << 30, 1 << 30))
+    from twisted.internet import reactor
+    from twisted.logger import Logger
+    from asyncsteem import ActiveBlockChain
+    from asyncsteem.mocknode import MockNode, listen
+    log = Logger(observer=lambda event: None, namespace="test")
+    node = MockNode(reactor, block_interval=BLOCK_INTERVAL, transactions=1)
+    address = listen(reactor, node)
+    blockchain = ActiveBlockChain(reactor, log, nodes=[address], initial_batch_size=128, ordered=(name == "ordered"))
+    outcome = {"blocks" : list()}
+    class Bot(object):
+        def block(self, tm, event, client):
+            outcome["blocks"].append(int(event["block_id"][:8], 16))
+    blockchain.register_bot(Bot(), "bot")
+    def done():
+        outcome["head"] = node.head()
+        reactor.stop()
+    reactor.callLater(DURATION, done)
+    reactor.run()
+    print(json.dumps(outcome))
+
+def run_scenario(name):
+    """Run a scenario in a child process and return its outcome."""
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child", name], timeout=DURATION + 30)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+class HeadSyncTest(unittest.TestCase):
+    def check_follows_head(self, outcome):
+        blocks = sorted(outcome["blocks"])
+        self.assertTrue(blocks)
+        #Every block from the start up to the last one delivered, each once.
+        self.assertEqual(blocks, list(range(blocks[0], blocks[-1] + 1)))
+        #And the last one delivered is (close to) the head, not stuck where the initial queries ran past it.
+        self.assertGreaterEqual(blocks[-1], outcome["head"] - 5)
+
+    def test_unordered(self):
+        self.check_follows_head(run_scenario("unordered"))
+
+    def test_ordered(self):
+        outcome = run_scenario("ordered")
+        self.assertEqual(outcome["blocks"], sorted(outcome["blocks"]))
+        self.check_follows_head(outcome)
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--child":
+        _scenario(sys.argv[2])
+    else:
+        unittest.main()
@@ -0,0 +1,86 @@
+"""Tests for incremental decoding of JSON-RPC batch responses."""
+import os
+import sys
+import json
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+from twisted.internet.error import ConnectionLost
+from asyncsteem.jsonstream import JsonArrayProtocol, StreamedArray, ResponseTooLarge
+
+class _Transport(object):
+    def __init__(self):
+        self.stopped = False
+    def stopProducing(self):
+        self.stopped = True
+
+class JsonStreamTest(unittest.TestCase):
+    def receive(self, body, chunk=1, max_size=None, reason=None):
+        """Feed a body to a JsonArrayProtocol in chunks, returns the elements and the outcome of its Deferred."""
+        elements = list()
+        outcome = list()
+        protocol = JsonArrayProtocol(elements.append, max_size)
+        protocol.makeConnection(_Transport())
+        protocol.finished.addBoth(outcome.append)
+        for start in range(0, len(body), chunk):
+            protocol.dataReceived(body[start:start+chunk])
+        protocol.connectionLost(Failure(reason if reason != None else ResponseDone()))
+        return elements, outcome[0], protocol
+
+    def test_elements_in_any_chunking(self):
+        replies = [{"id" : 1, "result" : {"text" : 'a "quoted" \\ [bracket], {brace}', "list" : [1, [2, 3]]}},
+                   {"id" : 2, "result" : None},
+                   {"id" : 3, "error" : {"code" : -32000, "message" : "é中"}}]
+        body = json.dumps(replies, ensure_ascii=False).encode()
+        for chunk in (1, 2, 7, len(body)):
+            elements, outcome, protocol = self.receive(b" \n" + body + b"\n", chunk)
+            self.assertEqual(elements, replies)
+            self.assertIsInstance(outcome, StreamedArray)
+            self.assertEqual(outcome.count, 3)
+
+    def test_element_handed_out_before_the_end(self):
+        elements = list()
+        protocol = JsonArrayProtocol(elements.append)
+        protocol.makeConnection(_Transport())
+        protocol.dataReceived(b'[{"id":1},{"id"')
+        self.assertEqual(elements, [{"id" : 1}])
+        #Received bytes of elements already handed out are let go of.
+        self.assertEqual(bytes(protocol.buf), b'{"id"')
+
+    def test_empty_array(self):
+        elements, outcome, protocol = self.receive(b"[ ]")
+        self.assertEqual(elements, [])
+        self.assertEqual(outcome.count, 0)
+
+    def test_other_body(self):
+        elements, outcome, protocol = self.receive(b'{"id":1,"result":[1,2]}', 3)
+        self.assertEqual(elements, [])
+        self.assertEqual(outcome, ({"id" : 1, "result" : [1, 2]}, 23))
+
+    def test_truncated_array(self):
+        elements, outcome, protocol = self.receive(b'[{"id":1},{"id":2')
+        self.assertEqual(elements, [{"id" : 1}])
+        self.assertTrue(outcome.check(ValueError))
+
+    def test_invalid_element(self):
+        elements, outcome, protocol = self.receive(b'[{"id":1},nonsense,{"id":3}]')
+        self.assertTrue(outcome.check(ValueError))
+        self.assertTrue(protocol.transport.stopped)
+
+    def test_too_large(self):
+        elements, outcome, protocol = self.receive(b'[{"id":1},{"id":2},{"id":3}]', 4, max_size=20)
+        #The elements that fit are still handed out.
+        self.assertEqual(elements, [{"id" : 1}, {"id" : 2}])
+        self.assertTrue(outcome.check(ResponseTooLarge))
+        self.assertTrue(protocol.transport.stopped)
+
+    def test_connection_lost(self):
+        elements, outcome, protocol = self.receive(b'[{"id":1}', reason=ConnectionLost())
+        self.assertTrue(outcome.check(ConnectionLost))
+
+if __name__ == "__main__":
+    unittest.main()
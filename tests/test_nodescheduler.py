@@ -0,0 +1,62 @@
+"""Tests for latency and health based API node selection."""
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+from asyncsteem.nodescheduler import NodeScheduler
+
+class NodeSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = NodeScheduler(["a", "b", "c"], down_time=30)
+
+    def test_prefers_the_fastest_node(self):
+        self.scheduler.measured("a", 0.5)
+        self.scheduler.measured("b", 0.1)
+        self.scheduler.measured("c", 0.3)
+        self.assertEqual(self.scheduler.select(), "b")
+        self.assertEqual(self.scheduler.select(exclude="b"), "c")
+
+    def test_spreads_over_nodes_in_flight(self):
+        for node in ("a", "b"):
+            self.scheduler.measured(node, 0.1)
+        self.scheduler.started("a")
+        self.assertEqual(self.scheduler.select(exclude="c"), "b")
+        self.scheduler.succeeded("a", 0.1)
+        self.assertEqual(self.scheduler.nodes["a"].in_flight, 0)
+
+    def test_avoids_nodes_behind_the_head(self):
+        for node in ("a", "b", "c"):
+            self.scheduler.measured(node, 0.1)
+        self.scheduler.report_head("a", 1000)
+        self.scheduler.report_head("b", 1010)
+        self.scheduler.report_head("c", 1010)
+        self.assertNotEqual(self.scheduler.select(), "a")
+        self.assertEqual(self.scheduler.stats()["a"]["head_lag"], 10)
+
+    def test_failing_node_leaves_rotation(self):
+        self.scheduler.measured("b", 0.5)
+        self.scheduler.measured("c", 0.5)
+        self.assertFalse(self.scheduler.failed("a", in_flight=False))
+        self.assertFalse(self.scheduler.failed("a", in_flight=False))
+        #The third error in a row takes it out.
+        self.assertTrue(self.scheduler.failed("a", in_flight=False))
+        self.assertTrue(self.scheduler.is_down("a"))
+        for attempt in range(0, 10):
+            self.assertNotEqual(self.scheduler.select(), "a")
+        self.scheduler.revive("a")
+        self.assertFalse(self.scheduler.is_down("a"))
+        self.assertEqual(self.scheduler.nodes["a"].consecutive_errors, 0)
+
+    def test_all_nodes_down(self):
+        for node in ("a", "b", "c"):
+            for attempt in range(0, 3):
+                self.scheduler.failed(node, in_flight=False)
+        self.scheduler.nodes["b"].down_until = self.scheduler.nodes["b"].down_until - 20
+        #With nothing in rotation, pick the node that comes back soonest.
+        self.assertEqual(self.scheduler.select(), "b")
+
+if __name__ == "__main__":
+    unittest.main()